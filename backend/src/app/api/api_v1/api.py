@@ -1,6 +1,7 @@
 from fastapi import APIRouter
 
-from app.api.api_v1.endpoints import items
+from app.api.api_v1.endpoints import ingestion, items
 
 api_router = APIRouter()
 api_router.include_router(items.router, prefix="/items", tags=["items"])
+api_router.include_router(ingestion.router, prefix="/ingestion", tags=["ingestion"])
@@ -2,9 +2,11 @@ import asyncio
 import datetime
 import logging
 from collections import OrderedDict
+from typing import List, Optional, Tuple
 from uuid import UUID, uuid4
 
 import anyio
+from anyio.streams.memory import MemoryObjectSendStream
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sse_starlette.sse import EventSourceResponse
@@ -17,6 +19,16 @@ from app.chat.messaging import (
     StreamedMessageSubProcess,
     handle_chat_message,
 )
+from app.core.answer_cache import (
+    CachedAnswer,
+    DocumentSetKey,
+    document_set_key,
+    get_answer_cache,
+)
+from app.core.bedrock import get_embed_model
+from app.core.chat_engine_cache import conversation_lock
+from app.core.rag_engine import get_document_versions
+from app.core.s3 import get_s3_fs
 from app.models.db import (
     Message,
     MessageRoleEnum,
@@ -29,6 +41,34 @@ router = APIRouter()
 logger = logging.getLogger(__name__)
 
 
+async def get_answer_cache_key(
+    conversation: schema.Conversation, question: str
+) -> Optional[Tuple[DocumentSetKey, List[float]]]:
+    """
+    Answers are only cached for the opening question of a conversation, later
+    ones depend on the chat history.
+    """
+    if conversation.messages or not conversation.documents:
+        return None
+    try:
+        versions = await get_document_versions(conversation.documents, fs=get_s3_fs())
+        embedding = await get_embed_model().aget_query_embedding(question)
+    except Exception:
+        # the cache is an optimisation, answer the question regardless
+        logger.warning("Could not build the answer cache key", exc_info=True)
+        return None
+    return document_set_key(versions), embedding
+
+
+async def replay_answer(
+    answer: CachedAnswer, send_chan: MemoryObjectSendStream
+) -> None:
+    async with send_chan:
+        for sub_process in answer.sub_processes:
+            await send_chan.send(sub_process)
+        await send_chan.send(StreamedMessage(content=answer.content))
+
+
 @router.post("/create")
 async def create_conversation(
     payload: schema.ConversationCreate,
@@ -103,12 +143,23 @@ async def message_conversation(
     db.add(user_message)
     db.commit()
     send_chan, recv_chan = anyio.create_memory_object_stream(100)
+    answer_cache = get_answer_cache()
+    cache_key = await get_answer_cache_key(conversation, user_message.content)
+    cached_answer = answer_cache.get(*cache_key) if cache_key else None
+
+    async def answer() -> None:
+        # turns of a conversation share its cached chat engine, so they take
+        # turns using it
+        async with conversation_lock(str(conversation_id)):
+            await handle_chat_message(conversation, user_message, send_chan)
 
     async def event_publisher():
         async with send_chan:
-            task = asyncio.create_task(
-                handle_chat_message(conversation, user_message, send_chan)
-            )
+            if cached_answer is not None:
+                # the sub processes carry the citations, so they are replayed too
+                task = asyncio.create_task(replay_answer(cached_answer, send_chan))
+            else:
+                task = asyncio.create_task(answer())
             message_id = str(uuid4())
             message = Message(
                 id=message_id,
@@ -120,6 +171,7 @@ async def message_conversation(
             )
             final_status = MessageStatusEnum.ERROR
             event_id_to_sub_process = OrderedDict()
+            event_id_to_streamed = OrderedDict()
             try:
                 async for message_obj in recv_chan:
                     if isinstance(message_obj, StreamedMessage):
@@ -148,6 +200,7 @@ async def message_conversation(
                         )
 
                         event_id_to_sub_process[message_obj.event_id] = sub_process
+                        event_id_to_streamed[message_obj.event_id] = message_obj
 
                         message.sub_processes = list(event_id_to_sub_process.values())
                     else:
@@ -162,6 +215,14 @@ async def message_conversation(
                         "handle_chat_message task failed"
                     ) from task.exception()
                 final_status = MessageStatusEnum.SUCCESS
+                if cache_key is not None and cached_answer is None:
+                    answer_cache.put(
+                        *cache_key,
+                        CachedAnswer(
+                            content=message.content,
+                            sub_processes=list(event_id_to_streamed.values()),
+                        ),
+                    )
             except:
                 logger.error("Error in message publisher", exc_info=True)
                 final_status = MessageStatusEnum.ERROR
@@ -0,0 +1,57 @@
+from fastapi import APIRouter, HTTPException
+
+from app.api.deps import CurrentUser, SessionDep
+from app.crud import document
+from app.schemas import IngestionJob, IngestionJobCreate, IngestionRequest
+from app.services.ingestion import get_ingestion_store
+
+router = APIRouter()
+
+
+@router.post("/enqueue")
+async def enqueue_documents(
+    request: IngestionRequest, session: SessionDep, user: CurrentUser
+) -> list[IngestionJob]:
+    """queue the user's documents, documents already queued keep their job"""
+    documents = await document.get_many_by_owner(
+        session, ids=request.document_ids, user=user
+    )
+    missing = set(request.document_ids) - {doc.id for doc in documents}
+    if missing:
+        raise HTTPException(
+            status_code=404, detail=f"Documents not found: {', '.join(sorted(missing))}"
+        )
+    store = get_ingestion_store()
+    return [
+        store.enqueue(
+            IngestionJobCreate(
+                document_id=doc.id,
+                url=doc.url,
+                metadata_map=doc.metadata_map,
+                not_before=request.not_before,
+            )
+        )
+        for doc in documents
+    ]
+
+
+@router.get("/get-by-id/{id}")
+async def read_job_by_id(
+    id: str, session: SessionDep, user: CurrentUser
+) -> IngestionJob:
+    job = get_ingestion_store().get(id)
+    # jobs of other users' documents are reported as missing
+    if job is None or not await document.get_many_by_owner(
+        session, ids=[job.document_id], user=user
+    ):
+        raise HTTPException(status_code=404, detail="Ingestion job not found")
+    return job
+
+
+@router.get("/get-by-document/{document_id}")
+async def read_jobs_by_document(
+    document_id: str, session: SessionDep, user: CurrentUser
+) -> list[IngestionJob]:
+    if not await document.get_many_by_owner(session, ids=[document_id], user=user):
+        raise HTTPException(status_code=404, detail="Document not found")
+    return get_ingestion_store().get_by_document(document_id)
@@ -0,0 +1,414 @@
+"""
+in-process nearest neighbour tier for hot documents
+
+a handful of popular events get most of the traffic, and every retrieval for
+them used to be a round trip to pgvector. once a document has been queried a
+few times its chunk vectors are loaded into memory, from pgvector if it can
+return them or else from the docstore and the embedding cache, and served from
+an ivf index over numpy arrays. entries are keyed by the document's storage
+version, so re-ingesting a document invalidates them, and anything not in the
+tier falls back to pgvector.
+
+conversations usually only cover a few documents, so their chunk vectors are
+also loaded once into one contiguous matrix per document set and scanned in
+full, with a single matrix-vector product per retrieval. both keep the vectors
+quantized, see app.core.quantization.
+"""
+
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from cachetools import LRUCache, TTLCache
+from llama_index.core import VectorStoreIndex
+from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.core.schema import BaseNode, MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import (
+    ExactMatchFilter,
+    MetadataFilters,
+    VectorStoreQueryResult,
+)
+
+from app.chat.constants import DB_DOC_ID_KEY
+from app.core.config import settings
+from app.core.embedding_cache import get_embedding_cache
+from app.core.multi_doc import SharedDocumentQuery
+from app.core.quantization import QuantizedVectors
+from app.core.quantization import top_k as _top_k
+
+logger = logging.getLogger(__name__)
+
+# below this many vectors a flat scan is as fast as probing clusters
+FLAT_MAX_VECTORS = 2048
+
+
+def _payload_nbytes(nodes: Sequence[BaseNode]) -> int:
+    """rough in-memory size of the nodes' text and metadata"""
+    return sum(len(node.get_content(metadata_mode=MetadataMode.ALL)) for node in nodes)
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.where(norms == 0, 1, norms)
+
+
+class IVFIndex:
+    """
+    Cosine similarity search over one document's chunks. Large documents are
+    clustered with spherical k-means and only the `n_probe` closest clusters
+    are scanned, small ones are scanned in full.
+    """
+
+    def __init__(
+        self,
+        nodes: Sequence[BaseNode],
+        embeddings: np.ndarray,
+        n_probe: int = 8,
+        kmeans_iters: int = 10,
+        seed: int = 0,
+    ):
+        self.nodes = list(nodes)
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32))
+        self.n_probe = n_probe
+        self.centroids: Optional[np.ndarray] = None
+        self.lists: List[np.ndarray] = []
+        if len(self.nodes) > FLAT_MAX_VECTORS:
+            self._train(vectors, int(np.sqrt(len(self.nodes))), kmeans_iters, seed)
+        self.store = QuantizedVectors(vectors)
+        centroids = 0 if self.centroids is None else self.centroids.nbytes
+        self.nbytes = self.store.nbytes + centroids + _payload_nbytes(self.nodes)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """the full precision vectors"""
+        return self.store.full
+
+    def _train(self, vectors: np.ndarray, n_lists: int, iters: int, seed: int) -> None:
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+        for _ in range(iters):
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+            for i in range(n_lists):
+                members = vectors[assignment == i]
+                if len(members):
+                    centroids[i] = members.sum(axis=0)
+            centroids = _normalize(centroids)
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        self.centroids = centroids
+        self.lists = [np.flatnonzero(assignment == i) for i in range(n_lists)]
+
+    def search(
+        self, query: Sequence[float], top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """positions and scores of the `top_k` closest chunks"""
+        q = _normalize(np.asarray(query, dtype=np.float32))
+        if self.centroids is None:
+            return self.store.search(q, top_k)
+        probe = _top_k(self.centroids @ q, self.n_probe)
+        candidates = np.concatenate([self.lists[i] for i in probe])
+        positions, scores = self.store.search(q, top_k, rows=candidates)
+        return candidates[positions], scores
+
+    def query(self, query: Sequence[float], top_k: int) -> VectorStoreQueryResult:
+        positions, scores = self.search(query, top_k)
+        nodes = [self.nodes[i] for i in positions]
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=scores.tolist(),
+            ids=[node.node_id for node in nodes],
+        )
+
+
+def load_document_embeddings(
+    doc_id: str,
+    index: VectorStoreIndex,
+    model_name: str,
+) -> Optional[Tuple[List[BaseNode], np.ndarray]]:
+    """
+    The chunks of one document and their vectors, or None if the vectors can't
+    all be recovered without re-embedding. The vectors are taken off the nodes,
+    as python lists they take several times the room of the array.
+    """
+    filters = MetadataFilters(
+        filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value=doc_id)]
+    )
+    try:
+        nodes = index.vector_store.get_nodes(filters=filters)
+    except NotImplementedError:
+        nodes = []
+    if nodes and all(node.embedding is not None for node in nodes):
+        embeddings = [node.embedding for node in nodes]
+    else:
+        nodes = [
+            node
+            for node in index.docstore.get_nodes(
+                list(index.index_struct.nodes_dict.values()), raise_error=False
+            )
+            if node is not None
+        ]
+        embeddings = get_embedding_cache().get_many(
+            model_name,
+            [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes],
+        )
+        if not nodes or any(embedding is None for embedding in embeddings):
+            return None
+    matrix = np.array(embeddings, dtype=np.float32)
+    for node in nodes:
+        node.embedding = None
+    return nodes, matrix
+
+
+def load_document_vectors(
+    doc_id: str,
+    index: VectorStoreIndex,
+    model_name: str,
+) -> Optional[IVFIndex]:
+    loaded = load_document_embeddings(doc_id, index, model_name)
+    return IVFIndex(*loaded) if loaded is not None else None
+
+
+class DocumentMatrix:
+    """
+    The chunk vectors of a set of documents in one contiguous, normalized
+    matrix, with each document's chunks in a contiguous run of rows.
+    """
+
+    def __init__(self, documents: Dict[str, Tuple[List[BaseNode], np.ndarray]]):
+        self.nodes: List[BaseNode] = []
+        self.ranges: Dict[str, Tuple[int, int]] = {}
+        blocks = []
+        for doc_id, (nodes, embeddings) in documents.items():
+            start = len(self.nodes)
+            self.nodes.extend(nodes)
+            self.ranges[doc_id] = (start, len(self.nodes))
+            blocks.append(embeddings)
+        self.store = QuantizedVectors(
+            _normalize(np.concatenate(blocks).astype(np.float32))
+            if blocks
+            else np.zeros((0, 0), dtype=np.float32)
+        )
+        self.nbytes = self.store.nbytes + _payload_nbytes(self.nodes)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.ranges
+
+    def query(
+        self, query: Sequence[float], top_k: int, doc_id: Optional[str] = None
+    ) -> VectorStoreQueryResult:
+        """top k over one document's rows, or over every row"""
+        start, end = self.ranges[doc_id] if doc_id else (0, len(self.nodes))
+        if start == end:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        q = _normalize(np.asarray(query, dtype=np.float32))
+        positions, scores = self.store.search(q, top_k, rows=slice(start, end))
+        nodes = [self.nodes[start + i] for i in positions]
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=scores.tolist(),
+            ids=[node.node_id for node in nodes],
+        )
+
+
+# sorted ((doc_id, storage version), ...) -> DocumentMatrix
+_document_matrices: LRUCache = LRUCache(maxsize=settings.DOCUMENT_MATRIX_CACHE_SIZE)
+
+
+async def get_document_matrix(
+    doc_id_to_index: Dict[str, VectorStoreIndex], model_name: str
+) -> Optional[DocumentMatrix]:
+    """
+    The matrix for a conversation's documents, loaded on first use and shared
+    by every conversation over the same document versions. None if the
+    documents have more chunks than EXACT_SEARCH_MAX_CHUNKS.
+    """
+    chunks = sum(
+        len(index.index_struct.nodes_dict) for index in doc_id_to_index.values()
+    )
+    if not doc_id_to_index or chunks > settings.EXACT_SEARCH_MAX_CHUNKS:
+        return None
+    key = tuple(
+        sorted(
+            (doc_id, index.storage_context.index_store.index_version(doc_id))
+            for doc_id, index in doc_id_to_index.items()
+        )
+    )
+    matrix = _document_matrices.get(key)
+    if matrix is None:
+
+        def load() -> DocumentMatrix:
+            documents = {}
+            for doc_id, index in doc_id_to_index.items():
+                loaded = load_document_embeddings(doc_id, index, model_name)
+                if loaded is not None:
+                    documents[doc_id] = loaded
+            return DocumentMatrix(documents)
+
+        matrix = await asyncio.to_thread(load)
+        _document_matrices[key] = matrix
+        logger.info(
+            "Loaded %d chunks of %d documents for exact search.",
+            len(matrix.nodes),
+            len(matrix.ranges),
+        )
+    return matrix
+
+
+class ANNCache:
+    def __init__(
+        self,
+        max_bytes: int = settings.ANN_CACHE_MAX_BYTES,
+        hot_queries: int = settings.ANN_HOT_QUERIES,
+        tracked_documents: int = settings.ANN_TRACKED_DOCUMENTS,
+        unavailable_ttl: float = settings.ANN_UNAVAILABLE_TTL,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.hot_queries = hot_queries
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[int, IVFIndex]]" = OrderedDict()
+        # (doc_id, version) -> pgvector queries, the coldest are forgotten first
+        self._queries: LRUCache = LRUCache(maxsize=tracked_documents)
+        # builds in flight, and versions that can't be built without bedrock
+        self._building: Set[Tuple[str, int]] = set()
+        self._unavailable: TTLCache = TTLCache(
+            maxsize=tracked_documents, ttl=unavailable_ttl
+        )
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ann")
+
+    def get(self, doc_id: str, version: int) -> Optional[IVFIndex]:
+        with self._lock:
+            entry = self._entries.get(doc_id)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(doc_id)
+            self.hits += 1
+            return entry[1]
+
+    def record_miss(
+        self, doc_id: str, version: int, loader: Callable[[], Optional[IVFIndex]]
+    ) -> None:
+        """count a query served by pgvector, loading the document once it's hot"""
+        if self.max_bytes <= 0:
+            return
+        key = (doc_id, version)
+        with self._lock:
+            if key in self._building or key in self._unavailable:
+                return
+            self._queries[key] = self._queries.get(key, 0) + 1
+            if self._queries[key] < self.hot_queries:
+                return
+            self._building.add(key)
+        self._executor.submit(self._build, doc_id, version, loader)
+
+    def _build(
+        self, doc_id: str, version: int, loader: Callable[[], Optional[IVFIndex]]
+    ) -> None:
+        key = (doc_id, version)
+        try:
+            ann_index = loader()
+        except Exception:
+            logger.warning("Failed to load vectors for %s", doc_id, exc_info=True)
+            ann_index = None
+        with self._lock:
+            self._building.discard(key)
+            self._queries.pop(key, None)
+            if ann_index is None:
+                self._unavailable[key] = True
+                return
+        self.put(doc_id, version, ann_index)
+        logger.info("Serving %s from memory (%d chunks).", doc_id, len(ann_index.nodes))
+
+    def put(self, doc_id: str, version: int, ann_index: IVFIndex) -> None:
+        size = ann_index.nbytes
+        with self._lock:
+            previous = self._entries.pop(doc_id, None)
+            if previous is not None:
+                self.size -= previous[1].nbytes
+            if size > self.max_bytes:
+                return
+            self._entries[doc_id] = (version, ann_index)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted.nbytes
+
+
+_ann_cache: Optional[ANNCache] = None
+
+
+def get_ann_cache() -> ANNCache:
+    global _ann_cache
+    if _ann_cache is None:
+        _ann_cache = ANNCache()
+    return _ann_cache
+
+
+class ANNVectorIndexRetriever(VectorIndexRetriever):
+    """
+    Retriever for one document. It answers exactly from the conversation's
+    DocumentMatrix if it holds the document, then from the in-process tier if
+    the document is loaded there, and from the vector store otherwise, through
+    the query `shared` with the conversation's other documents if given.
+    """
+
+    def __init__(
+        self,
+        index: VectorStoreIndex,
+        doc_id: str,
+        version: int,
+        ann_cache: Optional[ANNCache] = None,
+        matrix: Optional[DocumentMatrix] = None,
+        shared: Optional[SharedDocumentQuery] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(index, **kwargs)
+        self._doc_id = doc_id
+        self._version = version
+        self._ann_cache = ann_cache or get_ann_cache()
+        self._matrix = matrix
+        self._shared = shared
+
+    def _load(self) -> Optional[IVFIndex]:
+        return load_document_vectors(
+            self._doc_id, self._index, self._embed_model.model_name
+        )
+
+    def _ann_query(self, query_bundle: QueryBundle) -> Optional[VectorStoreQueryResult]:
+        if query_bundle.embedding is None:
+            return None
+        if self._matrix is not None and self._doc_id in self._matrix:
+            return self._matrix.query(
+                query_bundle.embedding, self._similarity_top_k, self._doc_id
+            )
+        ann_index = self._ann_cache.get(self._doc_id, self._version)
+        if ann_index is None:
+            self._ann_cache.record_miss(self._doc_id, self._version, self._load)
+            return None
+        return ann_index.query(query_bundle.embedding, self._similarity_top_k)
+
+    def _get_nodes_with_embeddings(
+        self, query_bundle_with_embeddings: QueryBundle
+    ) -> List[NodeWithScore]:
+        result = self._ann_query(query_bundle_with_embeddings)
+        if result is None:
+            return super()._get_nodes_with_embeddings(query_bundle_with_embeddings)
+        return self._build_node_list_from_query_result(result)
+
+    async def _aget_nodes_with_embeddings(
+        self, query_bundle_with_embeddings: QueryBundle
+    ) -> List[NodeWithScore]:
+        result = self._ann_query(query_bundle_with_embeddings)
+        if result is not None:
+            return self._build_node_list_from_query_result(result)
+        if self._shared is not None:
+            return await self._shared.aretrieve(
+                self._doc_id, query_bundle_with_embeddings, self._similarity_top_k
+            )
+        return await super()._aget_nodes_with_embeddings(query_bundle_with_embeddings)
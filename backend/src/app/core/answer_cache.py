@@ -0,0 +1,109 @@
+"""
+semantic cache of assistant answers
+
+the same few questions get asked about the busiest events over and over, and
+every one of them used to run the whole agent. answers are cached per set of
+documents, keyed by the storage version of each document so re-ingesting any
+of them misses, and looked up by the cosine similarity of the question's
+embedding to the questions already answered.
+"""
+
+import itertools
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from cachetools import TTLCache
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# sorted ((doc_id, storage version), ...)
+DocumentSetKey = Tuple[Tuple[str, int], ...]
+
+
+def document_set_key(versions: Dict[str, int]) -> DocumentSetKey:
+    return tuple(sorted(versions.items()))
+
+
+@dataclass
+class CachedAnswer:
+    """what the chat endpoint streamed for an answer, replayed on a hit"""
+
+    content: str
+    sub_processes: List[Any] = field(default_factory=list)
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        threshold: float = settings.ANSWER_CACHE_SIMILARITY,
+        ttl: float = settings.ANSWER_CACHE_TTL,
+        maxsize: int = settings.ANSWER_CACHE_SIZE,
+    ):
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        # entry id -> (normalized question embedding, answer)
+        self._entries: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._by_documents: Dict[DocumentSetKey, Set[int]] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def get(
+        self, documents: DocumentSetKey, embedding: Sequence[float]
+    ) -> Optional[CachedAnswer]:
+        q = np.asarray(embedding, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1)
+        best, best_score = None, self.threshold
+        with self._lock:
+            ids = self._by_documents.get(documents, set())
+            # drop the ids the ttl cache has expired or evicted
+            ids.intersection_update(self._entries.keys())
+            for entry_id in ids:
+                vector, answer = self._entries[entry_id]
+                score = float(vector @ q)
+                if score >= best_score:
+                    best, best_score = answer, score
+            if not ids:
+                self._by_documents.pop(documents, None)
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return best
+
+    def put(
+        self,
+        documents: DocumentSetKey,
+        embedding: Sequence[float],
+        answer: CachedAnswer,
+    ) -> None:
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1)
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (vector, answer)
+            self._by_documents.setdefault(documents, set()).add(entry_id)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+_answer_cache: Optional[AnswerCache] = None
+
+
+def get_answer_cache() -> AnswerCache:
+    global _answer_cache
+    if _answer_cache is None:
+        _answer_cache = AnswerCache()
+    return _answer_cache
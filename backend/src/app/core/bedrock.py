@@ -0,0 +1,141 @@
+"""
+process-wide bedrock clients
+
+building a BedrockConverse or BedrockEmbedding creates a boto session and
+client, which takes around 100ms and opens fresh connections, and every chat
+message used to build several of them. one of each model and region is built
+with a pooled connection config, warmed at startup, and requests get a shallow
+copy that shares its clients but carries the request's callback manager and
+the per-call state the llm keeps on itself.
+"""
+
+import asyncio
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from botocore.config import Config
+from llama_index.core.callbacks.base import CallbackManager
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.embeddings.bedrock import BedrockEmbedding, Models
+from llama_index.llms.bedrock_converse import BedrockConverse
+
+from app.chat.constants import NODE_PARSER_CHUNK_OVERLAP, NODE_PARSER_CHUNK_SIZE
+from app.core.config import settings
+from app.core.embedding_cache import CachedEmbedding
+from app.core.embedding_scheduler import ScheduledEmbedding
+
+BEDROCK_TOOL_LLM_NAME = "anthropic.claude-3-sonnet-20240229-v1:0"
+BEDROCK_CHAT_LLM_NAME = "anthropic.claude-3-sonnet-20240229-v1:0"
+SIMPLE_BEDROCK_CHAT_LLM_NAME = "anthropic.claude-3-sonnet-20240229-v1:0"
+
+# the (model, region) pairs the chat engines use, built at startup
+STARTUP_LLMS = (
+    (BEDROCK_TOOL_LLM_NAME, "ap-southeast-1"),
+    (BEDROCK_TOOL_LLM_NAME, "us-east-1"),
+)
+
+_prototypes: Dict[Tuple[str, ...], Any] = {}
+_lock = threading.Lock()
+
+
+def _prototype(key: Tuple[str, ...], build: Callable[[], Any]) -> Any:
+    prototype = _prototypes.get(key)
+    if prototype is None:
+        with _lock:
+            prototype = _prototypes.get(key)
+            if prototype is None:
+                prototype = _prototypes[key] = build()
+    return prototype
+
+
+def _for_request(prototype: Any, callback_manager: Optional[CallbackManager]) -> Any:
+    """
+    A shallow copy of `prototype` sharing its clients, with its own callback
+    manager. pydantic's copy() drops the fields llama index excludes from
+    serialization, the callback manager among them, so the copy is built here.
+    """
+    copied = prototype.__class__.construct(
+        _fields_set=set(prototype.__fields_set__),
+        **{
+            **prototype.__dict__,
+            "callback_manager": callback_manager or CallbackManager([]),
+        },
+    )
+    for name in prototype.__private_attributes__:
+        if hasattr(prototype, name):
+            object.__setattr__(copied, name, getattr(prototype, name))
+    return copied
+
+
+def _botocore_config() -> Config:
+    return Config(
+        retries={"max_attempts": 10, "mode": "standard"},
+        connect_timeout=60,
+        read_timeout=60,
+        max_pool_connections=settings.BEDROCK_MAX_POOL_CONNECTIONS,
+    )
+
+
+def get_llm(
+    model: str,
+    region_name: str,
+    callback_manager: Optional[CallbackManager] = None,
+) -> BedrockConverse:
+    def build() -> BedrockConverse:
+        return BedrockConverse(
+            temperature=0,
+            model=model,
+            aws_access_key_id=settings.AWS_KEY,
+            aws_secret_access_key=settings.AWS_SECRET,
+            region_name=region_name,
+            botocore_config=_botocore_config(),
+        )
+
+    prototype = _prototype(("llm", model, region_name), build)
+    # achat writes the system prompt onto the llm, so every request gets its own
+    return _for_request(prototype, callback_manager)
+
+
+def get_embed_model(
+    callback_manager: Optional[CallbackManager] = None,
+) -> CachedEmbedding:
+    def build() -> CachedEmbedding:
+        embedding_model = BedrockEmbedding(
+            model_name=Models.COHERE_EMBED_ENGLISH_V3,
+            aws_access_key_id=settings.AWS_KEY,
+            aws_secret_access_key=settings.AWS_SECRET,
+            region_name=settings.BEDROCK_REGION,
+            # cohere on bedrock takes at most 96 texts per call
+            embed_batch_size=96,
+            botocore_config=_botocore_config(),
+        )
+        # identical chunks are only ever sent to bedrock once, and the rest go
+        # out in concurrent, rate limited batches
+        return CachedEmbedding(ScheduledEmbedding(embedding_model))
+
+    prototype = _prototype(("embed", settings.BEDROCK_REGION), build)
+    # the service context sets its callback manager on the embed model
+    return _for_request(prototype, callback_manager)
+
+
+def get_node_parser(
+    callback_manager: Optional[CallbackManager] = None,
+) -> SentenceSplitter:
+    def build() -> SentenceSplitter:
+        # Use a smaller chunk size to retrieve more granular results
+        return SentenceSplitter.from_defaults(
+            chunk_size=NODE_PARSER_CHUNK_SIZE,
+            chunk_overlap=NODE_PARSER_CHUNK_OVERLAP,
+        )
+
+    return _for_request(_prototype(("node_parser",), build), callback_manager)
+
+
+async def init_bedrock_clients() -> None:
+    def warm() -> None:
+        get_embed_model()
+        get_node_parser()
+        for model, region_name in STARTUP_LLMS:
+            get_llm(model, region_name)
+
+    await asyncio.to_thread(warm)
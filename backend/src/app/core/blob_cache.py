@@ -0,0 +1,133 @@
+"""
+local, content addressed cache for downloaded documents
+
+blobs are stored once per content hash under `objects/`, and `refs/` maps each
+document id to the etag and content hash it was last fetched with, so a rebuild
+can revalidate with a conditional get and read unchanged documents from disk.
+all writes are atomic renames, which lets several workers on the same node share
+one cache directory. the directory is kept under a byte budget by evicting the
+least recently used blobs.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import IO, Callable, Optional
+
+from app.core.config import settings
+from app.core.fetcher import FetchedDocument
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BlobRef:
+    etag: str
+    content_hash: str
+
+
+class BlobCache:
+    def __init__(
+        self,
+        root: str = settings.BLOB_CACHE_DIR,
+        max_bytes: int = settings.BLOB_CACHE_MAX_BYTES,
+    ):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._objects = self.root / "objects"
+        self._refs = self.root / "refs"
+        self._objects.mkdir(parents=True, exist_ok=True)
+        self._refs.mkdir(parents=True, exist_ok=True)
+        self._evict_lock = threading.Lock()
+
+    def _blob_path(self, content_hash: str) -> Path:
+        return self._objects / content_hash
+
+    def _write_atomic(self, path: Path, write: Callable[[IO[bytes]], object]) -> None:
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def get(self, key: str) -> Optional[BlobRef]:
+        """the ref for `key`, if both it and its blob are in the cache"""
+        try:
+            ref = BlobRef(**json.loads((self._refs / key).read_text()))
+        except (FileNotFoundError, ValueError, TypeError):
+            return None
+        return ref if self._blob_path(ref.content_hash).exists() else None
+
+    def open(self, ref: BlobRef) -> FetchedDocument:
+        """
+        Open a cached blob and mark it as recently used. Raises
+        FileNotFoundError if another worker evicted it in the meantime.
+        """
+        path = self._blob_path(ref.content_hash)
+        content = open(path, "rb")
+        os.utime(path)
+        return FetchedDocument(
+            content=content, etag=ref.etag, content_hash=ref.content_hash
+        )
+
+    def put(self, key: str, fetched: FetchedDocument) -> None:
+        """store a freshly fetched document, leaving its buffer rewound"""
+        if not fetched.etag:
+            # nothing to revalidate against, so caching it would not save a fetch
+            return
+        path = self._blob_path(fetched.content_hash)
+        if path.exists():
+            os.utime(path)
+        else:
+            self._write_atomic(path, lambda f: shutil.copyfileobj(fetched.content, f))
+            fetched.content.seek(0)
+        ref = BlobRef(etag=fetched.etag, content_hash=fetched.content_hash)
+        self._write_atomic(
+            self._refs / key, lambda f: f.write(json.dumps(asdict(ref)).encode())
+        )
+        self.evict()
+
+    def evict(self) -> None:
+        with self._evict_lock:
+            blobs = [
+                entry
+                for entry in os.scandir(self._objects)
+                if entry.is_file() and not entry.name.startswith(".tmp-")
+            ]
+            stats = {entry.path: entry.stat() for entry in blobs}
+            size = sum(stat.st_size for stat in stats.values())
+            if size <= self.max_bytes:
+                return
+            evicted = 0
+            for blob_path, stat in sorted(
+                stats.items(), key=lambda item: item[1].st_mtime
+            ):
+                if size <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(blob_path)
+                except FileNotFoundError:
+                    pass
+                size -= stat.st_size
+                evicted += 1
+            # refs pointing at evicted blobs are ignored by get and overwritten
+            # on the next fetch
+            logger.info("Evicted %d blobs from the document cache.", evicted)
+
+
+_blob_cache: Optional[BlobCache] = None
+
+
+def get_blob_cache() -> BlobCache:
+    global _blob_cache
+    if _blob_cache is None:
+        _blob_cache = BlobCache()
+    return _blob_cache
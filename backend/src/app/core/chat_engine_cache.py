@@ -0,0 +1,134 @@
+"""
+per-conversation cache of built chat engines
+
+every message used to rebuild the conversation's tools, sub question engine,
+response synthesizer and agent, and convert its whole message history again.
+built engines are kept per conversation and set of documents until they go
+idle, each request swaps its callback handler into the engine's callback
+manager, and only the messages added since the last request are converted.
+
+the chat endpoint holds the conversation's lock for a whole turn, so a cached
+engine never serves two messages at once, which would send one turn's events
+to the other's stream and reset its agent mid-turn.
+"""
+
+import asyncio
+import threading
+import weakref
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from cachetools import TTLCache
+from llama_index.core.callbacks.base import BaseCallbackHandler, CallbackManager
+from llama_index.core.llms import ChatMessage
+
+from app.core.answer_cache import DocumentSetKey
+from app.core.config import settings
+from app.models.db import MessageStatusEnum
+from app.schema import Message as MessageSchema
+
+# (engine kind, conversation id, document versions, searched doc ids)
+ChatEngineKey = Tuple[str, str, DocumentSetKey, Tuple[str, ...]]
+
+
+@dataclass
+class CachedChatEngine:
+    engine: Any
+    callback_manager: CallbackManager
+    # the converted history of the first `settled` messages, which are final
+    history: List[ChatMessage] = field(default_factory=list)
+    settled: int = 0
+    last_settled_id: Optional[Any] = None
+
+    def use(self, callback_handler: BaseCallbackHandler) -> None:
+        """route the engine's events to the handler of the current request"""
+        self.callback_manager.set_handlers([callback_handler])
+
+    def sync_history(
+        self,
+        messages: Sequence[MessageSchema],
+        convert: Callable[[List[MessageSchema]], List[ChatMessage]],
+    ) -> List[ChatMessage]:
+        """
+        The converted history of `messages`. The messages converted for an
+        earlier request are reused if they are still a prefix of `messages`,
+        otherwise everything is converted again.
+        """
+        n = self.settled
+        if len(messages) < n or (n and messages[n - 1].id != self.last_settled_id):
+            self.history, self.settled, self.last_settled_id = [], 0, None
+            n = 0
+        # pending messages can still change, so they are converted every time
+        settled = n
+        while (
+            settled < len(messages)
+            and messages[settled].status != MessageStatusEnum.PENDING
+        ):
+            settled += 1
+        if settled > n:
+            self.history.extend(convert(list(messages[n:settled])))
+            self.settled = settled
+            self.last_settled_id = messages[settled - 1].id
+        return self.history + convert(list(messages[settled:]))
+
+
+class ChatEngineCache:
+    def __init__(
+        self,
+        maxsize: int = settings.CHAT_ENGINE_CACHE_SIZE,
+        ttl: float = settings.CHAT_ENGINE_CACHE_TTL,
+    ):
+        self.hits = 0
+        self.misses = 0
+        self._entries: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, key: ChatEngineKey) -> Optional[CachedChatEngine]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                # the ttl counts from the last message, not the first
+                self._entries[key] = entry
+        return entry
+
+    def put(self, key: ChatEngineKey, entry: CachedChatEngine) -> None:
+        with self._lock:
+            self._entries[key] = entry
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+_conversation_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = (
+    weakref.WeakValueDictionary()
+)
+
+
+def conversation_lock(conversation_id: str) -> asyncio.Lock:
+    """
+    The lock to hold while answering a message of the conversation. It is
+    dropped once no turn holds or waits for it.
+    """
+    lock = _conversation_locks.get(conversation_id)
+    if lock is None:
+        lock = _conversation_locks[conversation_id] = asyncio.Lock()
+    return lock
+
+
+_chat_engine_cache: Optional[ChatEngineCache] = None
+
+
+def get_chat_engine_cache() -> ChatEngineCache:
+    global _chat_engine_cache
+    if _chat_engine_cache is None:
+        _chat_engine_cache = ChatEngineCache()
+    return _chat_engine_cache
@@ -0,0 +1,240 @@
+"""
+rolling summary of long conversations
+
+every message of a conversation used to go into the prompt, so prompt size,
+cost and time to first token grew with the length of the conversation. the
+prompt now holds the most recent messages that fit in a token budget, preceded
+by a summary of everything before them. when older messages no longer fit they
+are folded into the summary in the background, off the request path, and stay
+in the prompt verbatim until that lands. the summary is stored next to the
+conversation on s3 so any worker can pick it up.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+
+from cachetools import LRUCache
+from fsspec.asyn import AsyncFileSystem
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.utils import get_tokenizer
+
+from app.core.bedrock import BEDROCK_CHAT_LLM_NAME, get_llm
+from app.core.config import settings
+from app.core.s3 import get_s3_fs, run_fs_call
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """\
+Progressively summarize the conversation between a user and an assistant \
+about the events the user selected, adding to the summary so far. Keep the \
+events, dates, places and preferences the user mentioned, and what the \
+assistant recommended. Use at most {max_words} words.
+
+Summary so far:
+{summary}
+
+New messages:
+{messages}
+
+New summary:"""
+
+# (summary so far, messages to fold into it) -> new summary
+Summarizer = Callable[[str, Sequence[ChatMessage]], Awaitable[str]]
+
+
+def count_tokens(text: str) -> int:
+    return len(get_tokenizer()(text))
+
+
+def message_digest(message: ChatMessage) -> str:
+    text = f"{message.role.value}:{message.content or ''}"
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def format_messages(messages: Sequence[ChatMessage]) -> str:
+    return "\n".join(f"{m.role.value}: {m.content}" for m in messages)
+
+
+async def summarize_with_llm(summary: str, messages: Sequence[ChatMessage]) -> str:
+    llm = get_llm(BEDROCK_CHAT_LLM_NAME, "us-east-1")
+    response = await llm.acomplete(
+        SUMMARY_PROMPT.format(
+            max_words=settings.CHAT_SUMMARY_MAX_WORDS,
+            summary=summary or "(none)",
+            messages=format_messages(messages),
+        )
+    )
+    return response.text.strip()
+
+
+@dataclass
+class ConversationMemory:
+    """the summary of a conversation's first `summarized` history messages"""
+
+    summary: str = ""
+    summarized: int = 0
+    # digest of the last summarized message, to notice a changed history
+    digest: Optional[str] = None
+
+    def matches(self, history: Sequence[ChatMessage]) -> bool:
+        if not self.summarized:
+            return True
+        return (
+            len(history) >= self.summarized
+            and message_digest(history[self.summarized - 1]) == self.digest
+        )
+
+
+class ChatMemoryStore:
+    def __init__(
+        self,
+        fs: AsyncFileSystem,
+        root: Optional[str] = None,
+        token_budget: int = settings.CHAT_HISTORY_TOKEN_BUDGET,
+        summarizer: Summarizer = summarize_with_llm,
+        maxsize: int = settings.CHAT_MEMORY_CACHE_SIZE,
+    ):
+        self.fs = fs
+        # the bucket is only known once settings are loaded
+        self.root = root if root is not None else settings.S3_BUCKET_NAME
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        self._memories: LRUCache = LRUCache(maxsize=maxsize)
+        self._summarizing: Dict[str, asyncio.Task] = {}
+
+    def _path(self, conversation_id: str) -> str:
+        return f"{self.root}/conversations/{conversation_id}/memory.json"
+
+    async def get(self, conversation_id: str) -> ConversationMemory:
+        memory = self._memories.get(conversation_id)
+        if memory is None:
+            try:
+                data = json.loads(
+                    await run_fs_call(self.fs, "cat_file", self._path(conversation_id))
+                )
+                memory = ConversationMemory(**data)
+            except FileNotFoundError:
+                memory = ConversationMemory()
+            self._memories[conversation_id] = memory
+        return memory
+
+    async def save(self, conversation_id: str, memory: ConversationMemory) -> None:
+        self._memories[conversation_id] = memory
+        await run_fs_call(
+            self.fs,
+            "pipe_file",
+            self._path(conversation_id),
+            json.dumps(asdict(memory)).encode(),
+        )
+
+    def _window_start(
+        self, history: Sequence[ChatMessage], budget: int, floor: int
+    ) -> int:
+        """where the most recent messages fitting in `budget` tokens start"""
+        start, used = len(history), 0
+        while start > floor:
+            used += count_tokens(history[start - 1].content or "")
+            if used > budget:
+                break
+            start -= 1
+        # a window opening with an answer reads as an answer to nothing
+        while start < len(history) and history[start].role != MessageRole.USER:
+            start += 1
+        return start
+
+    async def pack(
+        self, conversation_id: str, history: Sequence[ChatMessage]
+    ) -> List[ChatMessage]:
+        """
+        The summary of the older part of `history` and the messages since,
+        within the token budget. Messages past the budget that aren't in the
+        summary yet are kept until the fold started for them is saved. Only the
+        most recent messages are counted, so this takes the same time however
+        long the conversation is.
+        """
+        memory = await self.get(conversation_id)
+        if not memory.matches(history):
+            logger.info("History of conversation %s changed.", conversation_id)
+            memory = ConversationMemory()
+            self._memories[conversation_id] = memory
+        summary_tokens = count_tokens(memory.summary)
+        start = self._window_start(
+            history, self.token_budget - summary_tokens, memory.summarized
+        )
+        if start > memory.summarized:
+            # fold down to half the budget, so this doesn't run every turn
+            end = self._window_start(
+                history, (self.token_budget - summary_tokens) // 2, memory.summarized
+            )
+            self._summarize_later(conversation_id, memory, history, end)
+
+        # over budget rather than dropping what the user just said
+        packed = list(history[memory.summarized :])
+        if memory.summary:
+            packed.insert(
+                0,
+                ChatMessage(
+                    role=MessageRole.SYSTEM,
+                    content=f"Summary of the conversation so far:\n{memory.summary}",
+                ),
+            )
+        return packed
+
+    def _summarize_later(
+        self,
+        conversation_id: str,
+        memory: ConversationMemory,
+        history: Sequence[ChatMessage],
+        end: int,
+    ) -> None:
+        if conversation_id in self._summarizing:
+            return
+        task = asyncio.create_task(
+            self.summarize(conversation_id, memory, history, end)
+        )
+        self._summarizing[conversation_id] = task
+        task.add_done_callback(lambda _: self._summarizing.pop(conversation_id, None))
+
+    async def summarize(
+        self,
+        conversation_id: str,
+        memory: ConversationMemory,
+        history: Sequence[ChatMessage],
+        end: int,
+    ) -> Optional[ConversationMemory]:
+        """fold history[memory.summarized:end] into the summary and save it"""
+        summary, start = memory.summary, memory.summarized
+        try:
+            # a batch at a time, so no summary prompt outgrows the budget
+            while start < end:
+                stop, used = start, 0
+                while stop < end and (stop == start or used < self.token_budget):
+                    used += count_tokens(history[stop].content or "")
+                    stop += 1
+                summary = await self.summarizer(summary, history[start:stop])
+                start = stop
+            updated = ConversationMemory(
+                summary=summary,
+                summarized=end,
+                digest=message_digest(history[end - 1]),
+            )
+            await self.save(conversation_id, updated)
+        except Exception:
+            logger.exception("Failed to summarize conversation %s", conversation_id)
+            return None
+        logger.info("Summarized %d messages of conversation %s.", end, conversation_id)
+        return updated
+
+
+_chat_memory_store: Optional[ChatMemoryStore] = None
+
+
+def get_chat_memory_store() -> ChatMemoryStore:
+    global _chat_memory_store
+    if _chat_memory_store is None:
+        _chat_memory_store = ChatMemoryStore(get_s3_fs())
+    return _chat_memory_store
@@ -54,6 +54,79 @@ class Settings(BaseSettings):
     #
     PROJECT_NAME: str = "fastapi supabase template"
 
+    # rag ingestion
+    DOCUMENT_FETCH_CONCURRENCY: int = 16
+    DOCUMENT_FETCH_TIMEOUT: float = 60.0  # seconds, per document
+    DOCUMENT_FETCH_RETRIES: int = 3
+    # documents larger than this are spooled to disk instead of parsed in memory
+    DOCUMENT_SPOOL_MAX_BYTES: int = 32 * 1024 * 1024
+    BLOB_CACHE_DIR: str = ".cache/documents"
+    BLOB_CACHE_MAX_BYTES: int = 2 * 1024 * 1024 * 1024
+    PARSE_WORKERS: int = 0  # 0 means one per cpu
+    PARSE_PAGES_PER_TASK: int = 16
+    # estimated jaccard similarity above which chunks are collapsed, 1 disables
+    CHUNK_DEDUP_THRESHOLD: float = 0.85
+    EMBEDDING_CACHE_PATH: str = ".cache/embeddings.sqlite3"
+    EMBEDDING_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024
+    # how long cache hits wait before their access times are written
+    EMBEDDING_CACHE_TOUCH_INTERVAL: float = 30.0
+    QUERY_EMBEDDING_CACHE_SIZE: int = 10_000
+    QUERY_EMBEDDING_CACHE_TTL: float = 24 * 60 * 60
+    EMBEDDING_MAX_CONCURRENCY: int = 4
+    EMBEDDING_TOKENS_PER_SECOND: float = 20_000
+    EMBEDDING_MAX_BATCH_TOKENS: int = 96 * 512
+    INGESTION_QUEUE_PATH: str = ".cache/ingestion.sqlite3"
+    INGESTION_WORKERS: int = 2
+
+    # rag serving
+    INDEX_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    # how often a cached storage context re-reads its manifest for changes
+    # persisted by other processes
+    STORAGE_REVALIDATE_SECONDS: float = 2.0
+    S3_MAX_POOL_CONNECTIONS: int = 64
+    BEDROCK_MAX_POOL_CONNECTIONS: int = 64
+    # documents queried this many times are served from memory, 0 bytes disables
+    ANN_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    ANN_HOT_QUERIES: int = 3
+    # query counts are kept for this many cold documents, and documents whose
+    # vectors couldn't be loaded are retried after this many seconds
+    ANN_TRACKED_DOCUMENTS: int = 10_000
+    ANN_UNAVAILABLE_TTL: float = 3600.0
+    # conversations over at most this many chunks are searched exactly in memory
+    EXACT_SEARCH_MAX_CHUNKS: int = 50_000
+    DOCUMENT_MATRIX_CACHE_SIZE: int = 64
+    # local copies of chunk vectors are kept as "int8" or "binary" codes and
+    # rescored against spilled full precision vectors, or "none" for float32
+    VECTOR_QUANTIZATION: str = "int8"
+    VECTOR_RESCORE_FACTOR: int = 4
+    VECTOR_SPILL_DIR: str = ".cache/vectors"
+    # hybrid retrieval fuses this many keyword and vector candidates per query
+    HYBRID_CANDIDATE_TOP_K: int = 10
+    HYBRID_RRF_K: int = 60
+    BM25_CACHE_SIZE: int = 256
+    # the time window a question names is widened by this many days each side
+    # before documents are dropped, "today" is in utc and users aren't
+    PREFILTER_SLACK_DAYS: int = 1
+    # event dates of at most this many documents are kept for the prefilter
+    METADATA_INDEX_MAX_DOCUMENTS: int = 100_000
+    # answers to the opening question of a conversation are reused for questions
+    # about the same document versions whose embeddings are at least this similar
+    ANSWER_CACHE_SIMILARITY: float = 0.95
+    ANSWER_CACHE_TTL: float = 6 * 60 * 60
+    ANSWER_CACHE_SIZE: int = 10_000
+    # built chat engines are kept per conversation until idle this long
+    CHAT_ENGINE_CACHE_SIZE: int = 256
+    CHAT_ENGINE_CACHE_TTL: float = 30 * 60
+    # sub questions run this many at a time, each for at most the timeout, and
+    # the answer is synthesized from whatever finished by the deadline
+    SUB_QUESTION_CONCURRENCY: int = 4
+    SUB_QUESTION_TIMEOUT: float = 20.0
+    SUB_QUESTION_DEADLINE: float = 30.0
+    # chat history beyond this many tokens is folded into a rolling summary
+    CHAT_HISTORY_TOKEN_BUDGET: int = 4000
+    CHAT_SUMMARY_MAX_WORDS: int = 300
+    CHAT_MEMORY_CACHE_SIZE: int = 1024
+
     # class Config(ConfigDict):
     #     """sensitive to lowercase"""
     #
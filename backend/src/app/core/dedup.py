@@ -0,0 +1,155 @@
+"""
+near-duplicate chunk detection
+
+event documents from different providers repeat a lot of boilerplate (venue
+blurbs, terms and conditions, sponsors). chunks are compared with minhash
+signatures over word shingles, bucketed with lsh so only likely matches are
+compared, and every group of near-duplicates is collapsed to one node that keeps
+a back-reference to each source it was seen in.
+
+only chunks of the same document are collapsed. retrieval filters by document
+id, so a chunk standing in for another document's copy would never be found
+when only that other document is selected.
+"""
+
+import hashlib
+import logging
+import re
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+
+from app.chat.constants import DB_DOC_ID_KEY
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# metadata key holding [{document_id, page_label}, ...] on collapsed nodes
+DUPLICATE_SOURCES_KEY = "duplicate_sources"
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_WORD_RE = re.compile(r"\w+")
+
+
+class MinHashDeduplicator:
+    def __init__(
+        self,
+        threshold: float = settings.CHUNK_DEDUP_THRESHOLD,
+        num_perm: int = 128,
+        bands: int = 16,
+        shingle_size: int = 5,
+        seed: int = 1,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 2**31 - 1, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, 2**31 - 1, size=num_perm).astype(np.uint64)
+
+    def _shingles(self, text: str) -> set:
+        words = _WORD_RE.findall(text.lower())
+        k = self.shingle_size
+        return {" ".join(words[i : i + k]) for i in range(max(1, len(words) - k + 1))}
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.array(
+            [
+                int.from_bytes(
+                    hashlib.blake2b(shingle.encode(), digest_size=4).digest(), "little"
+                )
+                for shingle in self._shingles(text)
+            ],
+            dtype=np.uint64,
+        )
+        # one universal hash per permutation, min over the shingles
+        permuted = (np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME
+        return permuted.min(axis=0)
+
+    def groups(self, texts: Sequence[str]) -> List[List[int]]:
+        """
+        Group the indices of near-duplicate texts. Every index appears in
+        exactly one group, groups are ordered by their first index.
+        """
+        parent = list(range(len(texts)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        signatures = [self.signature(text) if text.strip() else None for text in texts]
+        buckets: Dict[bytes, List[int]] = {}
+        for i, signature in enumerate(signatures):
+            if signature is None:
+                continue
+            for band in range(self.bands):
+                key = (
+                    band.to_bytes(2, "little")
+                    + signature[band * self.rows : (band + 1) * self.rows].tobytes()
+                )
+                buckets.setdefault(key, []).append(i)
+
+        for candidates in buckets.values():
+            first = candidates[0]
+            for other in candidates[1:]:
+                if find(first) == find(other):
+                    continue
+                similarity = np.mean(signatures[first] == signatures[other])
+                if similarity >= self.threshold:
+                    parent[max(find(first), find(other))] = min(
+                        find(first), find(other)
+                    )
+
+        grouped: Dict[int, List[int]] = {}
+        for i in range(len(texts)):
+            grouped.setdefault(find(i), []).append(i)
+        return sorted(grouped.values())
+
+
+def deduplicate_nodes(
+    nodes: Sequence[BaseNode], threshold: float = settings.CHUNK_DEDUP_THRESHOLD
+) -> List[BaseNode]:
+    """
+    Collapse near-duplicate nodes of the same document, keeping the first node
+    of each group. Kept nodes that stand in for others list every source in
+    DUPLICATE_SOURCES_KEY, which is left out of the embedded and llm text.
+    """
+    if not nodes or threshold >= 1:
+        return list(nodes)
+    by_document: Dict[Optional[str], List[int]] = {}
+    for i, node in enumerate(nodes):
+        by_document.setdefault(node.metadata.get(DB_DOC_ID_KEY), []).append(i)
+    deduplicator = MinHashDeduplicator(threshold)
+    groups = sorted(
+        [members[j] for j in group]
+        for members in by_document.values()
+        for group in deduplicator.groups([nodes[i].get_content() for i in members])
+    )
+    kept = []
+    duplicate_groups = [group for group in groups if len(group) > 1]
+    for group in groups:
+        node = nodes[group[0]]
+        if len(group) > 1:
+            node.metadata[DUPLICATE_SOURCES_KEY] = [
+                {
+                    "document_id": nodes[i].metadata.get(DB_DOC_ID_KEY),
+                    "page_label": nodes[i].metadata.get("page_label"),
+                }
+                for i in group
+            ]
+            node.excluded_embed_metadata_keys.append(DUPLICATE_SOURCES_KEY)
+            node.excluded_llm_metadata_keys.append(DUPLICATE_SOURCES_KEY)
+        kept.append(node)
+    if duplicate_groups:
+        logger.info(
+            "Collapsed %d near-duplicate chunks into %d",
+            sum(len(group) for group in duplicate_groups),
+            len(duplicate_groups),
+        )
+    return kept
@@ -0,0 +1,377 @@
+"""
+persistent, content addressed embedding cache
+
+chunk embeddings are stored in a local sqlite database keyed by the embedding
+model name plus a hash of the chunk text, so re-embedding identical text on a
+rebuild is a local lookup instead of a bedrock call. the database is bounded by
+a byte budget and evicts the least recently used entries. triggers keep a
+running total of the stored bytes, so checking the budget doesn't scan the
+table, and hits only record their access time every few seconds, in a batch,
+instead of writing on every read.
+
+query embeddings are short lived and repeat across requests (suggested
+questions, sub-questions asked of every document), so they are kept in a
+separate in-memory ttl cache shared by every request instead.
+"""
+
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from cachetools import TTLCache
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def embedding_key(model_name: str, text: str) -> str:
+    return hashlib.sha256(f"{model_name}\0{text}".encode()).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        path: str = settings.EMBEDDING_CACHE_PATH,
+        max_bytes: int = settings.EMBEDDING_CACHE_MAX_BYTES,
+        touch_interval: float = settings.EMBEDDING_CACHE_TOUCH_INTERVAL,
+    ):
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # access times of hits that are not written yet
+        self._touched: Dict[str, float] = {}
+        self._touched_at = time.monotonic()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # wal lets several workers on the same node share the file
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_access "
+            "ON embeddings (last_access)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings_size ("
+            "id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)"
+        )
+        # databases created before the running total are summed up once
+        self._conn.execute(
+            "INSERT INTO embeddings_size SELECT 0, "
+            "(SELECT COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings) "
+            "WHERE NOT EXISTS (SELECT 1 FROM embeddings_size)"
+        )
+        self._conn.executescript(
+            """
+            CREATE TRIGGER IF NOT EXISTS embeddings_size_insert
+            AFTER INSERT ON embeddings BEGIN
+                UPDATE embeddings_size SET bytes = bytes + LENGTH(NEW.embedding);
+            END;
+            CREATE TRIGGER IF NOT EXISTS embeddings_size_update
+            AFTER UPDATE OF embedding ON embeddings BEGIN
+                UPDATE embeddings_size
+                SET bytes = bytes + LENGTH(NEW.embedding) - LENGTH(OLD.embedding);
+            END;
+            CREATE TRIGGER IF NOT EXISTS embeddings_size_delete
+            AFTER DELETE ON embeddings BEGIN
+                UPDATE embeddings_size SET bytes = bytes - LENGTH(OLD.embedding);
+            END;
+            """
+        )
+        self._conn.commit()
+
+    def get_many(
+        self, model_name: str, texts: Sequence[str]
+    ) -> List[Optional[Embedding]]:
+        keys = [embedding_key(model_name, text) for text in texts]
+        found: Dict[str, Embedding] = {}
+        with self._lock:
+            # stay well below sqlite's bound parameter limit
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    "SELECT key, embedding FROM embeddings "
+                    f"WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                found.update((key, array("f", blob).tolist()) for key, blob in rows)
+            if found:
+                now = time.time()
+                self._touched.update((key, now) for key in found)
+                if time.monotonic() - self._touched_at >= self.touch_interval:
+                    self._write_touched()
+                    self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return [found.get(key) for key in keys]
+
+    def put_many(
+        self, model_name: str, texts: Sequence[str], embeddings: Sequence[Embedding]
+    ) -> None:
+        now = time.time()
+        rows = [
+            (embedding_key(model_name, text), array("f", embedding).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self._lock:
+            # an upsert rather than a replace, so the size triggers see it
+            self._conn.executemany(
+                "INSERT INTO embeddings VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE "
+                "SET embedding = excluded.embedding, last_access = excluded.last_access",
+                rows,
+            )
+            # eviction goes by access time, so it has to be up to date
+            self._write_touched()
+            self._evict()
+            self._conn.commit()
+
+    def _write_touched(self) -> None:
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(last_access, key) for key, last_access in self._touched.items()],
+            )
+            self._touched.clear()
+        self._touched_at = time.monotonic()
+
+    def size(self) -> int:
+        """bytes of embeddings stored"""
+        with self._lock:
+            (size,) = self._conn.execute("SELECT bytes FROM embeddings_size").fetchone()
+        return size
+
+    def _evict(self) -> None:
+        (size,) = self._conn.execute("SELECT bytes FROM embeddings_size").fetchone()
+        if size <= self.max_bytes:
+            return
+        # drop the oldest entries until we are back under the budget
+        excess = size - self.max_bytes
+        rows = self._conn.execute(
+            "SELECT key, LENGTH(embedding) FROM embeddings ORDER BY last_access"
+        )
+        evicted = []
+        for key, length in rows:
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= length
+        self._conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+        logger.info("Evicted %d embeddings from the cache.", len(evicted))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            (entries,) = self._conn.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._write_touched()
+            self._conn.commit()
+            self._conn.close()
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache()
+    return _embedding_cache
+
+
+def normalize_query(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded in-memory cache of query embeddings keyed by model name and the
+    normalized query text. Concurrent misses for the same query share a single
+    call to the model.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = settings.QUERY_EMBEDDING_CACHE_SIZE,
+        ttl: float = settings.QUERY_EMBEDDING_CACHE_TTL,
+    ):
+        self.hits = 0
+        self.misses = 0
+        self._entries: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name: str, query: str) -> Optional[Embedding]:
+        key = embedding_key(model_name, normalize_query(query))
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return embedding
+
+    def put(self, model_name: str, query: str, embedding: Embedding) -> None:
+        key = embedding_key(model_name, normalize_query(query))
+        with self._lock:
+            self._entries[key] = embedding
+
+    def get_or_embed(
+        self, model_name: str, query: str, embed: Callable[[str], Embedding]
+    ) -> Embedding:
+        embedding = self.get(model_name, query)
+        if embedding is None:
+            embedding = embed(query)
+            self.put(model_name, query, embedding)
+        return embedding
+
+    async def aget_or_embed(
+        self,
+        model_name: str,
+        query: str,
+        embed: Callable[[str], Awaitable[Embedding]],
+    ) -> Embedding:
+        embedding = self.get(model_name, query)
+        if embedding is not None:
+            return embedding
+        key = embedding_key(model_name, normalize_query(query))
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            embedding = await embed(query)
+        except BaseException as e:
+            future.set_exception(e)
+            # retrieve it so an unawaited future doesn't log the error again
+            future.exception()
+            raise
+        else:
+            self.put(model_name, query, embedding)
+            future.set_result(embedding)
+            return embedding
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = len(self._entries)
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+_query_embedding_cache: Optional[QueryEmbeddingCache] = None
+
+
+def get_query_embedding_cache() -> QueryEmbeddingCache:
+    global _query_embedding_cache
+    if _query_embedding_cache is None:
+        _query_embedding_cache = QueryEmbeddingCache()
+    return _query_embedding_cache
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Wraps an embedding model and serves text embeddings from an EmbeddingCache
+    and query embeddings from a QueryEmbeddingCache, only sending the cache
+    misses to the wrapped model.
+    """
+
+    embed_model: BaseEmbedding = Field(description="The wrapped embedding model.")
+    _cache: EmbeddingCache = PrivateAttr()
+    _query_cache: QueryEmbeddingCache = PrivateAttr()
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        cache: Optional[EmbeddingCache] = None,
+        query_cache: Optional[QueryEmbeddingCache] = None,
+        **kwargs: Any,
+    ):
+        super().__init__(
+            embed_model=embed_model,
+            model_name=embed_model.model_name,
+            # the wrapped model does its own batching for the misses
+            embed_batch_size=kwargs.pop("embed_batch_size", 2048),
+            **kwargs,
+        )
+        self._cache = cache or get_embedding_cache()
+        self._query_cache = query_cache or get_query_embedding_cache()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._query_cache.get_or_embed(
+            self.model_name, query, self.embed_model.get_query_embedding
+        )
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return await self._query_cache.aget_or_embed(
+            self.model_name, query, self.embed_model.aget_query_embedding
+        )
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        cached = self._cache.get_many(self.model_name, texts)
+        missing = [text for text, embedding in zip(texts, cached) if embedding is None]
+        if missing:
+            embeddings = self.embed_model.get_text_embedding_batch(missing)
+            self._cache.put_many(self.model_name, missing, embeddings)
+            return self._merge(cached, embeddings)
+        return cached
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        cached = self._cache.get_many(self.model_name, texts)
+        missing = [text for text, embedding in zip(texts, cached) if embedding is None]
+        if missing:
+            embeddings = await self.embed_model.aget_text_embedding_batch(missing)
+            self._cache.put_many(self.model_name, missing, embeddings)
+            return self._merge(cached, embeddings)
+        return cached
+
+    @staticmethod
+    def _merge(
+        cached: List[Optional[Embedding]], embeddings: List[Embedding]
+    ) -> List[Embedding]:
+        new = iter(embeddings)
+        return [
+            embedding if embedding is not None else next(new) for embedding in cached
+        ]
@@ -0,0 +1,250 @@
+"""
+batched, rate aware embedding scheduler
+
+chunks are packed into batches up to the model's per call limits and several
+batches are embedded concurrently, all drawing from one token bucket. when
+bedrock throttles, the bucket rate is halved and the batch is retried with
+backoff, and the rate then creeps back up as calls succeed. there is one
+scheduler per model and process, so every embed model built for a request
+shares its thread pool and its rate limit.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from botocore.exceptions import ClientError
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+THROTTLING_ERROR_CODES = frozenset(
+    {
+        "ThrottlingException",
+        "TooManyRequestsException",
+        "ServiceUnavailableException",
+        "ModelNotReadyException",
+    }
+)
+
+
+def estimate_tokens(text: str) -> int:
+    # roughly four characters per token for english text
+    return len(text) // 4 + 1
+
+
+def is_throttling_error(e: Exception) -> bool:
+    return (
+        isinstance(e, ClientError)
+        and e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+    )
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket whose refill rate adapts to throttling, halving on
+    every throttle and recovering by a small step on every success.
+    """
+
+    def __init__(self, rate: float, min_rate: Optional[float] = None):
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 32
+        self.rate = rate
+        self.capacity = rate
+        self._tokens = rate
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    def acquire(self, tokens: float) -> None:
+        # a request larger than the bucket would never fit, cap it at capacity
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self) -> None:
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            logger.warning("Embedding throttled, rate now %.0f tokens/s", self.rate)
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+class EmbeddingScheduler:
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        max_concurrency: int = settings.EMBEDDING_MAX_CONCURRENCY,
+        tokens_per_second: float = settings.EMBEDDING_TOKENS_PER_SECOND,
+        max_batch_tokens: int = settings.EMBEDDING_MAX_BATCH_TOKENS,
+        max_retries: int = 6,
+        backoff: float = 1.0,
+    ):
+        self.embed_model = embed_model
+        self.max_batch_size = embed_model.embed_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(tokens_per_second)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="embedding"
+        )
+        self._stats_lock = threading.Lock()
+        self.chunks = 0
+        self.tokens = 0
+        self.seconds = 0.0
+
+    def pack(self, texts: List[str]) -> List[List[str]]:
+        """split texts into batches within the model's size and token limits"""
+        batches: List[List[str]] = []
+        batch: List[str] = []
+        batch_tokens = 0
+        for text in texts:
+            tokens = estimate_tokens(text)
+            if batch and (
+                len(batch) == self.max_batch_size
+                or batch_tokens + tokens > self.max_batch_tokens
+            ):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _embed_batch(self, batch: List[str]) -> List[Embedding]:
+        tokens = sum(estimate_tokens(text) for text in batch)
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire(tokens)
+            try:
+                embeddings = self.embed_model.get_text_embedding_batch(batch)
+            except Exception as e:
+                if not is_throttling_error(e) or attempt == self.max_retries:
+                    raise
+                self.bucket.throttled()
+                # full jitter so concurrent batches don't retry in lockstep
+                time.sleep(random.uniform(0, self.backoff * 2**attempt))
+            else:
+                self.bucket.succeeded()
+                return embeddings
+        raise AssertionError("unreachable")
+
+    def embed(self, texts: List[str]) -> List[Embedding]:
+        if not texts:
+            return []
+        start = time.perf_counter()
+        results = self._executor.map(self._embed_batch, self.pack(texts))
+        embeddings = [embedding for batch in results for embedding in batch]
+        elapsed = time.perf_counter() - start
+        tokens = sum(estimate_tokens(text) for text in texts)
+        with self._stats_lock:
+            self.chunks += len(texts)
+            self.tokens += tokens
+            self.seconds += elapsed
+        logger.info(
+            "Embedded %d chunks in %.2fs (%.1f chunks/s, %.0f tokens/s)",
+            len(texts),
+            elapsed,
+            len(texts) / elapsed,
+            tokens / elapsed,
+        )
+        return embeddings
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            seconds = self.seconds or float("inf")
+            return {
+                "chunks": self.chunks,
+                "tokens": self.tokens,
+                "chunks_per_second": self.chunks / seconds,
+                "tokens_per_second": self.tokens / seconds,
+                "rate_limit": self.bucket.rate,
+            }
+
+
+# model name -> the process-wide scheduler for it
+_schedulers: Dict[str, EmbeddingScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_embedding_scheduler(embed_model: BaseEmbedding) -> EmbeddingScheduler:
+    with _schedulers_lock:
+        scheduler = _schedulers.get(embed_model.model_name)
+        if scheduler is None:
+            scheduler = EmbeddingScheduler(embed_model)
+            _schedulers[embed_model.model_name] = scheduler
+        return scheduler
+
+
+class ScheduledEmbedding(BaseEmbedding):
+    """
+    Sends text embeddings for the wrapped model through an EmbeddingScheduler.
+    Query embeddings are single calls on the critical path and go straight
+    through.
+    """
+
+    embed_model: BaseEmbedding = Field(description="The wrapped embedding model.")
+    _scheduler: EmbeddingScheduler = PrivateAttr()
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        scheduler: Optional[EmbeddingScheduler] = None,
+        **kwargs: Any,
+    ):
+        super().__init__(
+            embed_model=embed_model,
+            model_name=embed_model.model_name,
+            # the scheduler does the batching
+            embed_batch_size=kwargs.pop("embed_batch_size", 2048),
+            **kwargs,
+        )
+        self._scheduler = scheduler or get_embedding_scheduler(embed_model)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ScheduledEmbedding"
+
+    @property
+    def scheduler(self) -> EmbeddingScheduler:
+        return self._scheduler
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self.embed_model.get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return await self.embed_model.aget_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._scheduler.embed([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._scheduler.embed(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return await asyncio.to_thread(self._scheduler.embed, texts)
@@ -9,6 +9,10 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 
 from app.api.deps import init_super_client
+from app.core.bedrock import init_bedrock_clients
+from app.core.fetcher import close_document_fetcher
+from app.core.parsing import shutdown_parse_executor
+from app.core.s3 import init_s3_fs
 
 
 @asynccontextmanager
@@ -16,6 +20,10 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     """life span events"""
     try:
         await init_super_client()
+        await init_s3_fs()
+        await init_bedrock_clients()
         yield
     finally:
+        await close_document_fetcher()
+        shutdown_parse_executor()
         logging.info("lifespan shutdown")
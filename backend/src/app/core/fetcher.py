@@ -0,0 +1,149 @@
+"""
+async document fetcher for the rag ingestion paths
+
+documents are downloaded concurrently over one pooled http client, with a cap on
+in-flight downloads, a timeout per document and retries on transient failures.
+bodies are kept in memory and only spill to a temp file past `spool_max_size`.
+passing the etag from a previous fetch turns the request into a conditional get,
+which comes back empty when the document has not changed.
+"""
+
+import asyncio
+import hashlib
+import logging
+from collections.abc import Mapping
+from dataclasses import dataclass
+from tempfile import SpooledTemporaryFile
+from typing import IO
+
+import httpx
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class DocumentFetchError(Exception):
+    """raised when a document could not be downloaded after all retries"""
+
+
+@dataclass
+class FetchedDocument:
+    content: IO[bytes]
+    etag: str | None
+    # sha256 of the body, computed while streaming
+    content_hash: str
+
+
+class DocumentFetcher:
+    def __init__(
+        self,
+        max_concurrency: int = settings.DOCUMENT_FETCH_CONCURRENCY,
+        timeout: float = settings.DOCUMENT_FETCH_TIMEOUT,
+        max_retries: int = settings.DOCUMENT_FETCH_RETRIES,
+        backoff: float = 0.5,
+        spool_max_size: int = settings.DOCUMENT_SPOOL_MAX_BYTES,
+        client: httpx.AsyncClient | None = None,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.spool_max_size = spool_max_size
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = client or httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_concurrency,
+            ),
+            follow_redirects=True,
+        )
+
+    async def _download(
+        self, url: str, etag: str | None = None
+    ) -> FetchedDocument | None:
+        headers = {"If-None-Match": etag} if etag else None
+        buffer = SpooledTemporaryFile(max_size=self.spool_max_size)
+        sha256 = hashlib.sha256()
+        try:
+            async with self._client.stream("GET", url, headers=headers) as r:
+                if r.status_code == httpx.codes.NOT_MODIFIED:
+                    buffer.close()
+                    return None
+                r.raise_for_status()
+                async for chunk in r.aiter_bytes():
+                    buffer.write(chunk)
+                    sha256.update(chunk)
+        except BaseException:
+            buffer.close()
+            raise
+        buffer.seek(0)
+        return FetchedDocument(
+            content=buffer, etag=r.headers.get("ETag"), content_hash=sha256.hexdigest()
+        )
+
+    async def fetch(self, url: str, etag: str | None = None) -> FetchedDocument | None:
+        """
+        download a single url, retrying transient failures with backoff.
+        returns None when `etag` is given and the document has not changed.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                # only the download holds a slot, not the backoff before a retry
+                async with self._semaphore:
+                    return await asyncio.wait_for(
+                        self._download(url, etag), self.timeout
+                    )
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in RETRYABLE_STATUS_CODES:
+                    raise DocumentFetchError(str(e)) from e
+                error: Exception = e
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                error = e
+            if attempt < self.max_retries:
+                delay = self.backoff * 2**attempt
+                logger.warning(
+                    "fetch failed (%r), retrying in %.1fs (%d/%d)",
+                    error,
+                    delay,
+                    attempt + 1,
+                    self.max_retries,
+                )
+                await asyncio.sleep(delay)
+        raise DocumentFetchError(
+            f"giving up after {self.max_retries + 1} attempts: {error!r}"
+        ) from error
+
+    async def fetch_many(
+        self, urls: Mapping[str, str], etags: Mapping[str, str] | None = None
+    ) -> dict[str, FetchedDocument | None]:
+        """download every url concurrently, keyed the same way as `urls`"""
+        etags = etags or {}
+        keys = list(urls)
+        fetched = await asyncio.gather(
+            *(self.fetch(urls[key], etags.get(key)) for key in keys)
+        )
+        return dict(zip(keys, fetched))
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+_fetcher: DocumentFetcher | None = None
+
+
+def get_document_fetcher() -> DocumentFetcher:
+    """process wide fetcher so every ingestion shares the same connection pool"""
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = DocumentFetcher()
+    return _fetcher
+
+
+async def close_document_fetcher() -> None:
+    global _fetcher
+    if _fetcher is not None:
+        await _fetcher.aclose()
+        _fetcher = None
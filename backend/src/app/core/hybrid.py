@@ -0,0 +1,242 @@
+"""
+keyword retrieval fused with vector retrieval
+
+embedding similarity is weak on exact event names, venues and dates, so each
+document also gets a small bm25 inverted index over its chunks. it is built at
+ingestion, persisted next to the document's nodes in the sharded docstore and
+dropped with them when the document is re-ingested. at query time the keyword
+and vector rankings are merged with reciprocal rank fusion. the fused order is
+what's returned, but nodes keep their vector similarity as their score, the
+fused score is put in their metadata.
+"""
+
+import logging
+import math
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from cachetools import LRUCache
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import BaseNode, MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.storage.docstore.types import BaseDocumentStore
+
+from app.core.config import settings
+from app.core.sharded_store import ShardedDocumentStore
+
+logger = logging.getLogger(__name__)
+
+BM25_COLLECTION = "bm25"
+# metadata key holding the reciprocal rank fusion score of retrieved nodes
+RRF_SCORE_KEY = "rrf_score"
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a set of chunks. Chunks can be added and removed one at a
+    time, the corpus statistics are kept up to date as they are.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> {node id -> term frequency}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        # node id -> its distinct terms, so removing a node skips the vocabulary
+        self.terms: Dict[str, List[str]] = {}
+        self.lengths: Dict[str, int] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def add(self, node_id: str, text: str) -> None:
+        self.remove(node_id)
+        terms = Counter(tokenize(text))
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[node_id] = tf
+        self.terms[node_id] = list(terms)
+        length = sum(terms.values())
+        self.lengths[node_id] = length
+        self.total_length += length
+
+    def add_nodes(self, nodes: Iterable[BaseNode]) -> None:
+        for node in nodes:
+            self.add(node.node_id, node.get_content(metadata_mode=MetadataMode.EMBED))
+
+    def remove(self, node_id: str) -> None:
+        length = self.lengths.pop(node_id, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for term in self.terms.pop(node_id, []):
+            del self.postings[term][node_id]
+            if not self.postings[term]:
+                del self.postings[term]
+
+    def search(self, query: str, top_k: int) -> List[Tuple[str, float]]:
+        if not self.lengths:
+            return []
+        n = len(self.lengths)
+        avg_length = self.total_length / n or 1
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for node_id, tf in posting.items():
+                norm = self.k1 * (
+                    1 - self.b + self.b * self.lengths[node_id] / avg_length
+                )
+                scores[node_id] = scores.get(node_id, 0.0) + idf * tf * (
+                    self.k1 + 1
+                ) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+    def to_dict(self) -> dict:
+        return {
+            "k1": self.k1,
+            "b": self.b,
+            "postings": self.postings,
+            "lengths": self.lengths,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BM25Index":
+        index = cls(k1=data["k1"], b=data["b"])
+        index.postings = data["postings"]
+        index.lengths = data["lengths"]
+        index.total_length = sum(index.lengths.values())
+        for term, posting in index.postings.items():
+            for node_id in posting:
+                index.terms.setdefault(node_id, []).append(term)
+        return index
+
+
+def save_bm25_index(
+    docstore: ShardedDocumentStore, doc_id: str, nodes: Sequence[BaseNode]
+) -> BM25Index:
+    """build the document's keyword index and store it in its docstore shard"""
+    index = BM25Index()
+    index.add_nodes(nodes)
+    docstore.kvstore.put(doc_id, index.to_dict(), collection=BM25_COLLECTION)
+    return index
+
+
+def delete_bm25_index(docstore: ShardedDocumentStore, doc_id: str) -> None:
+    docstore.kvstore.delete(doc_id, collection=BM25_COLLECTION)
+
+
+# (doc_id, storage version) -> BM25Index
+_bm25_indices: LRUCache = LRUCache(maxsize=settings.BM25_CACHE_SIZE)
+_bm25_lock = threading.Lock()
+
+
+def get_bm25_index(
+    docstore: ShardedDocumentStore, doc_id: str, version: int
+) -> Optional[BM25Index]:
+    """the document's keyword index, or None if it was ingested without one"""
+    with _bm25_lock:
+        index = _bm25_indices.get((doc_id, version))
+    if index is None:
+        data = docstore.kvstore.get(doc_id, collection=BM25_COLLECTION)
+        if data is None:
+            return None
+        index = BM25Index.from_dict(data)
+        with _bm25_lock:
+            _bm25_indices[(doc_id, version)] = index
+    return index
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[str]], k: int = 60
+) -> List[Tuple[str, float]]:
+    """merge rankings of ids, each id scores 1 / (k + rank) in every ranking"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, node_id in enumerate(ranking, start=1):
+            scores[node_id] = scores.get(node_id, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def _with_rrf_score(node: BaseNode, score: float) -> BaseNode:
+    # a copy, the nodes may be shared through the in-memory vector tiers
+    node = node.copy()
+    node.metadata = {**node.metadata, RRF_SCORE_KEY: score}
+    node.excluded_embed_metadata_keys = [
+        *node.excluded_embed_metadata_keys,
+        RRF_SCORE_KEY,
+    ]
+    node.excluded_llm_metadata_keys = [*node.excluded_llm_metadata_keys, RRF_SCORE_KEY]
+    return node
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses the candidates of `vector_retriever` with the top `candidate_top_k`
+    keyword matches of `bm25` and returns the best `similarity_top_k` by
+    reciprocal rank fusion. Keyword-only matches are read from `docstore` and
+    have no score, as they have no vector similarity.
+    """
+
+    def __init__(
+        self,
+        vector_retriever: BaseRetriever,
+        bm25: BM25Index,
+        docstore: BaseDocumentStore,
+        similarity_top_k: int = 3,
+        candidate_top_k: int = settings.HYBRID_CANDIDATE_TOP_K,
+        rrf_k: int = settings.HYBRID_RRF_K,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(**kwargs)
+        self._vector_retriever = vector_retriever
+        self._bm25 = bm25
+        self._docstore = docstore
+        self._similarity_top_k = similarity_top_k
+        self._candidate_top_k = candidate_top_k
+        self._rrf_k = rrf_k
+
+    def _fuse(
+        self, query_bundle: QueryBundle, vector_nodes: List[NodeWithScore]
+    ) -> List[NodeWithScore]:
+        keyword_ids = [
+            node_id
+            for node_id, _ in self._bm25.search(
+                query_bundle.query_str, self._candidate_top_k
+            )
+        ]
+        by_id = {n.node.node_id: n.node for n in vector_nodes}
+        similarities = {n.node.node_id: n.score for n in vector_nodes}
+        fused = reciprocal_rank_fusion(
+            [[n.node.node_id for n in vector_nodes], keyword_ids], k=self._rrf_k
+        )[: self._similarity_top_k]
+        missing = [node_id for node_id, _ in fused if node_id not in by_id]
+        if missing:
+            for node in self._docstore.get_nodes(missing, raise_error=False):
+                if node is not None:
+                    by_id[node.node_id] = node
+        return [
+            NodeWithScore(
+                node=_with_rrf_score(by_id[node_id], score),
+                score=similarities.get(node_id),
+            )
+            for node_id, score in fused
+            if node_id in by_id
+        ]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self._fuse(query_bundle, self._vector_retriever.retrieve(query_bundle))
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self._fuse(
+            query_bundle, await self._vector_retriever.aretrieve(query_bundle)
+        )
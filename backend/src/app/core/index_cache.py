@@ -0,0 +1,87 @@
+"""
+in-process cache of loaded per-document indices
+
+loading a VectorStoreIndex means reading its index struct out of the storage
+context, which every chat message used to do for every document in the
+conversation. loaded indices are kept here keyed by document id and the storage
+version they were loaded at, so a re-ingested document is reloaded while
+unchanged ones are reused. the cache is bounded by an estimate of the memory
+the index structs take, evicting the least recently used.
+"""
+
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from llama_index.core import VectorStoreIndex
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_index_size(index: VectorStoreIndex) -> int:
+    # the index struct is what a loaded index holds on to, its serialized size
+    # is a fair proxy for its footprint
+    return len(json.dumps(index.index_struct.to_dict()))
+
+
+class IndexCache:
+    def __init__(self, max_bytes: int = settings.INDEX_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[int, VectorStoreIndex, int]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get(self, doc_id: str, version: int) -> Optional[VectorStoreIndex]:
+        with self._lock:
+            entry = self._entries.get(doc_id)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(doc_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, doc_id: str, version: int, index: VectorStoreIndex) -> None:
+        size = estimate_index_size(index)
+        with self._lock:
+            previous = self._entries.pop(doc_id, None)
+            if previous is not None:
+                self.size -= previous[2]
+            if size > self.max_bytes:
+                return
+            self._entries[doc_id] = (version, index, size)
+            self.size += size
+            evicted = 0
+            while self.size > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                evicted += 1
+        if evicted:
+            logger.info("Evicted %d indices from the index cache.", evicted)
+
+    def invalidate(self, doc_id: str) -> None:
+        with self._lock:
+            entry = self._entries.pop(doc_id, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_index_cache: Optional[IndexCache] = None
+
+
+def get_index_cache() -> IndexCache:
+    global _index_cache
+    if _index_cache is None:
+        _index_cache = IndexCache()
+    return _index_cache
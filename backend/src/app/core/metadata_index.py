@@ -0,0 +1,186 @@
+"""
+prefilter on event dates before vector search
+
+questions like "what's on this weekend" used to vector search every chunk of
+every selected document. the event dates of the documents seen in recent
+conversations are indexed here in a sorted array, so the documents that can't
+answer such a question are dropped before any retrieval happens. documents
+without an event date are always kept.
+"""
+
+import bisect
+import calendar
+import logging
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Set, Tuple
+
+from pydantic import TypeAdapter, ValidationError
+
+from app.core.config import settings
+from app.schema import Document as DocumentSchema
+from app.schema import DocumentMetadataKeysEnum
+
+logger = logging.getLogger(__name__)
+
+_OPTIONAL_DATETIME = TypeAdapter(Optional[datetime])
+
+
+def _timestamp(value: datetime) -> float:
+    # naive datetimes are taken to be utc, like the rest of the backend
+    return calendar.timegm(value.utctimetuple())
+
+
+class MetadataIndex:
+    """
+    Event dates of the most recently added `max_documents` documents, the
+    least recently added are dropped and kept by every filter from then on.
+    """
+
+    def __init__(self, max_documents: int = settings.METADATA_INDEX_MAX_DOCUMENTS):
+        self.max_documents = max_documents
+        # sorted (event timestamp, doc id)
+        self._event_dates: List[Tuple[float, str]] = []
+        self._event_date_of: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._event_date_of
+
+    def __len__(self) -> int:
+        return len(self._event_date_of)
+
+    def add(self, doc_id: str, event_date: Optional[datetime]) -> None:
+        """index a document's event date, replacing anything indexed for it"""
+        with self._lock:
+            self._remove(doc_id)
+            if event_date is None:
+                return
+            timestamp = _timestamp(event_date)
+            bisect.insort(self._event_dates, (timestamp, doc_id))
+            self._event_date_of[doc_id] = timestamp
+            while len(self._event_date_of) > self.max_documents:
+                self._remove(next(iter(self._event_date_of)))
+
+    def add_documents(self, documents: Iterable[DocumentSchema]) -> None:
+        for document in documents:
+            raw = (document.metadata_map or {}).get(
+                DocumentMetadataKeysEnum.event_DOCUMENT
+            )
+            if raw is None:
+                continue
+            # only the fields indexed here have to be valid
+            try:
+                event_date = _OPTIONAL_DATETIME.validate_python(raw.get("event_date"))
+            except ValidationError:
+                logger.warning("Invalid event date on document %s", document.id)
+                event_date = None
+            self.add(str(document.id), event_date)
+
+    def remove(self, doc_id: str) -> None:
+        with self._lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id: str) -> None:
+        timestamp = self._event_date_of.pop(doc_id, None)
+        if timestamp is not None:
+            i = bisect.bisect_left(self._event_dates, (timestamp, doc_id))
+            del self._event_dates[i]
+
+    def between(self, start: datetime, end: datetime) -> Set[str]:
+        """documents whose event date falls in [start, end)"""
+        with self._lock:
+            lo = bisect.bisect_left(self._event_dates, (_timestamp(start), ""))
+            hi = bisect.bisect_left(self._event_dates, (_timestamp(end), ""))
+            return {doc_id for _, doc_id in self._event_dates[lo:hi]}
+
+    def prune(
+        self,
+        doc_ids: Iterable[str],
+        time_range: Optional[Tuple[datetime, datetime]] = None,
+    ) -> List[str]:
+        """
+        The documents of `doc_ids` that can match `time_range`, in order.
+        Documents without an event date are kept.
+        """
+        doc_ids = list(doc_ids)
+        keep = set(doc_ids)
+        if time_range is not None:
+            in_range = self.between(*time_range)
+            keep -= {d for d in doc_ids if d in self._event_date_of} - in_range
+        return [doc_id for doc_id in doc_ids if doc_id in keep]
+
+
+_metadata_index: Optional[MetadataIndex] = None
+
+
+def get_metadata_index() -> MetadataIndex:
+    global _metadata_index
+    if _metadata_index is None:
+        _metadata_index = MetadataIndex()
+    return _metadata_index
+
+
+_MONTHS = {name.lower(): i for i, name in enumerate(calendar.month_name) if name} | {
+    name.lower(): i for i, name in enumerate(calendar.month_abbr) if name
+}
+_ISO_DATE_RE = re.compile(r"\b(\d{4})-(\d{2})-(\d{2})\b")
+_MONTH_RE = re.compile(r"\b(?:in|during)\s+(" + "|".join(_MONTHS) + r")\b")
+
+
+def _month_range(year: int, month: int) -> Tuple[datetime, datetime]:
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    return start, end
+
+
+def parse_time_range(
+    question: str, now: Optional[datetime] = None
+) -> Optional[Tuple[datetime, datetime]]:
+    """
+    The [start, end) window a question asks about, for the common ways of
+    saying it ("tonight", "this weekend", "next week", "in June", 2024-06-14),
+    or None if it doesn't name one.
+    """
+    now = now or datetime.utcnow()
+    text = question.lower()
+    today = datetime(now.year, now.month, now.day)
+    day = timedelta(days=1)
+
+    match = _ISO_DATE_RE.search(text)
+    if match is not None:
+        try:
+            start = datetime(*map(int, match.groups()))
+        except ValueError:
+            return None
+        return start, start + day
+    if "today" in text or "tonight" in text:
+        return today, today + day
+    if "tomorrow" in text:
+        return today + day, today + 2 * day
+    if "weekend" in text:
+        # on a sunday "this weekend" is the one that started yesterday
+        saturday = today + timedelta(days=(5 - today.weekday()) % 7)
+        if today.weekday() == 6:
+            saturday = today - day
+        if "next weekend" in text:
+            saturday += 7 * day
+        return max(saturday, today), saturday + 2 * day
+    if "this week" in text:
+        return today, today - timedelta(days=today.weekday()) + 7 * day
+    if "next week" in text:
+        monday = today - timedelta(days=today.weekday()) + 7 * day
+        return monday, monday + 7 * day
+    if "this month" in text:
+        return today, _month_range(today.year, today.month)[1]
+    if "next month" in text:
+        end = _month_range(today.year, today.month)[1]
+        return _month_range(end.year, end.month)
+    match = _MONTH_RE.search(text)
+    if match is not None:
+        month = _MONTHS[match.group(1)]
+        year = today.year if month >= today.month else today.year + 1
+        return _month_range(year, month)
+    return None
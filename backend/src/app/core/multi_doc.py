@@ -0,0 +1,194 @@
+"""
+retrieval across all of a conversation's documents in one vector query
+
+instead of one filtered query per document, the conversation's document ids go
+into a single IN filter and the results are bucketed by document afterwards, so
+a conversation over twenty documents costs one round trip to pgvector. only the
+documents that come back with fewer chunks than asked for get a query of their
+own to top them up.
+"""
+
+import asyncio
+from typing import Any, Dict, List, Optional, Sequence
+
+from cachetools import LRUCache
+from llama_index.core import VectorStoreIndex
+from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import (
+    ExactMatchFilter,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+)
+
+from app.chat.constants import DB_DOC_ID_KEY
+
+
+def documents_filter(doc_ids: Sequence[str]) -> MetadataFilters:
+    return MetadataFilters(
+        filters=[
+            MetadataFilter(
+                key=DB_DOC_ID_KEY,
+                value=[str(doc_id) for doc_id in doc_ids],
+                operator=FilterOperator.IN,
+            )
+        ]
+    )
+
+
+def bucket_by_document(
+    nodes: List[NodeWithScore], per_document_top_k: int
+) -> Dict[str, List[NodeWithScore]]:
+    """the best `per_document_top_k` nodes of each document, best first"""
+    buckets: Dict[str, List[NodeWithScore]] = {}
+    for node in sorted(nodes, key=lambda n: n.score or 0.0, reverse=True):
+        bucket = buckets.setdefault(node.node.metadata.get(DB_DOC_ID_KEY), [])
+        if len(bucket) < per_document_top_k:
+            bucket.append(node)
+    return buckets
+
+
+def _merge(
+    bucket: List[NodeWithScore], more: List[NodeWithScore], top_k: int
+) -> List[NodeWithScore]:
+    seen = {n.node.node_id for n in bucket}
+    merged = bucket + [n for n in more if n.node.node_id not in seen]
+    return sorted(merged, key=lambda n: n.score or 0.0, reverse=True)[:top_k]
+
+
+class MultiDocumentRetriever(VectorIndexRetriever):
+    """
+    Retrieves the top `per_document_top_k` chunks of every document in
+    `doc_ids` with one vector store query, topping up the documents that were
+    crowded out by more relevant ones with a query filtered to each of them.
+    """
+
+    def __init__(
+        self,
+        index: VectorStoreIndex,
+        doc_ids: Sequence[str],
+        per_document_top_k: int = 3,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(
+            index,
+            similarity_top_k=per_document_top_k * max(len(doc_ids), 1),
+            filters=documents_filter(doc_ids),
+            **kwargs,
+        )
+        self._doc_ids_order = [str(doc_id) for doc_id in doc_ids]
+        self._per_document_top_k = per_document_top_k
+
+    def _document_retriever(self, doc_id: str) -> VectorIndexRetriever:
+        return VectorIndexRetriever(
+            self._index,
+            similarity_top_k=self._per_document_top_k,
+            filters=MetadataFilters(
+                filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value=doc_id)]
+            ),
+            callback_manager=self.callback_manager,
+            embed_model=self._embed_model,
+        )
+
+    def _short(self, buckets: Dict[str, List[NodeWithScore]]) -> List[str]:
+        return [
+            doc_id
+            for doc_id in self._doc_ids_order
+            if len(buckets.get(doc_id, [])) < self._per_document_top_k
+        ]
+
+    def get_buckets(self, query_bundle: QueryBundle) -> Dict[str, List[NodeWithScore]]:
+        """every document's top chunks for a query bundle with its embedding"""
+        buckets = bucket_by_document(
+            VectorIndexRetriever._get_nodes_with_embeddings(self, query_bundle),
+            self._per_document_top_k,
+        )
+        for doc_id in self._short(buckets):
+            buckets[doc_id] = _merge(
+                buckets.get(doc_id, []),
+                self._document_retriever(doc_id)._get_nodes_with_embeddings(
+                    query_bundle
+                ),
+                self._per_document_top_k,
+            )
+        return buckets
+
+    async def aget_buckets(
+        self, query_bundle: QueryBundle
+    ) -> Dict[str, List[NodeWithScore]]:
+        buckets = bucket_by_document(
+            await VectorIndexRetriever._aget_nodes_with_embeddings(self, query_bundle),
+            self._per_document_top_k,
+        )
+        short = self._short(buckets)
+        topped_up = await asyncio.gather(
+            *(
+                self._document_retriever(doc_id)._aget_nodes_with_embeddings(
+                    query_bundle
+                )
+                for doc_id in short
+            )
+        )
+        for doc_id, nodes in zip(short, topped_up):
+            buckets[doc_id] = _merge(
+                buckets.get(doc_id, []), nodes, self._per_document_top_k
+            )
+        return buckets
+
+    def _flatten(self, buckets: Dict[str, List[NodeWithScore]]) -> List[NodeWithScore]:
+        return [
+            node for doc_id in self._doc_ids_order for node in buckets.get(doc_id, [])
+        ]
+
+    def retrieve_per_document(
+        self, query_bundle: QueryBundle
+    ) -> Dict[str, List[NodeWithScore]]:
+        return bucket_by_document(self.retrieve(query_bundle), self._per_document_top_k)
+
+    async def aretrieve_per_document(
+        self, query_bundle: QueryBundle
+    ) -> Dict[str, List[NodeWithScore]]:
+        return bucket_by_document(
+            await self.aretrieve(query_bundle), self._per_document_top_k
+        )
+
+    def _get_nodes_with_embeddings(
+        self, query_bundle_with_embeddings: QueryBundle
+    ) -> List[NodeWithScore]:
+        return self._flatten(self.get_buckets(query_bundle_with_embeddings))
+
+    async def _aget_nodes_with_embeddings(
+        self, query_bundle_with_embeddings: QueryBundle
+    ) -> List[NodeWithScore]:
+        return self._flatten(await self.aget_buckets(query_bundle_with_embeddings))
+
+
+class SharedDocumentQuery:
+    """
+    Lets the per-document retrievers of a chat engine share one
+    MultiDocumentRetriever query. Retrievers asking the same question, as the
+    sub questions about every document usually do, wait on the same query and
+    each take their own document's chunks from it.
+    """
+
+    def __init__(self, retriever: MultiDocumentRetriever, maxsize: int = 32):
+        self._retriever = retriever
+        # query -> future of the per-document buckets
+        self._queries: LRUCache = LRUCache(maxsize=maxsize)
+
+    async def aretrieve(
+        self, doc_id: str, query_bundle: QueryBundle, top_k: Optional[int] = None
+    ) -> List[NodeWithScore]:
+        future = self._queries.get(query_bundle.query_str)
+        if future is None:
+            future = asyncio.ensure_future(self._retriever.aget_buckets(query_bundle))
+            self._queries[query_bundle.query_str] = future
+        try:
+            buckets = await asyncio.shield(future)
+        except Exception:
+            # let the next retriever try again rather than share the failure
+            if self._queries.get(query_bundle.query_str) is future:
+                del self._queries[query_bundle.query_str]
+            raise
+        return buckets.get(doc_id, [])[:top_k]
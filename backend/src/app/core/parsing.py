@@ -0,0 +1,168 @@
+"""
+pdf parsing and chunking for the rag ingestion paths
+
+text extraction and sentence splitting are cpu bound, so they run in a process
+pool, with large pdfs split into page ranges that are parsed in parallel.
+downloads still held in memory, under the spool limit, are sent to the workers
+as bytes. larger ones are read from a file instead, documents served from the
+blob cache are read in place and downloads that rolled over to disk are copied
+to a temp file once.
+"""
+
+import asyncio
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO, List, Optional, Tuple, Union
+
+import pypdf
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import BaseNode
+from llama_index.core.schema import Document as LlamaIndexDocument
+
+from app.chat.constants import (
+    DB_DOC_ID_KEY,
+    NODE_PARSER_CHUNK_OVERLAP,
+    NODE_PARSER_CHUNK_SIZE,
+)
+from app.core.config import settings
+
+
+def page_id(document_id: str, page_index: int) -> str:
+    return f"{document_id}_page_{page_index}"
+
+
+def _node_id(i: int, doc: LlamaIndexDocument) -> str:
+    # deterministic ids, so re-parsing a document yields the same node ids
+    return f"{doc.id_}_{i}"
+
+
+def read_pdf(
+    document_id: str, content: IO[bytes], start: int = 0, stop: Optional[int] = None
+) -> List[LlamaIndexDocument]:
+    """
+    Parse pages [start, stop) of a pdf into one llama index document per page.
+
+    The metadata matches what `PDFReader.load_data` produced for the temp file
+    this used to be written to.
+    """
+    pdf = pypdf.PdfReader(content)
+    docs = []
+    for page_index in range(start, len(pdf.pages) if stop is None else stop):
+        metadata = {
+            "page_label": pdf.page_labels[page_index],
+            "file_name": f"{document_id}.pdf",
+            DB_DOC_ID_KEY: document_id,
+        }
+        docs.append(
+            LlamaIndexDocument(
+                id_=page_id(document_id, page_index),
+                text=pdf.pages[page_index].extract_text(),
+                metadata=metadata,
+            )
+        )
+    return docs
+
+
+def chunk_documents(docs: List[LlamaIndexDocument]) -> List[BaseNode]:
+    # Use a smaller chunk size to retrieve more granular results
+    node_parser = SentenceSplitter(
+        chunk_size=NODE_PARSER_CHUNK_SIZE,
+        chunk_overlap=NODE_PARSER_CHUNK_OVERLAP,
+        id_func=_node_id,
+    )
+    return node_parser.get_nodes_from_documents(docs)
+
+
+# the pdf as sent to the workers, its bytes or the path of a file holding it
+Source = Union[bytes, str]
+
+
+def _open(source: Source) -> IO[bytes]:
+    return io.BytesIO(source) if isinstance(source, bytes) else open(source, "rb")
+
+
+def count_pages(source: Source) -> int:
+    """process pool entry point, reading the page tree is cpu bound too"""
+    with _open(source) as f:
+        return len(pypdf.PdfReader(f).pages)
+
+
+def parse_and_chunk_pages(
+    document_id: str, source: Source, start: int, stop: int
+) -> List[BaseNode]:
+    """process pool entry point, the pdf in and nodes out"""
+    with _open(source) as f:
+        return chunk_documents(read_pdf(document_id, f, start, stop))
+
+
+def _spill(content: IO[bytes]) -> Tuple[Source, bool]:
+    """what the workers read the pdf from, and whether it is a temp file"""
+    name = getattr(content, "name", None)
+    if isinstance(name, str) and os.path.isfile(name):
+        return name, False
+    content.seek(0)
+    if isinstance(content, tempfile.SpooledTemporaryFile) and not content._rolled:
+        # under the spool limit, pickling the bytes is cheaper than a file
+        return content.read(), False
+    if isinstance(content, io.BytesIO):
+        return content.getvalue(), False
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        shutil.copyfileobj(content, f)
+    return f.name, True
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_parse_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn rather than fork, the parent has boto and event loop threads running
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.PARSE_WORKERS or os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+def shutdown_parse_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+
+
+async def parse_and_chunk(document_id: str, content: IO[bytes]) -> List[BaseNode]:
+    """
+    Parse and chunk a pdf in the process pool.
+
+    Pdfs longer than PARSE_PAGES_PER_TASK are split into page ranges, so a
+    single large document is spread across all the workers.
+    """
+    source, is_temp = await asyncio.to_thread(_spill, content)
+    try:
+        step = settings.PARSE_PAGES_PER_TASK
+        loop = asyncio.get_running_loop()
+        executor = get_parse_executor()
+        num_pages = await loop.run_in_executor(executor, count_pages, source)
+        chunks = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    executor,
+                    parse_and_chunk_pages,
+                    document_id,
+                    source,
+                    start,
+                    min(start + step, num_pages),
+                )
+                for start in range(0, num_pages, step)
+            )
+        )
+    finally:
+        if is_temp:
+            os.unlink(source)
+    return [node for nodes in chunks for node in nodes]
@@ -0,0 +1,189 @@
+"""
+compact storage for the chunk vectors held by the local retrieval tiers
+
+cohere vectors are 1024 float32s, 4kb per chunk, on every worker. the ann tier
+and the conversation matrices keep them as int8 codes (4x smaller) or 1-bit
+sign codes (32x smaller) instead, score every row by its code, and rescore the
+best few candidates against the full precision vectors. those are spilled to an
+unlinked memory mapped file, so they are only paged in for the rows that get
+rescored and the os can drop them under memory pressure.
+
+`python -m app.core.quantization` prints recall against exact search and the
+resident memory of every mode.
+"""
+
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from app.core.config import settings
+
+NONE = "none"
+INT8 = "int8"
+BINARY = "binary"
+MODES = (NONE, INT8, BINARY)
+
+# set bits in every byte value, for hamming distances over packed codes
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+Rows = Union[slice, np.ndarray]
+
+_BLOCK_ROWS = 1024
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """positions of the `k` highest scores, best first"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=int)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def _spill(vectors: np.ndarray, spill_dir: str) -> np.ndarray:
+    if not vectors.size:
+        return vectors
+    Path(spill_dir).mkdir(parents=True, exist_ok=True)
+    # the mapping outlives the file, which is gone as soon as it is closed
+    with tempfile.NamedTemporaryFile(dir=spill_dir) as f:
+        mapped = np.memmap(f, dtype=np.float32, mode="w+", shape=vectors.shape)
+        mapped[:] = vectors
+        mapped.flush()
+    return mapped
+
+
+class QuantizedVectors:
+    """
+    Unit vectors stored as int8 or binary codes, with the full precision
+    vectors spilled to disk for rescoring. With mode "none" the float32
+    vectors are kept in memory and searched exactly.
+    """
+
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        mode: str = settings.VECTOR_QUANTIZATION,
+        rescore_factor: int = settings.VECTOR_RESCORE_FACTOR,
+        spill_dir: str = settings.VECTOR_SPILL_DIR,
+    ):
+        if mode not in MODES:
+            raise ValueError(f"Unknown quantization mode {mode!r}")
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.mode = mode
+        self.rescore_factor = rescore_factor
+        self.shape = vectors.shape
+        if mode == INT8:
+            # symmetric per-row scale, cosine only needs the direction
+            self.scales = np.abs(vectors).max(axis=1, initial=0) / 127
+            safe = np.where(self.scales == 0, 1, self.scales)
+            self.codes = np.round(vectors / safe[:, None]).astype(np.int8)
+        elif mode == BINARY:
+            self.codes = np.packbits(vectors > 0, axis=1)
+        self.full = vectors if mode == NONE else _spill(vectors, spill_dir)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        """bytes held in memory, the spilled vectors don't count"""
+        if self.mode == NONE:
+            return self.full.nbytes
+        if self.mode == INT8:
+            return self.codes.nbytes + self.scales.nbytes
+        return self.codes.nbytes
+
+    def _approximate(self, q: np.ndarray, rows: Rows) -> np.ndarray:
+        if self.mode == INT8:
+            codes = self.codes[rows]
+            scores = np.empty(len(codes), dtype=np.float32)
+            # widen a block at a time rather than the whole matrix at once
+            for i in range(0, len(codes), _BLOCK_ROWS):
+                block = codes[i : i + _BLOCK_ROWS].astype(np.float32)
+                scores[i : i + _BLOCK_ROWS] = block @ q
+            return scores * self.scales[rows]
+        if self.mode == BINARY:
+            q_bits = np.packbits(q > 0)
+            distance = _POPCOUNT[self.codes[rows] ^ q_bits].sum(axis=1)
+            return -distance.astype(np.float32)
+        return self.full[rows] @ q
+
+    def search(
+        self, q: np.ndarray, k: int, rows: Rows = slice(None)
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Positions within `rows` and cosine scores of the `k` best rows for
+        the unit query `q`, best first.
+        """
+        approximate = self._approximate(q, rows)
+        if self.mode == NONE:
+            top = top_k(approximate, k)
+            return top, approximate[top]
+        candidates = top_k(approximate, k * self.rescore_factor)
+        absolute = (
+            candidates + (rows.start or 0)
+            if isinstance(rows, slice)
+            else rows[candidates]
+        )
+        # read the spilled rows in file order
+        order = np.argsort(absolute)
+        exact = np.empty(len(candidates), dtype=np.float32)
+        exact[order] = self.full[absolute[order]] @ q
+        top = top_k(exact, k)
+        return candidates[top], exact[top]
+
+
+def _clustered(n: int, dim: int, rng: np.random.Generator) -> np.ndarray:
+    # chunk embeddings cluster by topic, uniform noise is a much harder case
+    centres = rng.normal(size=(max(n // 50, 1), dim))
+    vectors = centres[rng.integers(len(centres), size=n)] + rng.normal(
+        scale=0.6, size=(n, dim)
+    )
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def benchmark(
+    n: int = 20_000,
+    dim: int = 1024,
+    queries: int = 200,
+    k: int = 10,
+    seed: int = 0,
+) -> List[Dict[str, float]]:
+    """recall@k against exact float32 search and resident memory per mode"""
+    rng = np.random.default_rng(seed)
+    vectors = _clustered(n, dim, rng).astype(np.float32)
+    qs = vectors[rng.choice(n, queries, replace=False)] + rng.normal(
+        scale=0.05, size=(queries, dim)
+    ).astype(np.float32)
+    qs /= np.linalg.norm(qs, axis=1, keepdims=True)
+    exact = [set(top_k(vectors @ q, k)) for q in qs]
+    results = []
+    for mode in MODES:
+        store = QuantizedVectors(vectors, mode=mode)
+        start = time.perf_counter()
+        found = [set(store.search(q, k)[0]) for q in qs]
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "mode": mode,
+                "recall": float(
+                    np.mean([len(f & e) / k for f, e in zip(found, exact)])
+                ),
+                "resident_mb": store.nbytes / 2**20,
+                "compression": vectors.nbytes / store.nbytes,
+                "ms_per_query": 1000 * elapsed / queries,
+            }
+        )
+    return results
+
+
+if __name__ == "__main__":
+    print(f"{'mode':<8}{'recall@10':>10}{'MB':>10}{'x':>8}{'ms/q':>8}")
+    for row in benchmark():
+        print(
+            f"{row['mode']:<8}{row['recall']:>10.3f}{row['resident_mb']:>10.1f}"
+            f"{row['compression']:>8.1f}{row['ms_per_query']:>8.2f}"
+        )
@@ -1,15 +1,11 @@
+import asyncio
 import logging
 from datetime import datetime, timedelta
-from pathlib import Path
 from tabnanny import verbose
-from tempfile import TemporaryDirectory
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Set
 from xml.dom import IndexSizeErr
 
 import nest_asyncio
-import requests
-import s3fs
-from cachetools import TTLCache, cached
 from dns import node
 from fsspec.asyn import AsyncFileSystem
 from httpx import stream
@@ -33,40 +29,79 @@ from llama_index.core.chat_engine import ContextChatEngine
 from llama_index.core.chat_engine.types import ChatMode
 from llama_index.core.indices.query.base import BaseQueryEngine
 from llama_index.core.llms import ChatMessage, MessageRole
-from llama_index.core.node_parser import SentenceSplitter
-from llama_index.core.query_engine import SubQuestionQueryEngine
+from llama_index.core.query_engine import (
+    RetrieverQueryEngine,
+    SubQuestionQueryEngine,
+)
 from llama_index.core.schema import Document as LlamaIndexDocument
-from llama_index.core.schema import IndexNode
+from llama_index.core.schema import BaseNode, IndexNode, RelatedNodeInfo
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
 from llama_index.core.vector_stores.types import (
     ExactMatchFilter,
     MetadataFilters,
     VectorStore,
 )
-from llama_index.embeddings.bedrock import BedrockEmbedding, Models
 from llama_index.legacy import GPTKnowledgeGraphIndex
-from llama_index.llms.bedrock_converse import BedrockConverse
-from llama_index.readers.file import PDFReader
 from openai import OpenAI, chat
 from PIL.ImageShow import show
 
 from app.chat.constants import (
     DB_DOC_ID_KEY,
-    NODE_PARSER_CHUNK_OVERLAP,
-    NODE_PARSER_CHUNK_SIZE,
     SYSTEM_MESSAGE,
 )
 from app.chat.pg_vector import get_vector_store_singleton
 from app.chat.qa_response_synth import get_custom_response_synth
 from app.chat.tools import get_api_query_engine_tool
 from app.chat.utils import build_title_for_document
+from app.core.ann import (
+    ANNVectorIndexRetriever,
+    DocumentMatrix,
+    get_document_matrix,
+)
+from app.core.answer_cache import document_set_key
+from app.core.bedrock import (
+    BEDROCK_CHAT_LLM_NAME,
+    BEDROCK_TOOL_LLM_NAME,
+    SIMPLE_BEDROCK_CHAT_LLM_NAME,
+    get_embed_model,
+    get_llm,
+    get_node_parser,
+)
+from app.core.blob_cache import get_blob_cache
+from app.core.chat_memory import get_chat_memory_store
+from app.core.chat_engine_cache import (
+    CachedChatEngine,
+    ChatEngineKey,
+    get_chat_engine_cache,
+)
 from app.core.config import settings
+from app.core.dedup import deduplicate_nodes
+from app.core.fetcher import FetchedDocument, get_document_fetcher
+from app.core.hybrid import (
+    HybridRetriever,
+    delete_bm25_index,
+    get_bm25_index,
+    save_bm25_index,
+)
+from app.core.index_cache import get_index_cache
+from app.core.metadata_index import get_metadata_index, parse_time_range
+from app.core.multi_doc import MultiDocumentRetriever, SharedDocumentQuery
+from app.core.parsing import parse_and_chunk
+from app.core.s3 import get_s3_fs
+from app.core.sharded_store import (
+    ShardedDocumentStore,
+    get_sharded_storage_context,
+    shard_for_key,
+)
 from app.core.security.presigned_url import convert_bucket_url_to_presigned_url
+from app.core.sub_questions import BoundedSubQuestionQueryEngine
 from app.models.db import MessageRoleEnum, MessageStatusEnum
 from app.schema import Conversation as ConversationSchema
 from app.schema import Document as DocumentSchema
 from app.schema import DocumentMetadataKeysEnum, eventDocumentMetadata
 from app.schema import Message as MessageSchema
+from app.schemas.ingestion import IngestionJobCreate, IngestionJobInDB
+from app.services.ingestion import get_ingestion_store
 
 logger = logging.getLogger(__name__)
 
@@ -74,41 +109,222 @@ logger = logging.getLogger(__name__)
 logger.info("Applying nested asyncio patch")
 nest_asyncio.apply()
 
-BEDROCK_TOOL_LLM_NAME = "anthropic.claude-3-sonnet-20240229-v1:0"
-BEDROCK_CHAT_LLM_NAME = "anthropic.claude-3-sonnet-20240229-v1:0"
-SIMPLE_BEDROCK_CHAT_LLM_NAME = "anthropic.claude-3-sonnet-20240229-v1:0"
 
+async def fetch_documents(
+    documents: List[DocumentSchema], etags: Optional[Dict[str, str]] = None
+) -> Dict[str, Optional[FetchedDocument]]:
+    """
+    Download every document concurrently, keyed by document id. Documents with
+    an entry in `etags` are only downloaded if they changed, otherwise None.
+
+    Downloads go through the local blob cache, cached documents are revalidated
+    with a conditional get and read from disk when unchanged.
+    """
+    etags = etags or {}
+    blob_cache = get_blob_cache()
+    fetcher = get_document_fetcher()
+    urls = {
+        str(doc.id): convert_bucket_url_to_presigned_url(doc.url) for doc in documents
+    }
+    refs = {doc_id: blob_cache.get(doc_id) for doc_id in urls}
+    request_etags = {
+        doc_id: ref.etag if ref else etags[doc_id]
+        for doc_id, ref in refs.items()
+        if ref or doc_id in etags
+    }
+    fetched = await fetcher.fetch_many(urls, request_etags)
+
+    for doc_id, fetched_doc in fetched.items():
+        ref = refs[doc_id]
+        if fetched_doc is not None:
+            await asyncio.to_thread(blob_cache.put, doc_id, fetched_doc)
+        elif ref is not None and etags.get(doc_id) != ref.etag:
+            # unchanged since we cached it, but the caller has an older version
+            try:
+                fetched[doc_id] = blob_cache.open(ref)
+            except FileNotFoundError:
+                fetched[doc_id] = await fetcher.fetch(urls[doc_id])
+    return fetched
+
+
+async def parse_documents(
+    fetched: Dict[str, FetchedDocument],
+) -> Dict[str, List[BaseNode]]:
+    """Parse and chunk fetched documents in the process pool."""
+
+    async def parse(doc_id: str) -> List[BaseNode]:
+        with fetched[doc_id].content as content:
+            return await parse_and_chunk(doc_id, content)
+
+    nodes = await asyncio.gather(*(parse(doc_id) for doc_id in fetched))
+    return dict(zip(fetched, nodes))
+
+
+async def fetch_and_parse_documents(
+    documents: List[DocumentSchema],
+) -> Dict[str, List[BaseNode]]:
+    return await parse_documents(await fetch_documents(documents))
+
+
+def _hash_key(index_id: str, doc_id: str) -> str:
+    # fingerprints are kept per index, the fullstore and the per-document
+    # indices share a docstore but sync the same documents independently
+    return f"{doc_id}/{index_id}/hash"
+
+
+def _etag_key(index_id: str, doc_id: str) -> str:
+    return f"{doc_id}/{index_id}/etag"
+
+
+def _doc_id_of(node_id: str) -> str:
+    # node ids start with the id of the db document they were parsed from
+    return shard_for_key(node_id)
 
-def get_s3_fs() -> AsyncFileSystem:
-    s3 = s3fs.S3FileSystem(
-        key=settings.AWS_KEY,
-        secret=settings.AWS_SECRET,
-        endpoint_url=settings.S3_ENDPOINT_URL,
+
+def get_indexed_doc_ids(index: VectorStoreIndex) -> Set[str]:
+    """Ids of the db documents this index holds nodes of."""
+    return {_doc_id_of(node_id) for node_id in index.index_struct.nodes_dict}
+
+
+def scope_nodes(nodes: List[BaseNode], index_id: str) -> List[BaseNode]:
+    """
+    Suffix the ids of nodes and their relations with `index_id`. The fullstore
+    shares its docstore and vector store with the per-document indices, which
+    insert the same deterministic ids, so the suffix keeps either from
+    overwriting or deleting the other's nodes.
+    """
+    for node in nodes:
+        node.id_ = f"{node.id_}_{index_id}"
+        for related in node.relationships.values():
+            if isinstance(related, RelatedNodeInfo):
+                related.node_id = f"{related.node_id}_{index_id}"
+    return nodes
+
+
+def delete_document_from_index(index: VectorStoreIndex, doc_id: str) -> None:
+    """
+    Remove every node of a db document that this index inserted, from the
+    index, the vector store and the docstore, along with the index's
+    fingerprints of it.
+    """
+    docstore = index.storage_context.docstore
+    owned = {
+        node_id
+        for node_id in index.index_struct.nodes_dict
+        if _doc_id_of(node_id) == doc_id
+    }
+    if isinstance(docstore, ShardedDocumentStore):
+        ref_doc_infos = docstore.get_document_ref_doc_info(doc_id)
+    else:
+        ref_doc_infos = docstore.get_all_ref_doc_info() or {}
+    for ref_doc_id, ref_doc_info in ref_doc_infos.items():
+        node_ids = set(ref_doc_info.node_ids)
+        # a ref doc with nodes of another index is left to that index
+        if not node_ids or not node_ids <= owned:
+            continue
+        index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+        owned -= node_ids
+    # nodes inserted before they were scoped per index are shared with another
+    # index, this one only forgets them
+    for node_id in owned:
+        index.index_struct.delete(node_id)
+    index.storage_context.index_store.add_index_struct(index.index_struct)
+    docstore.delete_document(_hash_key(index.index_id, doc_id), raise_error=False)
+    docstore.delete_document(_etag_key(index.index_id, doc_id), raise_error=False)
+    if isinstance(docstore, ShardedDocumentStore) and index.index_id == doc_id:
+        # keyword indices are kept for the per-document indices only
+        delete_bm25_index(docstore, doc_id)
+
+
+async def sync_index_documents(
+    index: VectorStoreIndex,
+    documents: List[DocumentSchema],
+    revalidate: bool = False,
+    prune: bool = False,
+) -> Set[str]:
+    """
+    Bring the index in line with `documents`, only embedding what changed.
+
+    Every document is fingerprinted by its content hash in the docstore, per
+    index. New documents are always inserted. With `revalidate`, already indexed documents
+    are re-fetched with a conditional get and re-embedded only if their content
+    hash changed. With `prune`, documents this index holds that are missing from
+    `documents` are removed. Returns the ids of the documents whose stored entries changed.
+    """
+    docstore = index.storage_context.docstore
+    index_id = index.index_id
+    id_to_doc = {str(doc.id): doc for doc in documents}
+    known = {
+        doc_id
+        for doc_id in id_to_doc
+        if docstore.get_document_hash(_hash_key(index_id, doc_id)) is not None
+    }
+    to_fetch = [
+        doc for doc_id, doc in id_to_doc.items() if revalidate or doc_id not in known
+    ]
+    etags = {
+        doc_id: etag
+        for doc_id in known
+        if (etag := docstore.get_document_hash(_etag_key(index_id, doc_id))) is not None
+    }
+    fetched = await fetch_documents(to_fetch, etags)
+
+    changed: Dict[str, FetchedDocument] = {}
+    touched: Set[str] = set()
+    for doc_id, fetched_doc in fetched.items():
+        if fetched_doc is None:
+            continue
+        if fetched_doc.content_hash == docstore.get_document_hash(
+            _hash_key(index_id, doc_id)
+        ):
+            fetched_doc.content.close()
+            if fetched_doc.etag:
+                docstore.set_document_hash(
+                    _etag_key(index_id, doc_id), fetched_doc.etag
+                )
+                touched.add(doc_id)
+            continue
+        changed[doc_id] = fetched_doc
+    logger.info(
+        "Syncing index %s: %d of %d documents new or changed.",
+        index.index_id,
+        len(changed),
+        len(id_to_doc),
     )
-    if not (settings.RENDER or s3.exists(settings.S3_BUCKET_NAME)):
-        s3.mkdir(settings.S3_BUCKET_NAME, location="ap-southeast-1")
-    return s3
 
+    doc_id_to_nodes = await parse_documents(changed)
+    # collapse boilerplate repeated within each changed document before it is
+    # embedded, queries filter by document id so chunks can't be shared
+    doc_id_to_kept: Dict[str, List[BaseNode]] = {
+        doc_id: deduplicate_nodes(doc_id_to_nodes.get(doc_id, [])) for doc_id in changed
+    }
 
-def fetch_and_read_document(
-    document: DocumentSchema,
-) -> List[LlamaIndexDocument]:
-    # Super hacky approach to get this to feature complete on time.
-    # TODO: Come up with better abstractions for this and the other methods in this module.
-    with TemporaryDirectory() as temp_dir:
-        temp_file_path = Path(temp_dir) / f"{str(document.id)}.pdf"
-        with open(temp_file_path, "wb") as temp_file:
-            access_url = convert_bucket_url_to_presigned_url(document.url)
-            with requests.get(access_url, stream=True) as r:
-                r.raise_for_status()
-                for chunk in r.iter_content(chunk_size=8192):
-                    temp_file.write(chunk)
-            temp_file.seek(0)
-            reader = PDFReader()
-            return reader.load_data(
-                temp_file_path, extra_info={DB_DOC_ID_KEY: str(document.id)}
+    # documents only another index ingested are new to this one
+    indexed = get_indexed_doc_ids(index)
+    for doc_id, nodes in doc_id_to_kept.items():
+        if doc_id in indexed:
+            delete_document_from_index(index, doc_id)
+        nodes = scope_nodes(nodes, index_id)
+        docstore.add_documents(nodes)
+        index.insert_nodes(nodes)
+        docstore.set_document_hash(
+            _hash_key(index_id, doc_id), changed[doc_id].content_hash
+        )
+        if changed[doc_id].etag:
+            docstore.set_document_hash(
+                _etag_key(index_id, doc_id), changed[doc_id].etag
             )
 
+    # only what this index inserted is pruned, the per-document indices share
+    # the docstore
+    removed = get_indexed_doc_ids(index) - id_to_doc.keys() if prune else set()
+    if removed and isinstance(docstore, ShardedDocumentStore):
+        await docstore.kvstore.aload(list(removed))
+    for doc_id in removed:
+        delete_document_from_index(index, doc_id)
+        get_metadata_index().remove(doc_id)
+    return touched | changed.keys() | removed
+
 
 def build_description_for_document(document: DocumentSchema) -> str:
     if DocumentMetadataKeysEnum.event_DOCUMENT in document.metadata_map:
@@ -122,37 +338,48 @@ def build_description_for_document(document: DocumentSchema) -> str:
 
 
 def index_to_query_engine(
-    doc_id: str, index: VectorStoreIndex, service_context: ServiceContext
+    doc_id: str,
+    index: VectorStoreIndex,
+    service_context: ServiceContext,
+    matrix: Optional[DocumentMatrix] = None,
+    shared: Optional[SharedDocumentQuery] = None,
 ) -> BaseQueryEngine:
     filters = MetadataFilters(
         filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value=doc_id)]
     )
 
-    kwargs = {
-        "similarity_top_k": 3,
-        "filters": filters,
-        "service_context": service_context,
-    }
-
-    return index.as_query_engine(**kwargs)
-
-
-def index_to_query_engine_single(
-    doc_ids: str, index: VectorStoreIndex, service_context: ServiceContext
-) -> BaseQueryEngine:
-    # filters = MetadataFilters(
-    #     filters=[
-    #         ExactMatchFilter(key=DB_DOC_ID_KEY, value=doc_id) for doc_id in doc_ids
-    #     ]
-    # )
-
-    kwargs = {
-        "similarity_top_k": 5,
-        # "filters": filters,
-        "service_context": service_context,
-    }
-
-    return index.as_query_engine(**kwargs)
+    version = index.storage_context.index_store.index_version(doc_id)
+    docstore = index.storage_context.docstore
+    bm25 = (
+        get_bm25_index(docstore, doc_id, version)
+        if isinstance(docstore, ShardedDocumentStore)
+        else None
+    )
+    # the index may be shared with other requests through the index cache, so
+    # the request's callback manager and embed model go on the retriever instead
+    # of being set on the index
+    retriever = ANNVectorIndexRetriever(
+        index,
+        doc_id=doc_id,
+        version=version,
+        matrix=matrix,
+        shared=shared,
+        # with a keyword index the vector hits are only fusion candidates
+        similarity_top_k=settings.HYBRID_CANDIDATE_TOP_K if bm25 else 3,
+        filters=filters,
+        node_ids=list(index.index_struct.nodes_dict.values()),
+        callback_manager=service_context.callback_manager,
+        embed_model=service_context.embed_model,
+    )
+    if bm25 is not None:
+        retriever = HybridRetriever(
+            retriever,
+            bm25,
+            docstore,
+            similarity_top_k=3,
+            callback_manager=service_context.callback_manager,
+        )
+    return RetrieverQueryEngine.from_args(retriever, service_context=service_context)
 
 
 def index_to_chat_engine(doc_id: str, index: VectorStoreIndex, llm) -> BaseQueryEngine:
@@ -163,17 +390,37 @@ def index_to_chat_engine(doc_id: str, index: VectorStoreIndex, llm) -> BaseQuery
     return index.as_chat_engine(llm=llm, **kwargs)
 
 
-@cached(
-    TTLCache(maxsize=10, ttl=timedelta(minutes=5).total_seconds()),
-    key=lambda *args, **kwargs: "global_storage_context",
-)
-def get_storage_context(
+async def get_storage_context(
     persist_dir: str, vector_store: VectorStore, fs: Optional[AsyncFileSystem] = None
 ) -> StorageContext:
-    logger.info("Creating new storage context.")
-    return StorageContext.from_defaults(
-        persist_dir=persist_dir, vector_store=vector_store, fs=fs
+    # the docstore and index store are sharded per document under storage/,
+    # only read as documents are touched and kept in sync with other workers
+    return await get_sharded_storage_context(
+        f"{persist_dir}/storage", vector_store, fs=fs
+    )
+
+
+async def persist_storage_context(
+    storage_context: StorageContext, keys: Optional[List[str]] = None
+) -> None:
+    # only the sharded docstore and index store need writing, the vectors live
+    # in pgvector. with `keys`, only the shards holding them are written
+    await storage_context.docstore.kvstore.apersist(keys)
+
+
+async def get_document_versions(
+    documents: List[DocumentSchema], fs: Optional[AsyncFileSystem] = None
+) -> Dict[str, int]:
+    """The storage version of each document's index, re-ingesting bumps it."""
+    vector_store = await get_vector_store_singleton()
+    storage_context = await get_storage_context(
+        settings.S3_BUCKET_NAME, vector_store, fs=fs
     )
+    # versions come from the shard manifest, no shard needs reading
+    return {
+        str(doc.id): storage_context.index_store.index_version(str(doc.id))
+        for doc in documents
+    }
 
 
 async def build_doc_id_to_index_map(
@@ -185,46 +432,138 @@ async def build_doc_id_to_index_map(
 
     vector_store = await get_vector_store_singleton()
 
-    try:
+    storage_context = await get_storage_context(persist_dir, vector_store, fs=fs)
+    # read every document's shard concurrently up front
+    await storage_context.docstore.kvstore.aload([str(doc.id) for doc in documents])
+    index_cache = get_index_cache()
+    versions = {
+        str(doc.id): storage_context.index_store.index_version(str(doc.id))
+        for doc in documents
+    }
+    cached = {
+        doc_id: index
+        for doc_id, version in versions.items()
+        if (index := index_cache.get(doc_id, version)) is not None
+    }
+    to_load = [doc for doc in documents if str(doc.id) not in cached]
+
+    loaded: Dict[str, VectorStoreIndex] = {}
+    if to_load:
         try:
-            storage_context = get_storage_context(persist_dir, vector_store, fs=fs)
-        except FileNotFoundError:
-            logger.info(
-                "Could not find storage context in S3. Creating new storage context."
+            index_ids = [str(doc.id) for doc in to_load]
+            indices = load_indices_from_storage(
+                storage_context,
+                index_ids=index_ids,
+                service_context=service_context,
+            )
+            loaded = dict(zip(index_ids, indices))
+            logger.debug("Loaded indices from storage.")
+        except ValueError:
+            # never embed on the chat path, documents that are not indexed yet
+            # are handed to the ingestion workers and left out until they are
+            # ready
+            ready_ids = [
+                str(doc.id)
+                for doc in to_load
+                if storage_context.index_store.get_index_struct(str(doc.id)) is not None
+            ]
+            pending = [doc for doc in to_load if str(doc.id) not in ready_ids]
+            logger.warning(
+                "%d of %d documents are not indexed yet, queueing them for "
+                "ingestion. If you're running the seed_db script, this is normal "
+                "and expected.",
+                len(pending),
+                len(documents),
             )
-            storage_context = StorageContext.from_defaults(
-                vector_store=vector_store, fs=fs
+            enqueue_documents(pending)
+            indices = (
+                load_indices_from_storage(
+                    storage_context,
+                    index_ids=ready_ids,
+                    service_context=service_context,
+                )
+                if ready_ids
+                else []
             )
-            storage_context.persist(persist_dir=persist_dir, fs=fs)
-        index_ids = [str(doc.id) for doc in documents]
-        indices = load_indices_from_storage(
+            loaded = dict(zip(ready_ids, indices))
+        for doc_id, index in loaded.items():
+            index_cache.put(doc_id, versions[doc_id], index)
+
+    indices_by_id = {**cached, **loaded}
+    return {
+        str(doc.id): indices_by_id[str(doc.id)]
+        for doc in documents
+        if str(doc.id) in indices_by_id
+    }
+
+
+def enqueue_documents(
+    documents: List[DocumentSchema], not_before: Optional[datetime] = None
+) -> List[IngestionJobInDB]:
+    """Queue documents for background ingestion, deduplicated per document."""
+    store = get_ingestion_store()
+    return [
+        store.enqueue(
+            IngestionJobCreate(
+                document_id=str(doc.id),
+                url=doc.url,
+                metadata_map=doc.metadata_map,
+                not_before=not_before,
+            )
+        )
+        for doc in documents
+    ]
+
+
+async def ingest_document(
+    service_context: ServiceContext,
+    document: DocumentSchema,
+    fs: Optional[AsyncFileSystem] = None,
+    report: Callable[[str], None] = lambda stage: None,
+) -> VectorStoreIndex:
+    """
+    Build and persist the per-document index for one document. This is what
+    the ingestion workers run, `report` is told which stage the job is in.
+    """
+    persist_dir = f"{settings.S3_BUCKET_NAME}"
+    vector_store = await get_vector_store_singleton()
+    storage_context = await get_storage_context(persist_dir, vector_store, fs=fs)
+    await storage_context.docstore.kvstore.aload([str(document.id)])
+
+    report("fetching")
+    fetched = await fetch_documents([document])
+    report("parsing")
+    nodes = (await parse_documents(fetched))[str(document.id)]
+    # per-document indices are filtered by document id, so only collapse
+    # repeats within the document itself
+    nodes = deduplicate_nodes(nodes)
+    if storage_context.index_store.get_index_struct(str(document.id)) is not None:
+        # a re-ingest replaces the document, drop the nodes, vectors and
+        # keyword index of the previous version first
+        previous = load_index_from_storage(
             storage_context,
-            index_ids=index_ids,
+            index_id=str(document.id),
             service_context=service_context,
+            store_nodes_override=True,
         )
-        doc_id_to_index = dict(zip(index_ids, indices))
-        logger.debug("Loaded indices from storage.")
-    except ValueError:
-        logger.error(
-            "Failed to load indices from storage. Creating new indices. "
-            "If you're running the seed_db script, this is normal and expected."
-        )
-        storage_context = StorageContext.from_defaults(
-            persist_dir=persist_dir, vector_store=vector_store, fs=fs
-        )
-        doc_id_to_index = {}
-        for doc in documents:
-            llama_index_docs = fetch_and_read_document(doc)
-            storage_context.docstore.add_documents(llama_index_docs)
-            index = VectorStoreIndex.from_documents(
-                llama_index_docs,
-                storage_context=storage_context,
-                service_context=service_context,
-            )
-            index.set_index_id(str(doc.id))
-            index.storage_context.persist(persist_dir=persist_dir, fs=fs)
-            doc_id_to_index[str(doc.id)] = index
-    return doc_id_to_index
+        await asyncio.to_thread(delete_document_from_index, previous, str(document.id))
+    report("embedding")
+    storage_context.docstore.add_documents(nodes)
+    # embedding blocks, keep it off the loop so other jobs can make progress
+    index = await asyncio.to_thread(
+        VectorStoreIndex,
+        nodes,
+        storage_context=storage_context,
+        service_context=service_context,
+        # the index struct lists the nodes an index owns, even when the vector
+        # store keeps the text
+        store_nodes_override=True,
+    )
+    index.set_index_id(str(document.id))
+    save_bm25_index(storage_context.docstore, str(document.id), nodes)
+    report("persisting")
+    await persist_storage_context(index.storage_context, [str(document.id)])
+    return index
 
 
 # this is for dumb rag
@@ -234,65 +573,38 @@ async def build_single_index(
     fs: Optional[AsyncFileSystem] = None,
     force: bool = False,
 ):
-    fullstore_filename_prefix = "fullstore"
     vector_store = await get_vector_store_singleton()
     persist_dir = f"{settings.S3_BUCKET_NAME}"
+    storage_context = await get_storage_context(persist_dir, vector_store, fs=fs)
+    await storage_context.docstore.kvstore.aload(
+        ["fullstore"] + [str(doc.id) for doc in documents]
+    )
     try:
-        try:
-            storage_context = get_storage_context(persist_dir, vector_store, fs=fs)
-        except FileNotFoundError:
-            logger.info(
-                "Could not find storage context in S3. Creating new storage context."
-            )
-            storage_context = StorageContext.from_defaults(
-                vector_store=vector_store, fs=fs
-            )
-            storage_context.persist(
-                persist_dir=persist_dir,
-                fs=fs,
-                vector_store_fname=fullstore_filename_prefix + "vectors.json",
-                docstore_fname=fullstore_filename_prefix + "docs.json",
-                graph_store_fname=fullstore_filename_prefix + "graph.json",
-                index_store_fname=fullstore_filename_prefix + "index.json",
-            )
-        if force:
-            raise ValueError
-        doc_ids = [str(doc.id) for doc in documents]
         index = load_index_from_storage(
             storage_context,
             index_id="fullstore",
             service_context=service_context,
+            store_nodes_override=True,
         )
-        # TODO make it so that instead of rebuilding the enitre vector store it just inserts new ones
-
-        # for id in doc_ids:
-        #     if id not in index.ref_doc_info:
-        #         raise ValueError
-
         logger.debug("Loaded indices from storage.")
     except ValueError:
         logger.error("failed to find persisted vector store")
-        storage_context = StorageContext.from_defaults(
-            persist_dir=persist_dir, vector_store=vector_store, fs=fs
-        )
-        llama_index_docs = [fetch_and_read_document(doc) for doc in documents]
-        llama_index_docs = [x for y in llama_index_docs for x in y]
-        storage_context.docstore.add_documents(llama_index_docs)
-        index = VectorStoreIndex.from_documents(
-            llama_index_docs,
+        index = VectorStoreIndex(
+            [],
             storage_context=storage_context,
             service_context=service_context,
             show_progress=True,
+            store_nodes_override=True,
         )
         index.set_index_id("fullstore")
-        index.storage_context.persist(
-            persist_dir=persist_dir,
-            fs=fs,
-            # vector_store_fname=fullstore_filename_prefix + "vectors.json",
-            # docstore_fname=fullstore_filename_prefix + "docs.json",
-            # graph_store_fname=fullstore_filename_prefix + "graph.json",
-            # index_store_fname=fullstore_filename_prefix + "index.json",
-        )
+    # new documents are always inserted, force re-checks the existing ones for
+    # changes and drops the ones that are no longer wanted
+    touched = await sync_index_documents(
+        index, documents, revalidate=force, prune=force
+    )
+    if touched:
+        # the fullstore index struct lists every node, so it changes too
+        await persist_storage_context(index.storage_context, ["fullstore", *touched])
     return index
 
 
@@ -308,20 +620,19 @@ async def rebuild_vector_db(
         "Failed to load indices from storage. Creating new indices. "
         "If you're running the seed_db script, this is normal and expected."
     )
-    storage_context = StorageContext.from_defaults(
-        persist_dir=persist_dir, vector_store=vector_store, fs=fs
-    )
+    storage_context = await get_storage_context(persist_dir, vector_store, fs=fs)
     doc_id_to_index = {}
+    doc_id_to_nodes = await fetch_and_parse_documents(documents)
     for doc in documents:
-        llama_index_docs = fetch_and_read_document(doc)
-        storage_context.docstore.add_documents(llama_index_docs)
-        index = VectorStoreIndex.from_documents(
-            llama_index_docs,
+        nodes = doc_id_to_nodes[str(doc.id)]
+        storage_context.docstore.add_documents(nodes)
+        index = VectorStoreIndex(
+            nodes,
             storage_context=storage_context,
             service_context=service_context,
         )
         index.set_index_id(str(doc.id))
-        index.storage_context.persist(persist_dir=persist_dir, fs=fs)
+        await persist_storage_context(index.storage_context, [str(doc.id)])
         doc_id_to_index[str(doc.id)] = index
 
 
@@ -359,57 +670,162 @@ def get_tool_service_context(
     callback_handlers: List[BaseCallbackHandler],
 ) -> ServiceContext:
     callback_manager = CallbackManager(callback_handlers)
-
-    llm = BedrockConverse(
-        temperature=0,
-        model=BEDROCK_TOOL_LLM_NAME,
-        aws_access_key_id=settings.AWS_KEY,
-        aws_secret_access_key=settings.AWS_SECRET,
-        region_name="ap-southeast-1",
+    # the clients are shared process-wide, only the callback manager is new
+    service_context = ServiceContext.from_defaults(
         callback_manager=callback_manager,
+        llm=get_llm(BEDROCK_TOOL_LLM_NAME, "ap-southeast-1", callback_manager),
+        embed_model=get_embed_model(callback_manager),
+        node_parser=get_node_parser(callback_manager),
     )
-    embedding_model = BedrockEmbedding(
-        model_name=Models.COHERE_EMBED_ENGLISH_V3,
-        aws_access_key_id=settings.AWS_KEY,
-        aws_secret_access_key=settings.AWS_SECRET,
-        region_name=settings.BEDROCK_REGION,
-        # TODO add access to the Bedrock API key
+    return service_context
+
+
+def prefilter_documents(
+    documents: List[DocumentSchema],
+    question: str,
+    now: Optional[datetime] = None,
+) -> List[DocumentSchema]:
+    """
+    Drop the documents whose event date is well outside the time window the
+    question asks about, if it names one.
+    """
+    time_range = parse_time_range(question, now)
+    if time_range is None:
+        return documents
+    # the window is computed in utc without the user's timezone, an evening
+    # in the americas is already tomorrow, so only drop what's a day off
+    slack = timedelta(days=settings.PREFILTER_SLACK_DAYS)
+    time_range = (time_range[0] - slack, time_range[1] + slack)
+    metadata_index = get_metadata_index()
+    metadata_index.add_documents(documents)
+    kept = set(metadata_index.prune([str(doc.id) for doc in documents], time_range))
+    logger.info(
+        "Prefiltered %d of %d documents to %s.",
+        len(kept),
+        len(documents),
+        time_range,
     )
-    # Use a smaller chunk size to retrieve more granular results
-    node_parser = SentenceSplitter.from_defaults(
-        chunk_size=NODE_PARSER_CHUNK_SIZE,
-        chunk_overlap=NODE_PARSER_CHUNK_OVERLAP,
-        callback_manager=callback_manager,
+    # nothing in the window, let the agent say so from the full set
+    return [doc for doc in documents if str(doc.id) in kept] or documents
+
+
+def get_system_message(documents: List[DocumentSchema]) -> ChatMessage:
+    if documents:
+        doc_titles = "\n".join(
+            "- " + build_title_for_document(doc) for doc in documents
+        )
+    else:
+        doc_titles = "No documents selected."
+
+    curr_date = datetime.utcnow().strftime("%Y-%m-%d")
+    return ChatMessage(
+        role=MessageRole.SYSTEM,
+        content=SYSTEM_MESSAGE.format(doc_titles=doc_titles, curr_date=curr_date),
     )
-    service_context = ServiceContext.from_defaults(
-        callback_manager=callback_manager,
-        llm=llm,
-        embed_model=embedding_model,
-        node_parser=node_parser,
+
+
+async def get_prefix_messages(
+    cached: CachedChatEngine, conversation: ConversationSchema
+) -> List[ChatMessage]:
+    """
+    The system message, a summary of the older messages and the recent ones,
+    within the chat history token budget.
+    """
+    chat_history = cached.sync_history(conversation.messages, get_chat_history)
+    system_message = get_system_message(conversation.documents)
+    if chat_history and chat_history[0].role == MessageRole.SYSTEM:
+        system_message, chat_history = chat_history[0], chat_history[1:]
+    chat_history = await get_chat_memory_store().pack(
+        str(conversation.id), chat_history
+    )
+    logger.debug("Chat history: %s", chat_history)
+    return [system_message] + chat_history
+
+
+async def get_chat_engine_key(
+    kind: str,
+    conversation: ConversationSchema,
+    documents: List[DocumentSchema],
+    fs: Optional[AsyncFileSystem] = None,
+) -> ChatEngineKey:
+    versions = await get_document_versions(conversation.documents, fs=fs)
+    return (
+        kind,
+        str(conversation.id),
+        document_set_key(versions),
+        tuple(sorted(str(doc.id) for doc in documents)),
     )
-    return service_context
 
 
 async def get_chat_engine(
     callback_handler: BaseCallbackHandler,
     conversation: ConversationSchema,
+    question: Optional[str] = None,
 ) -> AgentRunner:
+    s3_fs = get_s3_fs()
+    documents = conversation.documents
+    if question:
+        # only load and search the documents the question can be about
+        documents = prefilter_documents(documents, question)
+    key = await get_chat_engine_key("agent", conversation, documents, fs=s3_fs)
+    chat_engine_cache = get_chat_engine_cache()
+    cached = chat_engine_cache.get(key)
+    if cached is None:
+        cached = await build_chat_engine(callback_handler, conversation, documents)
+        chat_engine_cache.put(key, cached)
+    else:
+        cached.use(callback_handler)
+        # drop the previous turn, the history below already has it
+        cached.engine.reset()
+
+    chat_engine: AgentRunner = cached.engine
+    chat_engine.agent_worker.prefix_messages = await get_prefix_messages(
+        cached, conversation
+    )
+    return chat_engine
+
+
+async def build_chat_engine(
+    callback_handler: BaseCallbackHandler,
+    conversation: ConversationSchema,
+    documents: List[DocumentSchema],
+) -> CachedChatEngine:
     service_context = get_tool_service_context([callback_handler])
     s3_fs = get_s3_fs()
     doc_id_to_index = await build_doc_id_to_index_map(
-        service_context, conversation.documents, fs=s3_fs
+        service_context, documents, fs=s3_fs
+    )
+    # small document sets are searched exactly from one in-memory matrix
+    matrix = await get_document_matrix(
+        doc_id_to_index, service_context.embed_model.model_name
     )
-    for key, val in doc_id_to_index.items():
-        doc_id_to_index[key]._callback_manager = service_context.callback_manager
-
     id_to_doc: Dict[str, DocumentSchema] = {
         str(doc.id): doc for doc in conversation.documents
     }
+    # the documents' tools share one vector store query per question, every
+    # index is a view of the same store
+    shared = (
+        SharedDocumentQuery(
+            MultiDocumentRetriever(
+                next(iter(doc_id_to_index.values())),
+                list(doc_id_to_index),
+                per_document_top_k=settings.HYBRID_CANDIDATE_TOP_K,
+                callback_manager=service_context.callback_manager,
+                embed_model=service_context.embed_model,
+            )
+        )
+        if doc_id_to_index
+        else None
+    )
 
     vector_query_engine_tools = [
         QueryEngineTool(
             query_engine=index_to_query_engine(
-                doc_id, index, service_context=service_context
+                doc_id,
+                index,
+                service_context=service_context,
+                matrix=matrix,
+                shared=shared,
             ),
             metadata=ToolMetadata(
                 name=eventDocumentMetadata.parse_obj(
@@ -423,7 +839,9 @@ async def get_chat_engine(
         for doc_id, index in doc_id_to_index.items()
     ]
     response_synth = get_custom_response_synth(service_context, conversation.documents)
-    qualitative_question_engine = SubQuestionQueryEngine.from_defaults(
+    # sub questions run a few at a time and the slowest are skipped at the
+    # deadline, so one slow document can't hold up the answer
+    qualitative_question_engine = BoundedSubQuestionQueryEngine.from_defaults(
         query_engine_tools=vector_query_engine_tools,
         service_context=service_context,
         response_synthesizer=response_synth,
@@ -443,47 +861,19 @@ user can ask questions about the events they have selected""",
         ),
     ]
 
-    chat_llm = BedrockConverse(
-        temperature=0,
-        model=BEDROCK_TOOL_LLM_NAME,
-        aws_access_key_id=settings.AWS_KEY,
-        aws_secret_access_key=settings.AWS_SECRET,
-        region_name="us-east-1",
-    )
-    chat_messages: List[MessageSchema] = conversation.messages
-    chat_history = get_chat_history(chat_messages)
-    logger.debug("Chat history: %s", chat_history)
-
-    if conversation.documents:
-        doc_titles = "\n".join(
-            "- " + build_title_for_document(doc) for doc in conversation.documents
-        )
-    else:
-        doc_titles = "No documents selected."
-
-    curr_date = datetime.utcnow().strftime("%Y-%m-%d")
-
-    if not chat_history or chat_history[0].role != MessageRole.SYSTEM:
-        chat_history = [
-            ChatMessage(
-                role=MessageRole.SYSTEM,
-                content=SYSTEM_MESSAGE.format(
-                    doc_titles=doc_titles, curr_date=curr_date
-                ),
-            )
-        ] + chat_history
-
+    chat_llm = get_llm(BEDROCK_TOOL_LLM_NAME, "us-east-1")
+    # the prefix messages are set for every message by get_chat_engine
     chat_engine = FunctionCallingAgentWorker.from_tools(
         tools=top_level_sub_tools,
         llm=chat_llm,
-        prefix_messages=chat_history,
+        prefix_messages=[],
         verbose=settings.VERBOSE,
         # system_prompt=SYSTEM_MESSAGE.format(doc_titles=doc_titles, curr_date=curr_date),
         callback_manager=service_context.callback_manager,
         max_function_calls=3,
     ).as_agent()
 
-    return chat_engine
+    return CachedChatEngine(chat_engine, service_context.callback_manager)
 
 
 # OpenAIAgent
@@ -493,55 +883,52 @@ async def get_chat_engine_simplest(
     callback_handler: BaseCallbackHandler,
     conversation: ConversationSchema,
 ):
-    service_context = get_tool_service_context([callback_handler])
     s3_fs = get_s3_fs()
-    index = await build_single_index(service_context, conversation.documents, fs=s3_fs)
-    doc_ids = [doc.id for doc in conversation.documents]
-    id_to_doc: Dict[str, DocumentSchema] = {
-        str(doc.id): doc for doc in conversation.documents
-    }
-
-    chat_llm = BedrockConverse(
-        temperature=0,
-        model=SIMPLE_BEDROCK_CHAT_LLM_NAME,
-        aws_access_key_id=settings.AWS_KEY,
-        aws_secret_access_key=settings.AWS_SECRET,
-        region_name="ap-southeast-1",
+    key = await get_chat_engine_key(
+        "simplest", conversation, conversation.documents, fs=s3_fs
     )
-    chat_messages: List[MessageSchema] = conversation.messages
-    chat_history = get_chat_history(chat_messages)
-    logger.debug("Chat history: %s", chat_history)
-
-    if conversation.documents:
-        doc_titles = "\n".join(
-            "- " + build_title_for_document(doc) for doc in conversation.documents
-        )
+    chat_engine_cache = get_chat_engine_cache()
+    cached = chat_engine_cache.get(key)
+    if cached is None:
+        cached = await build_chat_engine_simplest(callback_handler, conversation)
+        chat_engine_cache.put(key, cached)
     else:
-        doc_titles = "No documents selected."
+        cached.use(callback_handler)
+        cached.engine.reset()
 
-    curr_date = datetime.utcnow().strftime("%Y-%m-%d")
+    chat_engine: ContextChatEngine = cached.engine
+    # ContextChatEngine has no setter for its prefix messages
+    chat_engine._prefix_messages = await get_prefix_messages(cached, conversation)
+    return chat_engine
 
-    if not chat_history or chat_history[0].role != MessageRole.SYSTEM:
-        chat_history = [
-            ChatMessage(
-                role=MessageRole.SYSTEM,
-                content=SYSTEM_MESSAGE.format(
-                    doc_titles=doc_titles, curr_date=curr_date
-                ),
-            )
-        ] + chat_history
-    kwargs = {
-        "similarity_top_k": 3,
-    }
-    chat_engine = index.as_chat_engine(
+
+async def build_chat_engine_simplest(
+    callback_handler: BaseCallbackHandler,
+    conversation: ConversationSchema,
+) -> CachedChatEngine:
+    service_context = get_tool_service_context([callback_handler])
+    s3_fs = get_s3_fs()
+    index = await build_single_index(service_context, conversation.documents, fs=s3_fs)
+    doc_ids = [str(doc.id) for doc in conversation.documents]
+
+    chat_llm = get_llm(SIMPLE_BEDROCK_CHAT_LLM_NAME, "ap-southeast-1")
+    # the full store holds every document, so restrict retrieval to the
+    # conversation's documents with a single IN filtered query
+    retriever = MultiDocumentRetriever(
+        index,
+        doc_ids,
+        per_document_top_k=3,
+        callback_manager=service_context.callback_manager,
+        embed_model=service_context.embed_model,
+    )
+    chat_engine = ContextChatEngine.from_defaults(
+        retriever=retriever,
         # llm=chat_llm,
-        prefix_messages=chat_history,
-        chat_mode=ChatMode.CONTEXT,
+        prefix_messages=[],
         # callback_manager=service_context.callback_manager,
         verbose=True,
         service_context=service_context,
         stream=True,
-        **kwargs,
     )
 
-    return chat_engine
+    return CachedChatEngine(chat_engine, service_context.callback_manager)
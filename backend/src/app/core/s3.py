@@ -0,0 +1,52 @@
+"""
+process-wide s3 filesystem
+
+one s3fs filesystem with a pooled connection config is shared by every request
+and created at startup, with the bucket checked once. s3fs runs its requests on
+fsspec's own io loop, async callers reach it through ShardedKVStore so storage
+reads and writes don't block the app's loop.
+"""
+
+import asyncio
+from typing import Any, Optional
+
+import s3fs
+from fsspec.asyn import AsyncFileSystem
+
+from app.core.config import settings
+
+_s3_fs: Optional[AsyncFileSystem] = None
+
+
+def get_s3_fs() -> AsyncFileSystem:
+    global _s3_fs
+    if _s3_fs is None:
+        s3 = s3fs.S3FileSystem(
+            key=settings.AWS_KEY,
+            secret=settings.AWS_SECRET,
+            endpoint_url=settings.S3_ENDPOINT_URL,
+            config_kwargs={"max_pool_connections": settings.S3_MAX_POOL_CONNECTIONS},
+        )
+        if not (settings.RENDER or s3.exists(settings.S3_BUCKET_NAME)):
+            s3.mkdir(settings.S3_BUCKET_NAME, location="ap-southeast-1")
+        _s3_fs = s3
+    return _s3_fs
+
+
+async def run_fs_call(
+    fs: AsyncFileSystem, method: str, *args: Any, **kwargs: Any
+) -> Any:
+    """
+    Run a filesystem call without blocking the event loop. Async filesystems
+    like s3fs run it as a coroutine on fsspec's io loop, others in a thread.
+    """
+    if fs.async_impl:
+        coro = getattr(fs, f"_{method}")(*args, **kwargs)
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coro, fs.loop)
+        )
+    return await asyncio.to_thread(getattr(fs, method), *args, **kwargs)
+
+
+async def init_s3_fs() -> None:
+    await asyncio.to_thread(get_s3_fs)
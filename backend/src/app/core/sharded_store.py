@@ -0,0 +1,509 @@
+"""
+sharded, lazily loaded docstore and index store
+
+instead of one docstore.json and index_store.json holding the whole corpus,
+every key is filed in a shard named after the db document id its key starts
+with (node, page and index ids are all prefixed with it), and each shard is
+stored as compressed json under `<root>/shards/`. a manifest lists the shards
+with a version per shard. shards are read on first access and `persist` only
+writes the shards that changed, so loading and saving cost grows with the
+documents touched rather than with the size of the corpus.
+
+every persist writes a new generation of the manifest under
+`<root>/manifests/`, created only if that generation doesn't exist yet. a
+worker that loses the race to another one merges its changes into the winner's
+manifest and tries the next generation, so concurrent persists never drop each
+other's version bumps.
+
+storage contexts are cached per process. a cached one re-reads the manifest at
+most every few seconds and drops the shards whose version moved, so changes
+persisted by other workers show up quickly and unchanged shards are never read
+twice.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import fsspec
+from llama_index.core import StorageContext
+from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
+from llama_index.core.storage.docstore.types import RefDocInfo
+from llama_index.core.storage.index_store.keyval_index_store import KVIndexStore
+from llama_index.core.storage.kvstore.types import DEFAULT_COLLECTION, BaseKVStore
+from llama_index.core.vector_stores.types import VectorStore
+
+from app.core.config import settings
+from app.core.s3 import run_fs_call
+
+logger = logging.getLogger(__name__)
+
+MANIFESTS_DIR = "manifests"
+# older manifest generations kept around for readers that listed them just
+# before a persist
+KEEP_MANIFESTS = 8
+# keys without a document id prefix, like the fullstore index id, are spread
+# over a fixed number of shared shards
+SHARED_SHARDS = 16
+
+_DOC_ID_PREFIX_RE = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.IGNORECASE
+)
+
+# {collection: {key: value}}
+Shard = Dict[str, Dict[str, dict]]
+
+
+def shard_for_key(key: str) -> str:
+    match = _DOC_ID_PREFIX_RE.match(key)
+    if match:
+        return match.group(0).lower()
+    return f"shared-{zlib.crc32(key.encode()) % SHARED_SHARDS:02d}"
+
+
+def _encode(shard: Shard) -> bytes:
+    return zlib.compress(json.dumps(shard, separators=(",", ":")).encode())
+
+
+def _decode(data: bytes) -> Shard:
+    return json.loads(zlib.decompress(data))
+
+
+class ShardedKVStore(BaseKVStore):
+    def __init__(self, root: str, fs: Optional[fsspec.AbstractFileSystem] = None):
+        self.root = root.rstrip("/")
+        self.fs = fs or fsspec.filesystem("file", auto_mkdir=True)
+        self._lock = threading.RLock()
+        self._shards: Dict[str, Shard] = {}
+        self._dirty: Set[str] = set()
+        self._manifest: Optional[Dict[str, int]] = None
+        self._generation = 0
+        self._checked_at = 0.0
+        # persists of this process take turns, so they don't race each other
+        # for the next manifest generation
+        self._persist_lock = threading.Lock()
+        self._apersist_lock = asyncio.Lock()
+        # the manifest version each loaded shard was read at
+        self._loaded_versions: Dict[str, int] = {}
+
+    def _shard_path(self, shard: str) -> str:
+        return f"{self.root}/shards/{shard}.json.z"
+
+    @property
+    def _manifests_dir(self) -> str:
+        return f"{self.root}/{MANIFESTS_DIR}"
+
+    def _manifest_path(self, generation: int) -> str:
+        return f"{self._manifests_dir}/{generation:012d}.json"
+
+    @staticmethod
+    def _latest_generation(paths: List[str]) -> int:
+        return max(
+            (
+                int(path.rsplit("/", 1)[-1].split(".")[0])
+                for path in paths
+                if path.endswith(".json")
+            ),
+            default=0,
+        )
+
+    async def _run(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        return await run_fs_call(self.fs, method, *args, **kwargs)
+
+    def _read_manifest(self) -> Tuple[int, Dict[str, int]]:
+        """the latest manifest generation and its shard versions"""
+        while True:
+            try:
+                generation = self._latest_generation(
+                    self.fs.ls(self._manifests_dir, detail=False, refresh=True)
+                )
+                if not generation:
+                    return 0, {}
+                return generation, json.loads(
+                    self.fs.cat_file(self._manifest_path(generation))
+                )
+            except FileNotFoundError:
+                # nothing persisted yet, or the generation we listed was
+                # pruned by a newer persist before we read it
+                if not self.fs.exists(self._manifests_dir):
+                    return 0, {}
+
+    async def _aread_manifest(self) -> Tuple[int, Dict[str, int]]:
+        while True:
+            try:
+                generation = self._latest_generation(
+                    await self._run(
+                        "ls", self._manifests_dir, detail=False, refresh=True
+                    )
+                )
+                if not generation:
+                    return 0, {}
+                return generation, json.loads(
+                    await self._run("cat_file", self._manifest_path(generation))
+                )
+            except FileNotFoundError:
+                if not await self._run("exists", self._manifests_dir):
+                    return 0, {}
+
+    @property
+    def manifest(self) -> Dict[str, int]:
+        """shard name -> version, as of the last load or persist"""
+        with self._lock:
+            if self._manifest is None:
+                self._generation, self._manifest = self._read_manifest()
+                self._checked_at = time.monotonic()
+            return self._manifest
+
+    def _apply_manifest(self, generation: int, manifest: Dict[str, int]) -> None:
+        with self._lock:
+            self._checked_at = time.monotonic()
+            if generation < self._generation:
+                # our own persist got in since this was read
+                return
+            stale = [
+                shard
+                for shard in self._shards
+                if shard not in self._dirty
+                and manifest.get(shard, 0) != self._loaded_versions.get(shard, 0)
+            ]
+            for shard in stale:
+                del self._shards[shard]
+                self._loaded_versions.pop(shard, None)
+            self._generation, self._manifest = generation, manifest
+        if stale:
+            logger.info("%d storage shards changed, reloading them.", len(stale))
+
+    def _is_fresh(self, max_age: float) -> bool:
+        return time.monotonic() - self._checked_at < max_age
+
+    def revalidate(self, max_age: float = settings.STORAGE_REVALIDATE_SECONDS) -> None:
+        """
+        Re-read the manifest if it is older than `max_age` seconds and unload
+        the shards another process has persisted since we read them. Shards
+        with unpersisted changes are kept.
+        """
+        if not self._is_fresh(max_age):
+            self._apply_manifest(*self._read_manifest())
+
+    async def arevalidate(
+        self, max_age: float = settings.STORAGE_REVALIDATE_SECONDS
+    ) -> None:
+        if not self._is_fresh(max_age):
+            self._apply_manifest(*await self._aread_manifest())
+
+    def _to_load(self, shards: List[str]) -> List[str]:
+        with self._lock:
+            return [
+                shard
+                for shard in dict.fromkeys(shards)
+                if shard not in self._shards and shard in self.manifest
+            ]
+
+    def _install(self, shards: List[str], data: Dict[str, bytes]) -> None:
+        with self._lock:
+            for shard in shards:
+                if shard in self._shards:
+                    # loaded by someone else while we were reading
+                    continue
+                raw = data.get(self.fs._strip_protocol(self._shard_path(shard)))
+                self._shards[shard] = _decode(raw) if raw else {}
+                self._loaded_versions[shard] = self.manifest.get(shard, 0)
+        if shards:
+            logger.debug("Loaded %d storage shards.", len(shards))
+
+    def _load(self, shards: List[str]) -> None:
+        """read the given shards from storage, if they are not loaded yet"""
+        to_load = self._to_load(shards)
+        data = (
+            self.fs.cat([self._shard_path(s) for s in to_load], on_error="omit")
+            if to_load
+            else {}
+        )
+        self._install(to_load, data)
+        with self._lock:
+            # shards that were never stored start out empty
+            for shard in shards:
+                self._shards.setdefault(shard, {})
+
+    async def aload(self, keys: List[str]) -> None:
+        """read the shards holding `keys` concurrently, ahead of sync access"""
+        await self.arevalidate()
+        shards = [shard_for_key(key) for key in keys]
+        to_load = self._to_load(shards)
+        if to_load:
+            data = await self._run(
+                "cat", [self._shard_path(s) for s in to_load], on_error="omit"
+            )
+            self._install(to_load, data)
+
+    def _shard(self, key: str) -> Shard:
+        shard = shard_for_key(key)
+        self._load([shard])
+        return self._shards[shard]
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        with self._lock:
+            self._shard(key).setdefault(collection, {})[key] = val.copy()
+            self._dirty.add(shard_for_key(key))
+
+    async def aput(
+        self, key: str, val: dict, collection: str = DEFAULT_COLLECTION
+    ) -> None:
+        self.put(key, val, collection)
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        with self._lock:
+            val = self._shard(key).get(collection, {}).get(key)
+        return None if val is None else val.copy()
+
+    async def aget(
+        self, key: str, collection: str = DEFAULT_COLLECTION
+    ) -> Optional[dict]:
+        return self.get(key, collection)
+
+    def get_shard(self, shard: str, collection: str = DEFAULT_COLLECTION) -> Dict:
+        """every entry of `collection` filed in one shard"""
+        with self._lock:
+            self._load([shard])
+            return dict(self._shards[shard].get(collection, {}))
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        # this has to read every shard, only the rare whole-corpus operations
+        # like pruning use it
+        with self._lock:
+            self._load(list(self.manifest))
+            return {
+                key: val
+                for shard in self._shards.values()
+                for key, val in shard.get(collection, {}).items()
+            }
+
+    async def aget_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        return self.get_all(collection)
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        with self._lock:
+            deleted = self._shard(key).get(collection, {}).pop(key, None) is not None
+            if deleted:
+                self._dirty.add(shard_for_key(key))
+        return deleted
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return self.delete(key, collection)
+
+    def _shard_paths(self, written: Dict[str, bytes]) -> Dict[str, bytes]:
+        return {self._shard_path(shard): data for shard, data in written.items()}
+
+    def _take_dirty(
+        self, keys: Optional[List[str]] = None
+    ) -> Tuple[Dict[str, bytes], List[str], List[str]]:
+        """encode the dirty shards and mark them clean, ahead of writing them"""
+        with self._lock:
+            if keys is None:
+                dirty = list(self._dirty)
+            else:
+                dirty = [
+                    s for s in {shard_for_key(k) for k in keys} if s in self._dirty
+                ]
+            self._dirty.difference_update(dirty)
+            written = {
+                shard: _encode(self._shards[shard])
+                for shard in dirty
+                if any(self._shards[shard].values())
+            }
+            emptied = [
+                shard
+                for shard in dirty
+                if shard not in written and shard in self.manifest
+            ]
+            return written, dirty, emptied
+
+    @staticmethod
+    def _merge_manifest(
+        manifest: Dict[str, int], written: Dict[str, bytes], emptied: List[str]
+    ) -> bytes:
+        # merged into the latest manifest, other processes may have added
+        # shards of their own since we read it
+        for shard in written:
+            manifest[shard] = manifest.get(shard, 0) + 1
+        for shard in emptied:
+            manifest.pop(shard, None)
+        return json.dumps(manifest).encode()
+
+    def _persisted(
+        self, generation: int, manifest: Dict[str, int], dirty: List[str]
+    ) -> None:
+        with self._lock:
+            if generation > self._generation:
+                self._generation, self._manifest = generation, manifest
+            for shard in dirty:
+                self._loaded_versions[shard] = manifest.get(shard, 0)
+        logger.info(
+            "Persisted %d storage shards as manifest generation %d.",
+            len(dirty),
+            generation,
+        )
+
+    def _persist_failed(self, dirty: List[str]) -> None:
+        with self._lock:
+            self._dirty.update(dirty)
+
+    def persist(self, keys: Optional[List[str]] = None) -> None:
+        """
+        Write the shards changed since the last persist, then the next
+        manifest generation. With `keys`, only the shards holding them are
+        written, so one job doesn't save another's half-done changes.
+        """
+        with self._persist_lock:
+            written, dirty, emptied = self._take_dirty(keys)
+            if not dirty:
+                return
+            try:
+                if written:
+                    self.fs.pipe(self._shard_paths(written))
+                while True:
+                    generation, manifest = self._read_manifest()
+                    data = self._merge_manifest(manifest, written, emptied)
+                    try:
+                        self.fs.pipe_file(
+                            self._manifest_path(generation + 1), data, mode="create"
+                        )
+                        break
+                    except FileExistsError:
+                        logger.info("Manifest generation %d taken.", generation + 1)
+                if emptied:
+                    self.fs.rm([self._shard_path(shard) for shard in emptied])
+            except BaseException:
+                self._persist_failed(dirty)
+                raise
+            self._persisted(generation + 1, manifest, dirty)
+            if generation + 1 <= KEEP_MANIFESTS:
+                return
+            try:
+                self.fs.rm(self._manifest_path(generation + 1 - KEEP_MANIFESTS))
+            except FileNotFoundError:
+                pass
+
+    async def apersist(self, keys: Optional[List[str]] = None) -> None:
+        """persist, with the shards written concurrently off the event loop"""
+        async with self._apersist_lock:
+            written, dirty, emptied = self._take_dirty(keys)
+            if not dirty:
+                return
+            try:
+                if written:
+                    await self._run("pipe", self._shard_paths(written))
+                while True:
+                    generation, manifest = await self._aread_manifest()
+                    data = self._merge_manifest(manifest, written, emptied)
+                    try:
+                        await self._run(
+                            "pipe_file",
+                            self._manifest_path(generation + 1),
+                            data,
+                            mode="create",
+                        )
+                        break
+                    except FileExistsError:
+                        logger.info("Manifest generation %d taken.", generation + 1)
+                if emptied:
+                    await self._run(
+                        "rm", [self._shard_path(shard) for shard in emptied]
+                    )
+            except BaseException:
+                self._persist_failed(dirty)
+                raise
+            self._persisted(generation + 1, manifest, dirty)
+            if generation + 1 <= KEEP_MANIFESTS:
+                return
+            try:
+                await self._run(
+                    "rm", self._manifest_path(generation + 1 - KEEP_MANIFESTS)
+                )
+            except FileNotFoundError:
+                pass
+
+
+class ShardedDocumentStore(KVDocumentStore):
+    def __init__(self, kvstore: ShardedKVStore, **kwargs: Any) -> None:
+        super().__init__(kvstore, **kwargs)
+        self._sharded_kvstore = kvstore
+
+    @property
+    def kvstore(self) -> ShardedKVStore:
+        return self._sharded_kvstore
+
+    def get_document_ref_doc_info(self, doc_id: str) -> Dict[str, RefDocInfo]:
+        """the ref doc infos of one db document, reading only its shard"""
+        return {
+            ref_doc_id: RefDocInfo(**val)
+            for ref_doc_id, val in self._sharded_kvstore.get_shard(
+                shard_for_key(doc_id), self._ref_doc_collection
+            ).items()
+        }
+
+    def persist(
+        self, persist_path: str = "", fs: Optional[fsspec.AbstractFileSystem] = None
+    ) -> None:
+        # shards are written under the kvstore's own root
+        self._sharded_kvstore.persist()
+
+
+class ShardedIndexStore(KVIndexStore):
+    def __init__(self, kvstore: ShardedKVStore, **kwargs: Any) -> None:
+        super().__init__(kvstore, **kwargs)
+        self._sharded_kvstore = kvstore
+
+    def index_version(self, index_id: str) -> int:
+        """the stored version of the shard holding `index_id`, 0 if never stored"""
+        return self._sharded_kvstore.manifest.get(shard_for_key(index_id), 0)
+
+    def persist(
+        self, persist_path: str = "", fs: Optional[fsspec.AbstractFileSystem] = None
+    ) -> None:
+        self._sharded_kvstore.persist()
+
+
+def sharded_storage_context(
+    root: str,
+    vector_store: VectorStore,
+    fs: Optional[fsspec.AbstractFileSystem] = None,
+) -> StorageContext:
+    """a storage context whose docstore and index store share one sharded kvstore"""
+    kvstore = ShardedKVStore(root, fs=fs)
+    return StorageContext.from_defaults(
+        docstore=ShardedDocumentStore(kvstore),
+        index_store=ShardedIndexStore(kvstore),
+        vector_store=vector_store,
+    )
+
+
+# (root, id(vector store), id(fs)) -> storage context. the context holds on to
+# the vector store and fs, so their ids stay unique
+_storage_contexts: Dict[Tuple[str, int, int], StorageContext] = {}
+_storage_contexts_lock = threading.Lock()
+
+
+async def get_sharded_storage_context(
+    root: str,
+    vector_store: VectorStore,
+    fs: Optional[fsspec.AbstractFileSystem] = None,
+) -> StorageContext:
+    """
+    The process-wide storage context for these inputs, revalidated against the
+    manifest instead of being rebuilt.
+    """
+    key = (root, id(vector_store), id(fs))
+    with _storage_contexts_lock:
+        storage_context = _storage_contexts.get(key)
+        if storage_context is None:
+            logger.info("Creating new storage context for %s.", root)
+            storage_context = sharded_storage_context(root, vector_store, fs=fs)
+            _storage_contexts[key] = storage_context
+    await storage_context.docstore.kvstore.arevalidate()
+    return storage_context
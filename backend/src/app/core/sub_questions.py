@@ -0,0 +1,208 @@
+"""
+sub question fan-out with a concurrency limit and a deadline
+
+the sub question engine used to query every document for every sub question at
+once and wait for the slowest. sub questions now run a few at a time, each one
+gets at most its own timeout and whatever is left of the overall deadline, and
+the answer is synthesized from the ones that finished. sub questions that time
+out or whose search fails are skipped rather than failing the answer. they
+still end their sub question event, so they show up in the message's sub
+processes, and the synthesizer is told which ones went unanswered.
+"""
+
+import asyncio
+import logging
+from typing import Any, List, Optional
+
+from llama_index.core.base.response.schema import RESPONSE_TYPE
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.query_engine import SubQuestionQueryEngine
+from llama_index.core.query_engine.sub_question_query_engine import (
+    SubQuestionAnswerPair,
+)
+from llama_index.core.question_gen.types import SubQuestion
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.core.utils import get_color_mapping, print_text
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SkippedSubQuestion(SubQuestionAnswerPair):
+    """a sub question that got no answer, and why"""
+
+    skipped_reason: str
+
+
+class BoundedSubQuestionQueryEngine(SubQuestionQueryEngine):
+    """
+    A SubQuestionQueryEngine that runs at most `max_concurrency` sub questions
+    at a time, gives each at most `sub_question_timeout` seconds and skips
+    whatever hasn't finished `deadline` seconds after the sub questions were
+    generated.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        max_concurrency: int = settings.SUB_QUESTION_CONCURRENCY,
+        sub_question_timeout: float = settings.SUB_QUESTION_TIMEOUT,
+        deadline: float = settings.SUB_QUESTION_DEADLINE,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self._max_concurrency = max_concurrency
+        self._sub_question_timeout = sub_question_timeout
+        self._deadline = deadline
+
+    @classmethod
+    def from_defaults(
+        cls,
+        *args: Any,
+        max_concurrency: int = settings.SUB_QUESTION_CONCURRENCY,
+        sub_question_timeout: float = settings.SUB_QUESTION_TIMEOUT,
+        deadline: float = settings.SUB_QUESTION_DEADLINE,
+        **kwargs: Any,
+    ) -> "BoundedSubQuestionQueryEngine":
+        engine = super().from_defaults(*args, **kwargs)
+        engine._max_concurrency = max_concurrency
+        engine._sub_question_timeout = sub_question_timeout
+        engine._deadline = deadline
+        return engine
+
+    def _construct_node(self, qa_pair: SubQuestionAnswerPair) -> NodeWithScore:
+        if isinstance(qa_pair, SkippedSubQuestion):
+            # so the answer says what it couldn't find out instead of guessing
+            return NodeWithScore(
+                node=TextNode(
+                    text=f"Sub question: {qa_pair.sub_q.sub_question}\n"
+                    f"Response: Not answered, {qa_pair.skipped_reason}."
+                )
+            )
+        return super()._construct_node(qa_pair)
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        with self.callback_manager.event(
+            CBEventType.QUERY, payload={EventPayload.QUERY_STR: query_bundle.query_str}
+        ) as query_event:
+            sub_questions = await self._question_gen.agenerate(
+                self._metadatas, query_bundle
+            )
+
+            colors = get_color_mapping([str(i) for i in range(len(sub_questions))])
+
+            if self._verbose:
+                print_text(f"Generated {len(sub_questions)} sub questions.\n")
+
+            semaphore = asyncio.Semaphore(self._max_concurrency)
+            deadline = asyncio.get_running_loop().time() + self._deadline
+
+            async def run(
+                sub_q: SubQuestion, color: str
+            ) -> Optional[SubQuestionAnswerPair]:
+                async with semaphore:
+                    return await self._aquery_subq(
+                        sub_q, color=color, deadline=deadline
+                    )
+
+            qa_pairs_all = await asyncio.gather(
+                *(
+                    run(sub_q, colors[str(ind)])
+                    for ind, sub_q in enumerate(sub_questions)
+                )
+            )
+
+            # filter out sub questions that failed
+            qa_pairs: List[SubQuestionAnswerPair] = list(filter(None, qa_pairs_all))
+            skipped = [p for p in qa_pairs if isinstance(p, SkippedSubQuestion)]
+            if skipped:
+                logger.warning(
+                    "Synthesizing from %d of %d sub questions.",
+                    len(qa_pairs) - len(skipped),
+                    len(sub_questions),
+                )
+
+            nodes = [self._construct_node(pair) for pair in qa_pairs]
+
+            source_nodes = [node for qa_pair in qa_pairs for node in qa_pair.sources]
+            response = await self._response_synthesizer.asynthesize(
+                query=query_bundle,
+                nodes=nodes,
+                additional_source_nodes=source_nodes,
+            )
+
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+
+        return response
+
+    async def _aquery_subq(
+        self,
+        sub_q: SubQuestion,
+        color: Optional[str] = None,
+        deadline: Optional[float] = None,
+    ) -> Optional[SubQuestionAnswerPair]:
+        question = sub_q.sub_question
+        timeout = self._sub_question_timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline - asyncio.get_running_loop().time())
+        try:
+            with self.callback_manager.event(
+                CBEventType.SUB_QUESTION,
+                payload={EventPayload.SUB_QUESTION: SubQuestionAnswerPair(sub_q=sub_q)},
+            ) as event:
+                query_engine = self._query_engines[sub_q.tool_name]
+
+                if self._verbose:
+                    print_text(f"[{sub_q.tool_name}] Q: {question}\n", color=color)
+
+                if timeout <= 0:
+                    qa_pair = SkippedSubQuestion(
+                        sub_q=sub_q, skipped_reason="the deadline had passed"
+                    )
+                else:
+                    try:
+                        response = await asyncio.wait_for(
+                            query_engine.aquery(question), timeout
+                        )
+                    except asyncio.TimeoutError:
+                        qa_pair = SkippedSubQuestion(
+                            sub_q=sub_q,
+                            skipped_reason=f"no answer within {timeout:.1f}s",
+                        )
+                    except Exception as e:
+                        # a throttled or failing document costs its sub question,
+                        # not the whole answer
+                        qa_pair = SkippedSubQuestion(
+                            sub_q=sub_q,
+                            skipped_reason=f"searching it failed ({type(e).__name__})",
+                        )
+                    else:
+                        response_text = str(response)
+
+                        if self._verbose:
+                            print_text(
+                                f"[{sub_q.tool_name}] A: {response_text}\n",
+                                color=color,
+                            )
+
+                        qa_pair = SubQuestionAnswerPair(
+                            sub_q=sub_q,
+                            answer=response_text,
+                            sources=response.source_nodes,
+                        )
+
+                if isinstance(qa_pair, SkippedSubQuestion):
+                    logger.warning(
+                        "[%s] Skipped %s: %s",
+                        sub_q.tool_name,
+                        question,
+                        qa_pair.skipped_reason,
+                    )
+
+                event.on_end(payload={EventPayload.SUB_QUESTION: qa_pair})
+
+            return qa_pair
+        except ValueError:
+            logger.warning(f"[{sub_q.tool_name}] Failed to run {question}")
+            return None
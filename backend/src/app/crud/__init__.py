@@ -6,6 +6,7 @@
 @Description  :
 """
 
+from .crud_document import document
 from .crud_item import item
 
 # For a new basic set of CRUD operations you could just do
@@ -0,0 +1,26 @@
+from supabase_py_async import AsyncClient
+
+from app.crud.base import CRUDBase
+from app.schemas import Document, DocumentCreate, DocumentUpdate
+from app.schemas.auth import UserIn
+
+
+class CRUDDocument(CRUDBase[Document, DocumentCreate, DocumentUpdate]):
+    async def get_many_by_owner(
+        self, db: AsyncClient, *, ids: list[str], user: UserIn
+    ) -> list[Document]:
+        """the documents among `ids` that belong to the user"""
+        if not ids:
+            return []
+        data, count = (
+            await db.table(self.model.table_name)
+            .select("*")
+            .in_("id", ids)
+            .eq("user_id", user.id)
+            .execute()
+        )
+        _, got = data
+        return [self.model(**item) for item in got]
+
+
+document = CRUDDocument(Document)
@@ -74,6 +74,8 @@ class QuestionAnswerPair(BaseMetadataObject):
     question: str
     answer: Optional[str]
     citations: Optional[List[Citation]] = None
+    # why the sub-question went unanswered, e.g. it ran past the deadline
+    skipped_reason: Optional[str] = None
 
     @classmethod
     def from_sub_question_answer_pair(
@@ -93,6 +95,7 @@ class QuestionAnswerPair(BaseMetadataObject):
             question=sub_question_answer_pair.sub_q.sub_question,
             answer=sub_question_answer_pair.answer,
             citations=citations,
+            skipped_reason=getattr(sub_question_answer_pair, "skipped_reason", None),
         )
 
     @classmethod
@@ -1,3 +1,11 @@
 from .auth import Token
+from .document import Document, DocumentCreate, DocumentInDB, DocumentUpdate
+from .ingestion import (
+    IngestionJob,
+    IngestionJobCreate,
+    IngestionJobInDB,
+    IngestionJobStatus,
+    IngestionRequest,
+)
 from .item import Item, ItemCreate, ItemInDB, ItemUpdate
 from .msg import Massage
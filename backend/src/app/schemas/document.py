@@ -0,0 +1,34 @@
+from typing import Any, ClassVar
+
+from app.schemas.base import CreateBase, InDBBase, ResponseBase, UpdateBase
+
+
+# request
+# Properties to receive on document creation
+# in
+class DocumentCreate(CreateBase):
+    url: str
+    metadata_map: dict[str, Any] | None = None
+
+
+# Properties to receive on document update
+# in
+class DocumentUpdate(UpdateBase):
+    url: str
+    metadata_map: dict[str, Any] | None = None
+
+
+# Properties to return to client
+# curd model
+# out
+class Document(ResponseBase):
+    url: str
+    metadata_map: dict[str, Any] | None = None
+
+    table_name: ClassVar[str] = "document"
+
+
+# Properties properties stored in DB
+class DocumentInDB(InDBBase):
+    url: str
+    metadata_map: dict[str, Any] | None = None
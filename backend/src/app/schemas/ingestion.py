@@ -0,0 +1,54 @@
+from datetime import datetime
+from enum import Enum
+from typing import Any
+
+from pydantic import BaseModel
+
+
+class IngestionJobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+# request
+# Properties to receive from clients, the url and metadata are read from the
+# user's documents rather than trusted from the request
+# in
+class IngestionRequest(BaseModel):
+    document_ids: list[str]
+    # schedule large ingests for later, e.g. off-peak
+    not_before: datetime | None = None
+
+
+# Properties to queue a job with
+class IngestionJobCreate(BaseModel):
+    document_id: str
+    url: str
+    metadata_map: dict[str, Any] | None = None
+    # schedule large ingests for later, e.g. off-peak
+    not_before: datetime | None = None
+
+
+# response
+# Properties to return to client
+# out
+class IngestionJob(BaseModel):
+    id: str
+    document_id: str
+    status: IngestionJobStatus
+    # what the job is currently doing, e.g. fetching, embedding
+    stage: str | None = None
+    error: str | None = None
+    attempts: int
+    created_at: datetime
+    not_before: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+
+
+# Properties stored in the job queue, what the worker ingests from
+class IngestionJobInDB(IngestionJob):
+    url: str
+    metadata_map: dict[str, Any] | None = None
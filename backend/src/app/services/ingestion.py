@@ -0,0 +1,267 @@
+"""
+background ingestion jobs
+
+jobs live in a sqlite queue on local disk, so they survive restarts and can be
+shared by the api (which enqueues) and the ingestion workers (which claim and
+run them). there is at most one queued or running job per document, enqueueing
+a document that already has one returns the existing job.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from app.core.config import settings
+from app.schemas.ingestion import (
+    IngestionJobCreate,
+    IngestionJobInDB,
+    IngestionJobStatus,
+)
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = (IngestionJobStatus.queued.value, IngestionJobStatus.running.value)
+
+
+def _now() -> float:
+    return datetime.now(timezone.utc).timestamp()
+
+
+def _to_datetime(timestamp: float | None) -> datetime | None:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+class IngestionJobStore:
+    def __init__(self, path: str = settings.INGESTION_QUEUE_PATH):
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                document_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                metadata_map TEXT,
+                status TEXT NOT NULL,
+                stage TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                not_before REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_document
+                ON jobs (document_id) WHERE status IN {ACTIVE_STATUSES};
+            CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, not_before);
+            """
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _to_job(row: sqlite3.Row) -> IngestionJobInDB:
+        return IngestionJobInDB(
+            id=row["id"],
+            document_id=row["document_id"],
+            url=row["url"],
+            metadata_map=json.loads(row["metadata_map"] or "null"),
+            status=row["status"],
+            stage=row["stage"],
+            error=row["error"],
+            attempts=row["attempts"],
+            created_at=_to_datetime(row["created_at"]),
+            not_before=_to_datetime(row["not_before"]),
+            started_at=_to_datetime(row["started_at"]),
+            finished_at=_to_datetime(row["finished_at"]),
+        )
+
+    def _active_job(self, document_id: str) -> IngestionJobInDB | None:
+        row = self._conn.execute(
+            f"SELECT * FROM jobs WHERE document_id = ? AND status IN {ACTIVE_STATUSES}",
+            (document_id,),
+        ).fetchone()
+        return self._to_job(row) if row else None
+
+    def enqueue(self, job_in: IngestionJobCreate) -> IngestionJobInDB:
+        """queue a document, or return the job already queued or running for it"""
+        now = _now()
+        not_before = job_in.not_before.timestamp() if job_in.not_before else now
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT INTO jobs (id, document_id, url, metadata_map, status, "
+                    "created_at, not_before) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        str(uuid.uuid4()),
+                        job_in.document_id,
+                        job_in.url,
+                        json.dumps(job_in.metadata_map, default=str),
+                        IngestionJobStatus.queued.value,
+                        now,
+                        not_before,
+                    ),
+                )
+                self._conn.commit()
+            except sqlite3.IntegrityError:
+                logger.debug("Ingestion already queued for %s", job_in.document_id)
+            return self._active_job(job_in.document_id)
+
+    def get(self, id: str) -> IngestionJobInDB | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE id = ?", (id,)
+            ).fetchone()
+        return self._to_job(row) if row else None
+
+    def get_by_document(self, document_id: str) -> list[IngestionJobInDB]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM jobs WHERE document_id = ? ORDER BY created_at DESC",
+                (document_id,),
+            ).fetchall()
+        return [self._to_job(row) for row in rows]
+
+    def claim(self) -> IngestionJobInDB | None:
+        """atomically take the next due job off the queue"""
+        now = _now()
+        with self._lock:
+            row = self._conn.execute(
+                "UPDATE jobs SET status = ?, stage = NULL, started_at = ?, "
+                "attempts = attempts + 1 WHERE id = ("
+                "SELECT id FROM jobs WHERE status = ? AND not_before <= ? "
+                "ORDER BY not_before, created_at LIMIT 1) RETURNING *",
+                (
+                    IngestionJobStatus.running.value,
+                    now,
+                    IngestionJobStatus.queued.value,
+                    now,
+                ),
+            ).fetchone()
+            self._conn.commit()
+        return self._to_job(row) if row else None
+
+    def set_stage(self, id: str, stage: str) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET stage = ? WHERE id = ?", (stage, id))
+            self._conn.commit()
+
+    def succeed(self, id: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, stage = NULL, error = NULL, "
+                "finished_at = ? WHERE id = ?",
+                (IngestionJobStatus.succeeded.value, _now(), id),
+            )
+            self._conn.commit()
+
+    def fail(self, id: str, error: str, retry_after: timedelta | None = None) -> None:
+        """mark a job failed, or put it back on the queue if `retry_after` is set"""
+        with self._lock:
+            if retry_after is None:
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, finished_at = ? "
+                    "WHERE id = ?",
+                    (IngestionJobStatus.failed.value, error, _now(), id),
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, not_before = ? "
+                    "WHERE id = ?",
+                    (
+                        IngestionJobStatus.queued.value,
+                        error,
+                        _now() + retry_after.total_seconds(),
+                        id,
+                    ),
+                )
+            self._conn.commit()
+
+    def requeue_stale(self, timeout: timedelta) -> int:
+        """put jobs whose worker died mid-run back on the queue"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, stage = NULL "
+                "WHERE status = ? AND started_at < ?",
+                (
+                    IngestionJobStatus.queued.value,
+                    IngestionJobStatus.running.value,
+                    _now() - timeout.total_seconds(),
+                ),
+            )
+            self._conn.commit()
+        return cursor.rowcount
+
+
+_store: IngestionJobStore | None = None
+
+
+def get_ingestion_store() -> IngestionJobStore:
+    global _store
+    if _store is None:
+        _store = IngestionJobStore()
+    return _store
+
+
+JobHandler = Callable[[IngestionJobInDB, Callable[[str], None]], Awaitable[None]]
+
+
+class IngestionWorkerPool:
+    """
+    runs `handler` for queued jobs on `concurrency` workers. the handler gets
+    the job and a callback to report which stage it is in.
+    """
+
+    def __init__(
+        self,
+        store: IngestionJobStore,
+        handler: JobHandler,
+        concurrency: int = settings.INGESTION_WORKERS,
+        max_attempts: int = 3,
+        poll_interval: float = 1.0,
+    ):
+        self.store = store
+        self.handler = handler
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+
+    async def _run_job(self, job: IngestionJobInDB) -> None:
+        logger.info("Ingesting document %s (job %s)", job.document_id, job.id)
+        try:
+            await self.handler(job, lambda stage: self.store.set_stage(job.id, stage))
+        except Exception as e:
+            logger.error("Ingestion job %s failed", job.id, exc_info=True)
+            retry_after = (
+                timedelta(minutes=2**job.attempts)
+                if job.attempts < self.max_attempts
+                else None
+            )
+            self.store.fail(job.id, repr(e), retry_after=retry_after)
+        else:
+            self.store.succeed(job.id)
+
+    async def _worker(self) -> None:
+        while True:
+            job = self.store.claim()
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            await self._run_job(job)
+
+    async def run(self) -> None:
+        requeued = self.store.requeue_stale(timedelta(hours=1))
+        if requeued:
+            logger.warning("Requeued %d stale ingestion jobs", requeued)
+        await asyncio.gather(*(self._worker() for _ in range(self.concurrency)))
@@ -0,0 +1,34 @@
+"""
+ingestion worker process
+
+runs the background ingestion jobs queued by the api and the chat path, kept out
+of the api process so embedding never competes with request handling.
+
+    poetry run ingestion-worker
+"""
+
+import asyncio
+from collections.abc import Callable
+
+from app.core.rag_engine import get_tool_service_context, ingest_document
+from app.core.s3 import get_s3_fs
+from app.schema import Document as DocumentSchema
+from app.schemas.ingestion import IngestionJobInDB
+from app.services.ingestion import IngestionWorkerPool, get_ingestion_store
+
+
+async def run_job(job: IngestionJobInDB, report: Callable[[str], None]) -> None:
+    document = DocumentSchema(
+        id=job.document_id, url=job.url, metadata_map=job.metadata_map
+    )
+    service_context = get_tool_service_context([])
+    await ingest_document(service_context, document, fs=get_s3_fs(), report=report)
+
+
+def main() -> None:
+    pool = IngestionWorkerPool(get_ingestion_store(), run_job)
+    asyncio.run(pool.run())
+
+
+if __name__ == "__main__":
+    main()
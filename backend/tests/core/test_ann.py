@@ -0,0 +1,118 @@
+from types import SimpleNamespace
+
+import numpy as np
+from llama_index.core.schema import TextNode
+
+from app.core.ann import ANNCache, DocumentMatrix, IVFIndex, load_document_embeddings
+
+
+def random_index(n: int, dim: int = 32, seed: int = 0) -> IVFIndex:
+    rng = np.random.default_rng(seed)
+    nodes = [TextNode(text=f"chunk {i}") for i in range(n)]
+    return IVFIndex(nodes, rng.normal(size=(n, dim)))
+
+
+def test_flat_search_is_exact() -> None:
+    index = random_index(100)
+    query = index.vectors[7] + 0.01
+    positions, scores = index.search(query, 3)
+    expected = np.argsort(-(index.vectors @ (query / np.linalg.norm(query))))[:3]
+    assert positions.tolist() == expected.tolist()
+    assert scores[0] >= scores[1] >= scores[2]
+
+
+def test_ivf_search_finds_near_duplicates() -> None:
+    index = random_index(5000)
+    assert index.centroids is not None
+    hits = sum(index.search(index.vectors[i], 1)[0][0] == i for i in range(0, 5000, 50))
+    assert hits == 100
+
+
+def test_query_returns_nodes() -> None:
+    index = random_index(10)
+    result = index.query(index.vectors[3], 2)
+    assert result.nodes[0].get_content() == "chunk 3"
+    assert result.ids[0] == index.nodes[3].node_id
+
+
+def flush(cache: ANNCache) -> None:
+    cache._executor.submit(lambda: None).result()
+
+
+def test_loads_documents_once_hot() -> None:
+    cache = ANNCache(hot_queries=2)
+    index = random_index(10)
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return index
+
+    cache.record_miss("doc", 1, loader)
+    flush(cache)
+    assert cache.get("doc", 1) is None and not loads
+    cache.record_miss("doc", 1, loader)
+    flush(cache)
+    assert cache.get("doc", 1) is index and len(loads) == 1
+    # re-ingesting the document moves it to a new version
+    assert cache.get("doc", 2) is None
+
+
+def test_unloadable_documents_are_not_retried() -> None:
+    cache = ANNCache(hot_queries=1)
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return None
+
+    for _ in range(3):
+        cache.record_miss("doc", 1, loader)
+        flush(cache)
+    assert len(loads) == 1
+
+
+def test_query_counts_are_bounded() -> None:
+    cache = ANNCache(hot_queries=10, tracked_documents=2)
+    for doc_id in ("a", "b", "c"):
+        cache.record_miss(doc_id, 1, lambda: None)
+    assert len(cache._queries) == 2 and ("a", 1) not in cache._queries
+
+
+def test_evicts_over_budget() -> None:
+    a, b = random_index(10, seed=1), random_index(10, seed=2)
+    cache = ANNCache(max_bytes=a.nbytes + b.nbytes - 1)
+    cache.put("a", 1, a)
+    cache.put("b", 1, b)
+    assert cache.get("a", 1) is None and cache.get("b", 1) is b
+
+
+def test_matrix_searches_within_one_document() -> None:
+    rng = np.random.default_rng(0)
+    documents = {
+        doc_id: (
+            [TextNode(text=f"{doc_id} {i}") for i in range(20)],
+            rng.normal(size=(20, 16)),
+        )
+        for doc_id in ("a", "b")
+    }
+    matrix = DocumentMatrix(documents)
+    assert matrix.ranges == {"a": (0, 20), "b": (20, 40)}
+    query = documents["b"][1][5]
+    assert matrix.query(query, 1, "b").nodes[0].get_content() == "b 5"
+    hits = matrix.query(query, 3, "a")
+    assert all(node.get_content().startswith("a ") for node in hits.nodes)
+    assert hits.similarities == sorted(hits.similarities, reverse=True)
+    assert matrix.query(query, 1).nodes[0].get_content() == "b 5"
+
+
+def test_loaded_nodes_drop_their_vectors() -> None:
+    nodes = [TextNode(text=f"chunk {i}", embedding=[float(i), 1.0]) for i in range(3)]
+    index = SimpleNamespace(
+        vector_store=SimpleNamespace(get_nodes=lambda filters: nodes)
+    )
+    loaded, embeddings = load_document_embeddings("doc", index, "model")
+    assert embeddings.tolist() == [[0.0, 1.0], [1.0, 1.0], [2.0, 1.0]]
+    assert all(node.embedding is None for node in loaded)
+    matrix = DocumentMatrix({"doc": (loaded, embeddings)})
+    assert matrix.nbytes > matrix.store.nbytes
@@ -0,0 +1,36 @@
+from app.core.answer_cache import AnswerCache, CachedAnswer, document_set_key
+
+DOCS = document_set_key({"doc-b": 2, "doc-a": 1})
+
+
+def test_hits_similar_questions_about_the_same_documents() -> None:
+    cache = AnswerCache(threshold=0.95, ttl=60)
+    answer = CachedAnswer(content="It starts at 7pm.")
+    cache.put(DOCS, [1.0, 0.0, 0.0], answer)
+    assert (
+        cache.get(document_set_key({"doc-a": 1, "doc-b": 2}), [0.99, 0.05, 0]) is answer
+    )
+    assert cache.get(DOCS, [0.0, 1.0, 0.0]) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_reingested_documents_miss() -> None:
+    cache = AnswerCache(threshold=0.95, ttl=60)
+    cache.put(DOCS, [1.0, 0.0], CachedAnswer(content="old"))
+    assert cache.get(document_set_key({"doc-a": 2, "doc-b": 2}), [1.0, 0.0]) is None
+
+
+def test_entries_expire() -> None:
+    cache = AnswerCache(threshold=0.95, ttl=0)
+    cache.put(DOCS, [1.0, 0.0], CachedAnswer(content="stale"))
+    assert cache.get(DOCS, [1.0, 0.0]) is None
+    assert DOCS not in cache._by_documents
+
+
+def test_evicted_ids_are_forgotten() -> None:
+    cache = AnswerCache(threshold=0.95, ttl=60)
+    cache.put(DOCS, [1.0, 0.0], CachedAnswer(content="evicted"))
+    cache.put(DOCS, [0.0, 1.0], CachedAnswer(content="kept"))
+    cache._entries.pop(next(iter(cache._by_documents[DOCS])))
+    assert cache.get(DOCS, [0.0, 1.0]).content == "kept"
+    assert len(cache._by_documents[DOCS]) == 1
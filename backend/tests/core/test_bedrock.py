@@ -0,0 +1,30 @@
+from llama_index.core.callbacks import CallbackManager
+
+from app.core.bedrock import BEDROCK_TOOL_LLM_NAME, get_embed_model, get_llm
+from app.core.rag_engine import get_tool_service_context
+
+
+def test_requests_share_clients_but_not_state() -> None:
+    first_manager, second_manager = CallbackManager([]), CallbackManager([])
+    first = get_llm("model", "us-east-1", first_manager)
+    second = get_llm("model", "us-east-1", second_manager)
+    assert first._client is second._client
+    assert first.callback_manager is first_manager
+    assert second.callback_manager is second_manager
+    first.system_prompt = "per request"
+    assert second.system_prompt is None
+    assert get_llm("model", "ap-southeast-1")._client is not first._client
+
+
+def test_embed_models_share_the_scheduler() -> None:
+    first, second = get_embed_model(), get_embed_model()
+    assert first is not second
+    assert first.embed_model.scheduler is second.embed_model.scheduler
+
+
+def test_copies_work_in_a_service_context() -> None:
+    service_context = get_tool_service_context([])
+    assert service_context.llm.model == BEDROCK_TOOL_LLM_NAME
+    assert service_context.embed_model.callback_manager is (
+        service_context.callback_manager
+    )
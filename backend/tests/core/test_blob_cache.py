@@ -0,0 +1,46 @@
+import hashlib
+import io
+import os
+from pathlib import Path
+
+from app.core.blob_cache import BlobCache
+from app.core.fetcher import FetchedDocument
+
+
+def fetched(content: bytes, etag: str = '"v1"') -> FetchedDocument:
+    return FetchedDocument(
+        content=io.BytesIO(content),
+        etag=etag,
+        content_hash=hashlib.sha256(content).hexdigest(),
+    )
+
+
+def test_put_and_open(tmp_path: Path) -> None:
+    cache = BlobCache(root=str(tmp_path))
+    assert cache.get("doc") is None
+    doc = fetched(b"pdf")
+    cache.put("doc", doc)
+    # the buffer is left readable for the caller
+    assert doc.content.read() == b"pdf"
+    ref = cache.get("doc")
+    assert ref is not None and ref.etag == '"v1"'
+    with cache.open(ref).content as content:
+        assert content.read() == b"pdf"
+
+
+def test_skips_documents_without_etag(tmp_path: Path) -> None:
+    cache = BlobCache(root=str(tmp_path))
+    cache.put("doc", fetched(b"pdf", etag=None))
+    assert cache.get("doc") is None
+
+
+def test_evicts_least_recently_used(tmp_path: Path) -> None:
+    cache = BlobCache(root=str(tmp_path), max_bytes=8)
+    cache.put("a", fetched(b"aaaa"))
+    cache.put("b", fetched(b"bbbb"))
+    ref_a = cache.get("a")
+    os.utime(cache._blob_path(cache.get("b").content_hash), (0, 0))
+    cache.put("c", fetched(b"cccc"))
+    assert cache.get("a") == ref_a
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
@@ -0,0 +1,167 @@
+import asyncio
+from typing import List
+from uuid import uuid4
+
+import fsspec
+import pytest
+from llama_index.core.agent import FunctionCallingAgentWorker
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.llms import ChatMessage
+
+from app.core import rag_engine
+from app.core.bedrock import BEDROCK_TOOL_LLM_NAME, get_llm
+from app.core.chat_engine_cache import (
+    CachedChatEngine,
+    ChatEngineCache,
+    conversation_lock,
+)
+from app.core.chat_memory import ChatMemoryStore
+from app.models.db import MessageRoleEnum, MessageStatusEnum
+from app.schema import Conversation, Message
+
+CONVERSATION_ID = uuid4()
+
+
+def message(
+    content: str,
+    role: MessageRoleEnum = MessageRoleEnum.user,
+    status: MessageStatusEnum = MessageStatusEnum.SUCCESS,
+) -> Message:
+    return Message(
+        id=uuid4(),
+        conversation_id=CONVERSATION_ID,
+        content=content,
+        role=role,
+        status=status,
+        sub_processes=[],
+    )
+
+
+class CountingConverter:
+    def __init__(self):
+        self.converted = 0
+
+    def __call__(self, messages: List[Message]) -> List[ChatMessage]:
+        self.converted += len(messages)
+        return rag_engine.get_chat_history(messages)
+
+
+class Handler(BaseCallbackHandler):
+    def __init__(self):
+        super().__init__([], [])
+
+    def on_event_start(self, *args, **kwargs):
+        return ""
+
+    def on_event_end(self, *args, **kwargs):
+        pass
+
+    def start_trace(self, trace_id=None):
+        pass
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        pass
+
+
+def test_only_new_messages_are_converted() -> None:
+    cached = CachedChatEngine(engine=None, callback_manager=CallbackManager([]))
+    convert = CountingConverter()
+    messages = [message("hi"), message("hello", MessageRoleEnum.assistant)]
+    assert len(cached.sync_history(messages, convert)) == 2
+
+    messages += [message("when does it start?")]
+    history = cached.sync_history(messages, convert)
+    assert [m.content for m in history] == ["hi", "hello", "when does it start?"]
+    assert convert.converted == 3
+
+
+def test_pending_messages_are_converted_until_settled() -> None:
+    cached = CachedChatEngine(engine=None, callback_manager=CallbackManager([]))
+    convert = CountingConverter()
+    first = message("hi")
+    answer = message("", MessageRoleEnum.assistant, MessageStatusEnum.PENDING)
+    assert len(cached.sync_history([first, answer], convert)) == 1
+    assert cached.settled == 1
+
+    answer = answer.model_copy(update={"content": "hello", "status": "SUCCESS"})
+    history = cached.sync_history([first, answer], convert)
+    assert [m.content for m in history] == ["hi", "hello"]
+    assert cached.settled == 2 and convert.converted == 3
+
+
+def test_edited_history_is_converted_again() -> None:
+    cached = CachedChatEngine(engine=None, callback_manager=CallbackManager([]))
+    convert = CountingConverter()
+    first, second = message("hi"), message("hello", MessageRoleEnum.assistant)
+    cached.sync_history([first, second], convert)
+    history = cached.sync_history([first], convert)
+    assert [m.content for m in history] == ["hi"]
+    assert convert.converted == 3
+
+
+def test_engines_expire_when_idle() -> None:
+    cache = ChatEngineCache(maxsize=2, ttl=0)
+    key = ("agent", "conversation", (), ())
+    cache.put(key, CachedChatEngine(engine=None, callback_manager=CallbackManager([])))
+    assert cache.get(key) is None
+    assert cache.stats()["misses"] == 1
+
+
+@pytest.mark.anyio
+async def test_agent_is_reused_with_the_new_handler(monkeypatch) -> None:
+    built = []
+
+    async def build_chat_engine(callback_handler, conversation, documents):
+        callback_manager = CallbackManager([callback_handler])
+        agent = FunctionCallingAgentWorker.from_tools(
+            tools=[],
+            llm=get_llm(BEDROCK_TOOL_LLM_NAME, "us-east-1", callback_manager),
+            prefix_messages=[],
+            callback_manager=callback_manager,
+        ).as_agent()
+        built.append(agent)
+        return CachedChatEngine(agent, callback_manager)
+
+    async def get_document_versions(documents, fs=None):
+        return {}
+
+    monkeypatch.setattr(rag_engine, "build_chat_engine", build_chat_engine)
+    monkeypatch.setattr(rag_engine, "get_document_versions", get_document_versions)
+    monkeypatch.setattr(rag_engine, "get_s3_fs", lambda: None)
+    monkeypatch.setattr(
+        "app.core.chat_engine_cache._chat_engine_cache", ChatEngineCache()
+    )
+    monkeypatch.setattr(
+        "app.core.chat_memory._chat_memory_store",
+        ChatMemoryStore(fsspec.filesystem("memory"), root="engine-cache"),
+    )
+
+    conversation = Conversation(id=uuid4(), messages=[message("hi")], documents=[])
+    first_handler, second_handler = Handler(), Handler()
+    first = await rag_engine.get_chat_engine(first_handler, conversation)
+    first.memory.put(ChatMessage(content="previous turn"))
+
+    conversation.messages.append(message("hello", MessageRoleEnum.assistant))
+    second = await rag_engine.get_chat_engine(second_handler, conversation)
+    assert second is first and len(built) == 1
+    assert second.callback_manager.handlers == [second_handler]
+    assert second.memory.get_all() == []
+    prefix_messages = second.agent_worker.prefix_messages
+    assert prefix_messages[0].role == "system"
+    assert [m.content for m in prefix_messages[1:]] == ["hi", "hello"]
+
+
+@pytest.mark.anyio
+async def test_turns_of_a_conversation_take_turns() -> None:
+    order = []
+
+    async def turn(name: str) -> None:
+        async with conversation_lock("conversation"):
+            order.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            order.append(f"{name} end")
+
+    await asyncio.gather(turn("first"), turn("second"))
+    assert order == ["first start", "first end", "second start", "second end"]
+    assert conversation_lock("other") is not conversation_lock("conversation")
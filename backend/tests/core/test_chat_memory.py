@@ -0,0 +1,86 @@
+import asyncio
+from typing import List, Sequence
+
+import fsspec
+import pytest
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from app.core.chat_memory import ChatMemoryStore, count_tokens
+
+
+def turns(n: int) -> List[ChatMessage]:
+    return [
+        ChatMessage(
+            role=MessageRole.USER if i % 2 == 0 else MessageRole.ASSISTANT,
+            content=f"message {i} " + "word " * 40,
+        )
+        for i in range(n)
+    ]
+
+
+class Summarizer:
+    def __init__(self):
+        self.folded: List[str] = []
+
+    async def __call__(self, summary: str, messages: Sequence[ChatMessage]) -> str:
+        self.folded += [m.content.split()[1] for m in messages]
+        return f"{len(self.folded)} messages"
+
+
+def store(summarizer: Summarizer, root: str) -> ChatMemoryStore:
+    return ChatMemoryStore(
+        fsspec.filesystem("memory"),
+        root=root,
+        token_budget=200,
+        summarizer=summarizer,
+    )
+
+
+async def settle(memory_store: ChatMemoryStore) -> None:
+    await asyncio.gather(*memory_store._summarizing.values())
+
+
+@pytest.mark.anyio
+async def test_short_conversations_are_kept_verbatim() -> None:
+    summarizer = Summarizer()
+    memory_store = store(summarizer, "short")
+    history = turns(3)
+    assert await memory_store.pack("conversation", history) == history
+    assert not memory_store._summarizing and not summarizer.folded
+
+
+@pytest.mark.anyio
+async def test_older_messages_are_folded_into_a_summary() -> None:
+    summarizer = Summarizer()
+    memory_store = store(summarizer, "long")
+    history = turns(12)
+    # nothing is dropped before the summary covering it is saved
+    assert await memory_store.pack("conversation", history) == history
+    await settle(memory_store)
+    assert summarizer.folded == [str(i) for i in range(len(summarizer.folded))]
+
+    # a new worker reads the summary back from storage
+    memory_store = store(summarizer, "long")
+    history += turns(2)
+    packed = await memory_store.pack("conversation", history)
+    assert packed[0].role == MessageRole.SYSTEM
+    assert f"{len(summarizer.folded)} messages" in packed[0].content
+    assert packed[1].role == MessageRole.USER and packed[-1] is history[-1]
+    assert sum(count_tokens(m.content) for m in packed) <= 200
+
+
+@pytest.mark.anyio
+async def test_a_changed_history_is_summarized_again() -> None:
+    summarizer = Summarizer()
+    memory_store = store(summarizer, "changed")
+    await memory_store.pack("conversation", turns(12))
+    await settle(memory_store)
+
+    summarizer.folded.clear()
+    history = [ChatMessage(role=MessageRole.USER, content="message x")] + turns(11)
+    packed = await memory_store.pack("conversation", history)
+    assert packed[0].role != MessageRole.SYSTEM
+    await settle(memory_store)
+    assert summarizer.folded[0] == "x"
+    memory = await memory_store.get("conversation")
+    assert memory.summarized == len(summarizer.folded)
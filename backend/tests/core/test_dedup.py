@@ -0,0 +1,62 @@
+from llama_index.core.schema import TextNode
+
+from app.chat.constants import DB_DOC_ID_KEY
+from app.core.dedup import DUPLICATE_SOURCES_KEY, MinHashDeduplicator, deduplicate_nodes
+
+BOILERPLATE = (
+    "The venue is fully accessible and offers step free access from the main "
+    "entrance. Tickets are non refundable except where the event is cancelled. "
+    "Bags may be searched on entry and glass bottles are not permitted inside. "
+    "Our sponsors make this festival possible, thank you for your support."
+)
+
+
+def node(text: str, doc_id: str, page: int) -> TextNode:
+    return TextNode(text=text, metadata={DB_DOC_ID_KEY: doc_id, "page_label": page})
+
+
+def test_groups_near_duplicates() -> None:
+    groups = MinHashDeduplicator(threshold=0.8).groups(
+        [
+            BOILERPLATE,
+            "A jazz night with three local bands and a late bar.",
+            BOILERPLATE.replace("thank you", "thanks"),
+            BOILERPLATE,
+        ]
+    )
+    assert groups == [[0, 2, 3], [1]]
+
+
+def test_keeps_distinct_texts() -> None:
+    texts = [f"Event number {i} takes place on day {i} at stage {i}." for i in range(5)]
+    assert MinHashDeduplicator().groups(texts) == [[i] for i in range(5)]
+
+
+def test_collapsed_node_references_every_source() -> None:
+    nodes = [
+        node(BOILERPLATE, "doc-a", 2),
+        node("Doors open at seven, the headliner is on at nine.", "doc-a", 1),
+        node(BOILERPLATE, "doc-a", 4),
+    ]
+    kept = deduplicate_nodes(nodes, threshold=0.8)
+    assert [n.node_id for n in kept] == [nodes[0].node_id, nodes[1].node_id]
+    assert kept[0].metadata[DUPLICATE_SOURCES_KEY] == [
+        {"document_id": "doc-a", "page_label": 2},
+        {"document_id": "doc-a", "page_label": 4},
+    ]
+    # the back-references don't change what gets embedded
+    assert DUPLICATE_SOURCES_KEY not in kept[0].get_content(metadata_mode="embed")
+    assert DUPLICATE_SOURCES_KEY not in kept[1].metadata
+
+
+def test_other_documents_keep_their_copy() -> None:
+    # retrieval filters by document, each one needs its own
+    nodes = [node(BOILERPLATE, "doc-a", 1), node(BOILERPLATE, "doc-b", 3)]
+    kept = deduplicate_nodes(nodes, threshold=0.8)
+    assert kept == nodes
+    assert not any(DUPLICATE_SOURCES_KEY in n.metadata for n in kept)
+
+
+def test_threshold_of_one_disables() -> None:
+    nodes = [node(BOILERPLATE, "doc-a", 1), node(BOILERPLATE, "doc-b", 1)]
+    assert deduplicate_nodes(nodes, threshold=1) == nodes
@@ -0,0 +1,77 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from app.core.embedding_cache import EmbeddingCache, QueryEmbeddingCache
+
+
+def test_get_many_counts_hits_and_misses() -> None:
+    cache = EmbeddingCache(path=":memory:")
+    cache.put_many("model", ["a", "b"], [[1.0, 2.0], [3.0, 4.0]])
+    assert cache.get_many("model", ["a", "c", "b"]) == [[1.0, 2.0], None, [3.0, 4.0]]
+    # keyed by model as well as text
+    assert cache.get_many("other-model", ["a"]) == [None]
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+    assert stats["entries"] == 2
+
+
+def test_evicts_least_recently_used() -> None:
+    # room for two 2-dim float32 embeddings
+    cache = EmbeddingCache(path=":memory:", max_bytes=16)
+    cache.put_many("model", ["a"], [[1.0, 1.0]])
+    cache.put_many("model", ["b"], [[2.0, 2.0]])
+    cache.get_many("model", ["a"])
+    cache.put_many("model", ["c"], [[3.0, 3.0]])
+    assert cache.get_many("model", ["a", "b", "c"]) == [[1.0, 1.0], None, [3.0, 3.0]]
+
+
+@pytest.mark.anyio
+async def test_query_cache_normalizes_and_shares_concurrent_misses() -> None:
+    cache = QueryEmbeddingCache(maxsize=10, ttl=60)
+    calls = []
+
+    async def embed(query: str) -> List[float]:
+        calls.append(query)
+        await asyncio.sleep(0.01)
+        return [1.0, 0.0]
+
+    first, second = await asyncio.gather(
+        cache.aget_or_embed("model", "When is the  festival?", embed),
+        cache.aget_or_embed("model", "when is the festival? ", embed),
+    )
+    assert first == second == [1.0, 0.0] and len(calls) == 1
+    assert cache.get("model", "WHEN IS THE FESTIVAL?") == [1.0, 0.0]
+    assert cache.get("other-model", "when is the festival?") is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_size_is_kept_without_scanning() -> None:
+    cache = EmbeddingCache(path=":memory:", max_bytes=24)
+    cache.put_many("model", ["a", "b"], [[1.0, 1.0], [2.0, 2.0]])
+    # replacing an entry counts its new size only
+    cache.put_many("model", ["a"], [[1.0, 1.0, 1.0]])
+    assert cache.size() == 20
+    cache.put_many("model", ["c"], [[3.0, 3.0]])
+    (stored,) = cache._conn.execute(
+        "SELECT SUM(LENGTH(embedding)) FROM embeddings"
+    ).fetchone()
+    assert cache.size() == stored <= 24
+
+
+def test_hits_are_written_in_batches(tmp_path) -> None:
+    path = str(tmp_path / "embeddings.sqlite3")
+    cache = EmbeddingCache(path=path, touch_interval=60)
+    cache.put_many("model", ["a"], [[1.0, 1.0]])
+    writes = cache._conn.total_changes
+    for _ in range(3):
+        cache.get_many("model", ["a"])
+    assert cache._conn.total_changes == writes
+    (before,) = cache._conn.execute("SELECT last_access FROM embeddings").fetchone()
+    cache.close()
+
+    reopened = EmbeddingCache(path=path)
+    (after,) = reopened._conn.execute("SELECT last_access FROM embeddings").fetchone()
+    assert after > before
@@ -0,0 +1,42 @@
+from typing import List
+
+from botocore.exceptions import ClientError
+from llama_index.core.embeddings import MockEmbedding
+
+from app.core.embedding_scheduler import EmbeddingScheduler, ScheduledEmbedding
+
+
+class FlakyEmbedding(MockEmbedding):
+    throttles: int = 0
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        if self.throttles:
+            self.throttles -= 1
+            raise ClientError({"Error": {"Code": "ThrottlingException"}}, "InvokeModel")
+        return super()._get_text_embeddings(texts)
+
+
+def test_pack_respects_batch_size_and_tokens() -> None:
+    scheduler = EmbeddingScheduler(
+        MockEmbedding(embed_dim=2, embed_batch_size=3), max_batch_tokens=100
+    )
+    assert [len(batch) for batch in scheduler.pack(["a"] * 7)] == [3, 3, 1]
+    # ~50 tokens each, so only one fits per batch
+    assert len(scheduler.pack(["x" * 200] * 3)) == 3
+
+
+def test_embed_retries_throttling() -> None:
+    embed_model = FlakyEmbedding(embed_dim=2, embed_batch_size=2, throttles=2)
+    scheduler = EmbeddingScheduler(embed_model, backoff=0)
+    embeddings = scheduler.embed(["a", "b", "c"])
+    assert len(embeddings) == 3
+    assert scheduler.bucket.rate < scheduler.bucket.max_rate
+    assert scheduler.stats()["chunks"] == 3
+
+
+def test_embed_models_share_the_process_scheduler() -> None:
+    first = ScheduledEmbedding(MockEmbedding(embed_dim=2, model_name="shared"))
+    second = ScheduledEmbedding(MockEmbedding(embed_dim=2, model_name="shared"))
+    other = ScheduledEmbedding(MockEmbedding(embed_dim=2, model_name="other"))
+    assert first.scheduler is second.scheduler
+    assert other.scheduler is not first.scheduler
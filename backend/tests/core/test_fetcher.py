@@ -0,0 +1,109 @@
+import hashlib
+
+import httpx
+import pytest
+
+from app.core.fetcher import DocumentFetcher, DocumentFetchError
+
+
+def make_fetcher(handler, **kwargs) -> DocumentFetcher:
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return DocumentFetcher(client=client, backoff=0, **kwargs)
+
+
+@pytest.mark.anyio
+async def test_fetch_many() -> None:
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=request.url.path.encode())
+
+    fetcher = make_fetcher(handler)
+    fetched = await fetcher.fetch_many(
+        {"a": "https://bucket/a.pdf", "b": "https://bucket/b.pdf"}
+    )
+    assert {key: doc.content.read() for key, doc in fetched.items()} == {
+        "a": b"/a.pdf",
+        "b": b"/b.pdf",
+    }
+    await fetcher.aclose()
+
+
+@pytest.mark.anyio
+async def test_fetch_retries_transient_errors() -> None:
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        if len(calls) < 3:
+            return httpx.Response(503)
+        return httpx.Response(200, content=b"pdf")
+
+    fetcher = make_fetcher(handler, max_retries=3)
+    fetched = await fetcher.fetch("https://bucket/a.pdf")
+    assert fetched.content.read() == b"pdf"
+    assert len(calls) == 3
+    await fetcher.aclose()
+
+
+@pytest.mark.anyio
+async def test_backoff_frees_the_slot_for_other_fetches() -> None:
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.path)
+        if calls == ["/a.pdf"]:
+            return httpx.Response(503)
+        return httpx.Response(200, content=b"pdf")
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    fetcher = DocumentFetcher(client=client, backoff=0.2, max_concurrency=1)
+    await fetcher.fetch_many({"a": "https://bucket/a.pdf", "b": "https://bucket/b.pdf"})
+    # b is downloaded while a waits to retry
+    assert calls == ["/a.pdf", "/b.pdf", "/a.pdf"]
+    await fetcher.aclose()
+
+
+@pytest.mark.anyio
+async def test_fetch_does_not_retry_client_errors() -> None:
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        return httpx.Response(403)
+
+    fetcher = make_fetcher(handler, max_retries=3)
+    with pytest.raises(DocumentFetchError):
+        await fetcher.fetch("https://bucket/a.pdf")
+    assert len(calls) == 1
+    await fetcher.aclose()
+
+
+@pytest.mark.anyio
+async def test_fetch_spools_large_documents_to_disk() -> None:
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=b"x" * 1024)
+
+    fetcher = make_fetcher(handler, spool_max_size=512)
+    fetched = await fetcher.fetch("https://bucket/a.pdf")
+    assert fetched.content._rolled  # type: ignore[attr-defined]
+    assert fetched.content.read() == b"x" * 1024
+
+    fetcher = make_fetcher(handler, spool_max_size=4096)
+    fetched = await fetcher.fetch("https://bucket/a.pdf")
+    assert not fetched.content._rolled  # type: ignore[attr-defined]
+    await fetcher.aclose()
+
+
+@pytest.mark.anyio
+async def test_fetch_revalidates_with_etag() -> None:
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.headers.get("If-None-Match") == '"v1"':
+            return httpx.Response(304)
+        return httpx.Response(200, content=b"pdf", headers={"ETag": '"v1"'})
+
+    fetcher = make_fetcher(handler)
+    fetched = await fetcher.fetch("https://bucket/a.pdf")
+    assert fetched.etag == '"v1"'
+    assert fetched.content_hash == hashlib.sha256(b"pdf").hexdigest()
+    assert await fetcher.fetch("https://bucket/a.pdf", etag='"v1"') is None
+    assert await fetcher.fetch("https://bucket/a.pdf", etag='"v0"') is not None
+    await fetcher.aclose()
@@ -0,0 +1,69 @@
+from pathlib import Path
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from app.core.hybrid import (
+    RRF_SCORE_KEY,
+    BM25Index,
+    HybridRetriever,
+    get_bm25_index,
+    reciprocal_rank_fusion,
+    save_bm25_index,
+)
+from app.core.sharded_store import ShardedDocumentStore, ShardedKVStore
+
+CHUNKS = {
+    "n0": "Doors open at seven and the bar stays open late.",
+    "n1": "The Harbour Lights festival is held at Pier 39 on 14 June.",
+    "n2": "Tickets are available online and at the door.",
+}
+
+
+class StaticRetriever(BaseRetriever):
+    def __init__(self, nodes):
+        super().__init__()
+        self._nodes = nodes
+
+    def _retrieve(self, query_bundle):
+        return self._nodes
+
+
+def test_bm25_ranks_exact_terms_and_updates_incrementally() -> None:
+    index = BM25Index()
+    for node_id, text in CHUNKS.items():
+        index.add(node_id, text)
+    assert index.search("pier 39", 2)[0][0] == "n1"
+    index.remove("n1")
+    assert index.search("pier 39", 2) == []
+    assert index.total_length == sum(index.lengths.values())
+    restored = BM25Index.from_dict(index.to_dict())
+    restored.remove("n0")
+    assert set(restored.lengths) == {"n2"}
+    assert all("n0" not in posting for posting in restored.postings.values())
+
+
+def test_reciprocal_rank_fusion() -> None:
+    fused = reciprocal_rank_fusion([["a", "b"], ["b", "c"]], k=60)
+    assert [node_id for node_id, _ in fused] == ["b", "a", "c"]
+
+
+def test_hybrid_promotes_keyword_matches(tmp_path: Path) -> None:
+    docstore = ShardedDocumentStore(ShardedKVStore(str(tmp_path)))
+    nodes = [TextNode(id_=node_id, text=text) for node_id, text in CHUNKS.items()]
+    docstore.add_documents(nodes)
+    save_bm25_index(docstore, "doc", nodes)
+    bm25 = get_bm25_index(docstore, "doc", version=1)
+    assert get_bm25_index(docstore, "doc", version=1) is bm25
+
+    # the vector side missed the chunk naming the venue entirely
+    vector = StaticRetriever([NodeWithScore(node=nodes[0], score=0.9)])
+    retriever = HybridRetriever(vector, bm25, docstore, similarity_top_k=2)
+    retrieved = retriever.retrieve(QueryBundle("When is Harbour Lights at Pier 39?"))
+    assert {n.node.node_id for n in retrieved} == {"n0", "n1"}
+    # the vector similarity is kept as the score, the fused one is metadata
+    scores = {n.node.node_id: n.score for n in retrieved}
+    assert scores == {"n0": 0.9, "n1": None}
+    assert all(RRF_SCORE_KEY in n.node.metadata for n in retrieved)
+    assert RRF_SCORE_KEY not in nodes[0].metadata
+    assert RRF_SCORE_KEY not in retrieved[0].node.get_content(metadata_mode="llm")
@@ -0,0 +1,43 @@
+from llama_index.core import VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import TextNode
+
+from app.core.index_cache import IndexCache, estimate_index_size
+
+
+def build_index(n: int) -> VectorStoreIndex:
+    return VectorStoreIndex(
+        [TextNode(text=f"chunk {i}") for i in range(n)],
+        embed_model=MockEmbedding(embed_dim=2),
+    )
+
+
+def test_hit_requires_matching_version() -> None:
+    cache = IndexCache()
+    index = build_index(1)
+    cache.put("doc", 1, index)
+    assert cache.get("doc", 1) is index
+    # re-ingesting bumps the storage version
+    assert cache.get("doc", 2) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_evicts_least_recently_used_over_budget() -> None:
+    a, b, c = build_index(2), build_index(2), build_index(2)
+    cache = IndexCache(max_bytes=2 * estimate_index_size(a))
+    cache.put("a", 1, a)
+    cache.put("b", 1, b)
+    cache.get("a", 1)
+    cache.put("c", 1, c)
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) is a and cache.get("c", 1) is c
+    assert cache.size <= cache.max_bytes
+
+
+def test_replacing_an_entry_updates_the_size() -> None:
+    cache = IndexCache()
+    cache.put("doc", 1, build_index(1))
+    cache.put("doc", 2, build_index(1))
+    assert len(cache) == 1
+    cache.invalidate("doc")
+    assert cache.size == 0 and len(cache) == 0
@@ -0,0 +1,117 @@
+import io
+import uuid
+
+import fsspec
+import pytest
+from llama_index.core import MockEmbedding, ServiceContext
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.vector_stores import SimpleVectorStore
+
+from app.core import rag_engine
+from app.core.fetcher import FetchedDocument
+from app.core.hybrid import BM25_COLLECTION
+from app.schema import Document
+
+DOC_ID = str(uuid.UUID(int=7))
+OTHER_DOC_ID = str(uuid.UUID(int=8))
+
+
+def pages(*texts: str, doc_id: str = DOC_ID):
+    return [
+        TextNode(
+            id_=f"{doc_id}_page_{i}_0",
+            text=text,
+            metadata={rag_engine.DB_DOC_ID_KEY: doc_id},
+            relationships={
+                NodeRelationship.SOURCE: RelatedNodeInfo(node_id=f"{doc_id}_page_{i}")
+            },
+        )
+        for i, text in enumerate(texts)
+    ]
+
+
+def service_context() -> ServiceContext:
+    return ServiceContext.from_defaults(
+        llm=MockLLM(), embed_model=MockEmbedding(embed_dim=2)
+    )
+
+
+@pytest.mark.anyio
+async def test_reingesting_replaces_the_previous_version(monkeypatch) -> None:
+    vector_store = SimpleVectorStore()
+    versions = iter([pages("first", "second", "third"), pages("revised")])
+
+    async def get_vector_store_singleton():
+        return vector_store
+
+    async def fetch_documents(documents, etags=None):
+        return {DOC_ID: None}
+
+    async def parse_documents(fetched):
+        return {DOC_ID: next(versions)}
+
+    monkeypatch.setattr(
+        rag_engine, "get_vector_store_singleton", get_vector_store_singleton
+    )
+    monkeypatch.setattr(rag_engine, "fetch_documents", fetch_documents)
+    monkeypatch.setattr(rag_engine, "parse_documents", parse_documents)
+    document = Document(id=uuid.UUID(DOC_ID), url="s3://doc.pdf")
+    fs = fsspec.filesystem("memory")
+
+    await rag_engine.ingest_document(service_context(), document, fs=fs)
+    index = await rag_engine.ingest_document(service_context(), document, fs=fs)
+
+    docstore = index.storage_context.docstore
+    assert set(vector_store.data.embedding_dict) == {f"{DOC_ID}_page_0_0"}
+    assert docstore.get_node(f"{DOC_ID}_page_0_0").get_content() == "revised"
+    assert not docstore.document_exists(f"{DOC_ID}_page_1_0")
+    bm25 = docstore.kvstore.get(DOC_ID, collection=BM25_COLLECTION)
+    assert bm25 is not None
+
+
+@pytest.mark.anyio
+async def test_fullstore_leaves_per_document_indices_alone(monkeypatch) -> None:
+    vector_store = SimpleVectorStore()
+
+    async def get_vector_store_singleton():
+        return vector_store
+
+    async def fetch_documents(documents, etags=None):
+        return {
+            str(doc.id): FetchedDocument(
+                content=io.BytesIO(), etag=None, content_hash=str(doc.id)
+            )
+            for doc in documents
+        }
+
+    async def parse_documents(fetched):
+        return {doc_id: pages("text", doc_id=doc_id) for doc_id in fetched}
+
+    monkeypatch.setattr(
+        rag_engine, "get_vector_store_singleton", get_vector_store_singleton
+    )
+    monkeypatch.setattr(rag_engine, "fetch_documents", fetch_documents)
+    monkeypatch.setattr(rag_engine, "parse_documents", parse_documents)
+    document = Document(id=uuid.UUID(DOC_ID), url="s3://doc.pdf")
+    other = Document(id=uuid.UUID(OTHER_DOC_ID), url="s3://other.pdf")
+    fs = fsspec.filesystem("memory")
+    per_document = f"{DOC_ID}_page_0_0"
+
+    await rag_engine.ingest_document(service_context(), document, fs=fs)
+    # the document was never in the fullstore, so there is nothing to prune
+    index = await rag_engine.build_single_index(
+        service_context(), [other], fs=fs, force=True
+    )
+    assert rag_engine.get_indexed_doc_ids(index) == {OTHER_DOC_ID}
+    assert per_document in vector_store.data.embedding_dict
+
+    index = await rag_engine.build_single_index(service_context(), [document], fs=fs)
+    assert rag_engine.get_indexed_doc_ids(index) == {DOC_ID, OTHER_DOC_ID}
+
+    index = await rag_engine.build_single_index(
+        service_context(), [other], fs=fs, force=True
+    )
+    assert rag_engine.get_indexed_doc_ids(index) == {OTHER_DOC_ID}
+    assert per_document in vector_store.data.embedding_dict
+    assert index.storage_context.docstore.document_exists(per_document)
@@ -0,0 +1,83 @@
+import uuid
+from datetime import datetime
+
+from app.core.metadata_index import MetadataIndex, parse_time_range
+from app.core.rag_engine import prefilter_documents
+from app.schema import Document, DocumentMetadataKeysEnum
+
+# a saturday
+NOW = datetime(2024, 6, 15, 10)
+
+
+def document(event_date) -> Document:
+    return Document(
+        id=uuid.uuid4(),
+        url="https://example.com/event.pdf",
+        metadata_map={
+            DocumentMetadataKeysEnum.event_DOCUMENT: {
+                "filename": "event.pdf",
+                "locationt": "",
+                "event_date": event_date,
+                "doc_type": "flyer",
+            }
+        },
+    )
+
+
+def test_parse_time_range() -> None:
+    assert parse_time_range("anything on this weekend?", NOW) == (
+        datetime(2024, 6, 15),
+        datetime(2024, 6, 17),
+    )
+    assert parse_time_range("what about tomorrow", NOW) == (
+        datetime(2024, 6, 16),
+        datetime(2024, 6, 17),
+    )
+    assert parse_time_range("gigs in march", NOW) == (
+        datetime(2025, 3, 1),
+        datetime(2025, 4, 1),
+    )
+    assert parse_time_range("what happens on 2024-07-01", NOW)[0] == datetime(
+        2024, 7, 1
+    )
+    assert parse_time_range("who is playing?", NOW) is None
+
+
+def test_prune_by_date_keeps_undated_documents() -> None:
+    saturday = document("2024-06-15T20:00:00")
+    next_month = document("2024-07-20T20:00:00")
+    undated = document(None)
+    index = MetadataIndex()
+    index.add_documents([saturday, next_month, undated])
+    ids = [str(d.id) for d in (saturday, next_month, undated)]
+    assert index.prune(ids, parse_time_range("this weekend", NOW)) == [
+        ids[0],
+        ids[2],
+    ]
+    index.remove(ids[0])
+    assert index.between(datetime(2024, 6, 1), datetime(2024, 8, 1)) == {ids[1]}
+
+
+def test_least_recently_added_documents_are_dropped() -> None:
+    index = MetadataIndex(max_documents=2)
+    index.add("a", datetime(2024, 6, 15))
+    index.add("b", datetime(2024, 6, 16))
+    index.add("a", datetime(2024, 6, 15))
+    index.add("c", datetime(2024, 7, 1))
+    assert len(index) == 2 and "b" not in index
+    # dropped documents are kept like undated ones
+    assert index.prune(
+        ["a", "b", "c"], (datetime(2024, 6, 1), datetime(2024, 6, 30))
+    ) == [
+        "a",
+        "b",
+    ]
+
+
+def test_prefilter_allows_for_the_users_timezone() -> None:
+    # friday evening in new york is already saturday in utc
+    now = datetime(2024, 6, 15, 1)
+    friday_night = document("2024-06-14T21:00:00")
+    next_week = document("2024-06-21T21:00:00")
+    kept = prefilter_documents([friday_night, next_week], "what's on tonight?", now)
+    assert kept == [friday_night]
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from llama_index.core import MockEmbedding, VectorStoreIndex
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from app.chat.constants import DB_DOC_ID_KEY
+from app.core.multi_doc import (
+    MultiDocumentRetriever,
+    SharedDocumentQuery,
+    bucket_by_document,
+)
+
+
+def node(doc_id: str, i: int, embedding=None) -> TextNode:
+    return TextNode(
+        id_=f"{doc_id}-{i}",
+        text=f"{doc_id} chunk {i}",
+        metadata={DB_DOC_ID_KEY: doc_id},
+        embedding=embedding,
+    )
+
+
+def test_bucket_by_document_keeps_best_per_document() -> None:
+    scored = [
+        NodeWithScore(node=node("a", i), score=score)
+        for i, score in enumerate([0.9, 0.8, 0.7])
+    ] + [NodeWithScore(node=node("b", 0), score=0.1)]
+    buckets = bucket_by_document(scored, per_document_top_k=2)
+    assert [n.node.node_id for n in buckets["a"]] == ["a-0", "a-1"]
+    assert [n.node.node_id for n in buckets["b"]] == ["b-0"]
+
+
+def test_one_query_covers_only_the_requested_documents() -> None:
+    nodes = [
+        node(doc_id, i, embedding=[1.0, float(i)])
+        for doc_id in ("a", "b", "c")
+        for i in range(4)
+    ]
+    index = VectorStoreIndex(nodes, embed_model=MockEmbedding(embed_dim=2))
+    retriever = MultiDocumentRetriever(index, ["a", "b"], per_document_top_k=2)
+    buckets = retriever.retrieve_per_document(
+        QueryBundle(query_str="q", embedding=[1.0, 0.0])
+    )
+    assert sorted(buckets) == ["a", "b"]
+    assert all(len(bucket) == 2 for bucket in buckets.values())
+
+
+def test_crowded_out_documents_are_topped_up() -> None:
+    # every chunk of "a" beats every chunk of "b"
+    nodes = [node("a", i, embedding=[1.0, 0.01 * i]) for i in range(4)] + [
+        node("b", i, embedding=[0.0, 1.0]) for i in range(2)
+    ]
+    index = VectorStoreIndex(nodes, embed_model=MockEmbedding(embed_dim=2))
+    retriever = MultiDocumentRetriever(index, ["a", "b"], per_document_top_k=2)
+    buckets = retriever.retrieve_per_document(
+        QueryBundle(query_str="q", embedding=[1.0, 0.0])
+    )
+    assert len(buckets["a"]) == 2 and len(buckets["b"]) == 2
+
+
+@pytest.mark.anyio
+async def test_documents_asking_the_same_question_share_a_query() -> None:
+    nodes = [
+        node(doc_id, i, embedding=[1.0, float(i)])
+        for doc_id in ("a", "b")
+        for i in range(3)
+    ]
+    index = VectorStoreIndex(nodes, embed_model=MockEmbedding(embed_dim=2))
+    retriever = MultiDocumentRetriever(index, ["a", "b"], per_document_top_k=2)
+    queries = []
+    aget_buckets = retriever.aget_buckets
+
+    async def counted(query_bundle):
+        queries.append(query_bundle.query_str)
+        return await aget_buckets(query_bundle)
+
+    retriever.aget_buckets = counted
+    shared = SharedDocumentQuery(retriever)
+    query = QueryBundle(query_str="q", embedding=[1.0, 0.0])
+    a, b = await asyncio.gather(
+        shared.aretrieve("a", query, 1), shared.aretrieve("b", query, 2)
+    )
+    assert queries == ["q"]
+    assert [n.node.node_id for n in a] == ["a-0"]
+    assert {n.node.metadata[DB_DOC_ID_KEY] for n in b} == {"b"} and len(b) == 2
@@ -0,0 +1,102 @@
+import io
+import multiprocessing
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from tempfile import SpooledTemporaryFile
+from typing import List
+
+import pytest
+from llama_index.core.schema import BaseNode
+from pypdf import PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+from app.chat.constants import DB_DOC_ID_KEY
+from app.core import parsing
+from app.core.config import settings
+from app.core.parsing import chunk_documents, parse_and_chunk, read_pdf
+
+DOC_ID = str(uuid.UUID(int=3))
+
+
+def pdf(texts: List[str]) -> bytes:
+    """a pdf with one line of text per page"""
+    writer = PdfWriter()
+    font = writer._add_object(
+        DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Font"),
+                NameObject("/Subtype"): NameObject("/Type1"),
+                NameObject("/BaseFont"): NameObject("/Helvetica"),
+            }
+        )
+    )
+    for text in texts:
+        page = writer.add_blank_page(612, 792)
+        page[NameObject("/Resources")] = DictionaryObject(
+            {NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})}
+        )
+        contents = DecodedStreamObject()
+        contents.set_data(f"BT /F1 12 Tf 72 712 Td ({text}) Tj ET".encode())
+        page[NameObject("/Contents")] = writer._add_object(contents)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def summary(nodes: List[BaseNode]) -> list:
+    return [
+        (
+            node.node_id,
+            node.metadata["page_label"],
+            node.metadata["file_name"],
+            node.metadata[DB_DOC_ID_KEY],
+            node.get_content(),
+        )
+        for node in nodes
+    ]
+
+
+@pytest.mark.anyio
+async def test_pool_parses_like_a_single_pass(monkeypatch, tmp_path: Path) -> None:
+    data = pdf([f"Day {i} opens with the jazz stage at {i + 1} pm." for i in range(5)])
+    serial = chunk_documents(read_pdf(DOC_ID, io.BytesIO(data)))
+    assert len({node.metadata["page_label"] for node in serial}) == 5
+
+    # page ranges of two, spread over real worker processes
+    monkeypatch.setattr(settings, "PARSE_PAGES_PER_TASK", 2)
+    executor = ProcessPoolExecutor(
+        max_workers=2, mp_context=multiprocessing.get_context("spawn")
+    )
+    monkeypatch.setattr(parsing, "_executor", executor)
+    try:
+        # a download in memory, one rolled over to disk and a blob cache file
+        with SpooledTemporaryFile(max_size=len(data) + 1) as content:
+            content.write(data)
+            spooled = await parse_and_chunk(DOC_ID, content)
+        with SpooledTemporaryFile(max_size=1) as content:
+            content.write(data)
+            rolled = await parse_and_chunk(DOC_ID, content)
+        path = tmp_path / "cached.pdf"
+        path.write_bytes(data)
+        with open(path, "rb") as content:
+            cached = await parse_and_chunk(DOC_ID, content)
+    finally:
+        executor.shutdown()
+
+    assert summary(spooled) == summary(serial)
+    assert summary(rolled) == summary(serial)
+    assert summary(cached) == summary(serial)
+
+
+def test_only_rolled_over_downloads_are_spilled() -> None:
+    with SpooledTemporaryFile(max_size=16) as content:
+        content.write(b"%PDF small")
+        assert parsing._spill(content) == (b"%PDF small", False)
+        content.write(b" and now over the spool limit")
+        path, is_temp = parsing._spill(content)
+    assert (
+        is_temp
+        and Path(path).read_bytes() == b"%PDF small and now over the spool limit"
+    )
+    Path(path).unlink()
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from app.core.quantization import BINARY, INT8, NONE, QuantizedVectors, benchmark
+
+
+def unit(n: int, dim: int = 64, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("mode", [NONE, INT8, BINARY])
+def test_rescored_scores_are_exact(mode: str, tmp_path) -> None:
+    vectors = unit(500)
+    store = QuantizedVectors(vectors, mode=mode, spill_dir=str(tmp_path))
+    positions, scores = store.search(vectors[42], 5)
+    assert positions[0] == 42
+    np.testing.assert_allclose(scores, vectors[positions] @ vectors[42], rtol=1e-5)
+
+
+def test_searches_within_rows(tmp_path) -> None:
+    vectors = unit(100)
+    store = QuantizedVectors(vectors, mode=INT8, spill_dir=str(tmp_path))
+    positions, _ = store.search(vectors[10], 3, rows=slice(50, 100))
+    assert all(0 <= p < 50 for p in positions)
+    rows = np.array([10, 20, 30])
+    positions, _ = store.search(vectors[10], 1, rows=rows)
+    assert rows[positions[0]] == 10
+
+
+def test_benchmark_recall_and_memory() -> None:
+    results = {row["mode"]: row for row in benchmark(n=2000, dim=256, queries=20)}
+    assert results[NONE]["recall"] == 1.0
+    assert results[INT8]["recall"] >= 0.99 and results[INT8]["compression"] >= 3.9
+    assert results[BINARY]["recall"] >= 0.8 and results[BINARY]["compression"] == 32
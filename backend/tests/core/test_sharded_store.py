@@ -0,0 +1,153 @@
+import asyncio
+import uuid
+from pathlib import Path
+
+import pytest
+
+from llama_index.core.data_structs import IndexDict
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores import SimpleVectorStore
+
+from app.core.sharded_store import (
+    KEEP_MANIFESTS,
+    ShardedDocumentStore,
+    ShardedIndexStore,
+    ShardedKVStore,
+    get_sharded_storage_context,
+    shard_for_key,
+)
+
+DOC_A = str(uuid.UUID(int=1))
+DOC_B = str(uuid.UUID(int=2))
+
+
+def test_shard_for_key() -> None:
+    assert shard_for_key(f"{DOC_A}_page_3_1") == DOC_A
+    assert shard_for_key(f"{DOC_A}/etag") == DOC_A
+    assert shard_for_key("fullstore").startswith("shared-")
+
+
+def test_persist_writes_only_dirty_shards(tmp_path: Path) -> None:
+    store = ShardedKVStore(str(tmp_path))
+    store.put(f"{DOC_A}_page_0", {"v": 1})
+    store.put(f"{DOC_B}_page_0", {"v": 2})
+    store.persist()
+    assert store.manifest == {DOC_A: 1, DOC_B: 1}
+
+    store.put(f"{DOC_A}_page_1", {"v": 3})
+    store.persist()
+    assert store.manifest == {DOC_A: 2, DOC_B: 1}
+
+
+def test_shards_load_lazily(tmp_path: Path) -> None:
+    store = ShardedKVStore(str(tmp_path))
+    store.put(f"{DOC_A}_page_0", {"v": 1}, collection="c")
+    store.put(f"{DOC_B}_page_0", {"v": 2}, collection="c")
+    store.persist()
+
+    reopened = ShardedKVStore(str(tmp_path))
+    assert reopened.get(f"{DOC_A}_page_0", collection="c") == {"v": 1}
+    assert list(reopened._shards) == [DOC_A]
+    assert reopened.get_all(collection="c") == {
+        f"{DOC_A}_page_0": {"v": 1},
+        f"{DOC_B}_page_0": {"v": 2},
+    }
+
+
+def test_emptied_shards_are_removed(tmp_path: Path) -> None:
+    store = ShardedKVStore(str(tmp_path))
+    store.put(f"{DOC_A}_page_0", {"v": 1})
+    store.persist()
+    assert store.delete(f"{DOC_A}_page_0")
+    store.persist()
+    assert store.manifest == {}
+    assert not (tmp_path / "shards" / f"{DOC_A}.json.z").exists()
+
+
+def test_document_and_index_stores_share_shards(tmp_path: Path) -> None:
+    kvstore = ShardedKVStore(str(tmp_path))
+    docstore = ShardedDocumentStore(kvstore)
+    index_store = ShardedIndexStore(kvstore)
+    docstore.add_documents([TextNode(id_=f"{DOC_A}_page_0_0", text="hello")])
+    index_store.add_index_struct(IndexDict(index_id=DOC_A))
+    docstore.persist()
+
+    reopened = ShardedKVStore(str(tmp_path))
+    assert list(reopened.manifest) == [DOC_A]
+    node = ShardedDocumentStore(reopened).get_node(f"{DOC_A}_page_0_0")
+    assert node.get_content() == "hello"
+    assert ShardedIndexStore(reopened).get_index_struct(DOC_A).index_id == DOC_A
+
+
+def test_revalidate_reloads_only_changed_shards(tmp_path: Path) -> None:
+    writer = ShardedKVStore(str(tmp_path))
+    writer.put(f"{DOC_A}_page_0", {"v": 1})
+    writer.put(f"{DOC_B}_page_0", {"v": 1})
+    writer.persist()
+
+    reader = ShardedKVStore(str(tmp_path))
+    assert reader.get(f"{DOC_A}_page_0") == {"v": 1}
+    assert reader.get(f"{DOC_B}_page_0") == {"v": 1}
+    unchanged = reader._shards[DOC_B]
+
+    writer.put(f"{DOC_A}_page_0", {"v": 2})
+    writer.persist()
+    # within max_age the manifest is not re-read
+    reader.revalidate()
+    assert reader.get(f"{DOC_A}_page_0") == {"v": 1}
+    reader.revalidate(max_age=0)
+    assert reader.get(f"{DOC_A}_page_0") == {"v": 2}
+    assert reader._shards[DOC_B] is unchanged
+
+
+def test_persist_only_writes_the_given_keys(tmp_path: Path) -> None:
+    store = ShardedKVStore(str(tmp_path))
+    store.put(f"{DOC_A}_page_0", {"v": 1})
+    store.put(f"{DOC_B}_page_0", {"v": 2})
+    store.persist([DOC_A])
+    assert store.manifest == {DOC_A: 1}
+    assert store._dirty == {DOC_B}
+
+
+@pytest.mark.anyio
+async def test_concurrent_persists_keep_each_others_versions(tmp_path: Path) -> None:
+    first, second = ShardedKVStore(str(tmp_path)), ShardedKVStore(str(tmp_path))
+    first.put(f"{DOC_A}_page_0", {"v": 1})
+    second.put(f"{DOC_B}_page_0", {"v": 2})
+    # both read the same manifest generation, one of them has to retry
+    await asyncio.gather(first.apersist(), second.apersist())
+    reader = ShardedKVStore(str(tmp_path))
+    assert reader.manifest == {DOC_A: 1, DOC_B: 1}
+    assert reader._generation == 2
+
+
+def test_old_manifest_generations_are_pruned(tmp_path: Path) -> None:
+    store = ShardedKVStore(str(tmp_path))
+    for v in range(KEEP_MANIFESTS + 3):
+        store.put(f"{DOC_A}_page_0", {"v": v})
+        store.persist()
+    assert len(list((tmp_path / "manifests").iterdir())) == KEEP_MANIFESTS
+    assert ShardedKVStore(str(tmp_path)).manifest == {DOC_A: KEEP_MANIFESTS + 3}
+
+
+@pytest.mark.anyio
+async def test_async_persist_and_load(tmp_path: Path) -> None:
+    store = ShardedKVStore(str(tmp_path))
+    store.put(f"{DOC_A}_page_0", {"v": 1})
+    store.put(f"{DOC_B}_page_0", {"v": 2})
+    await store.apersist()
+    assert store.manifest == {DOC_A: 1, DOC_B: 1}
+
+    reopened = ShardedKVStore(str(tmp_path))
+    await reopened.aload([f"{DOC_A}_page_0", f"{DOC_B}/etag"])
+    assert sorted(reopened._shards) == [DOC_A, DOC_B]
+    assert reopened.get(f"{DOC_B}_page_0") == {"v": 2}
+
+
+@pytest.mark.anyio
+async def test_storage_contexts_are_cached_per_input(tmp_path: Path) -> None:
+    vector_store = SimpleVectorStore()
+    first = await get_sharded_storage_context(str(tmp_path / "a"), vector_store)
+    again = await get_sharded_storage_context(str(tmp_path / "a"), vector_store)
+    other = await get_sharded_storage_context(str(tmp_path / "b"), vector_store)
+    assert again is first and other is not first
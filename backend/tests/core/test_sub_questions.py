@@ -0,0 +1,156 @@
+import asyncio
+import time
+from typing import List, Sequence
+
+import pytest
+from llama_index.core.base.response.schema import Response
+from llama_index.core.callbacks import CallbackManager, CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.llms import MockLLM
+from llama_index.core.query_engine import CustomQueryEngine
+from llama_index.core.question_gen.types import BaseQuestionGenerator, SubQuestion
+from llama_index.core.response_synthesizers.no_text import NoText
+from llama_index.core.tools import QueryEngineTool, ToolMetadata
+
+from app.core.sub_questions import BoundedSubQuestionQueryEngine, SkippedSubQuestion
+from app.schema import QuestionAnswerPair
+
+
+class SlowQueryEngine(CustomQueryEngine):
+    delay: float
+
+    def custom_query(self, query_str: str) -> str:
+        raise NotImplementedError
+
+    async def acustom_query(self, query_str: str) -> Response:
+        if self.delay < 0:
+            raise RuntimeError("ThrottlingException")
+        await asyncio.sleep(self.delay)
+        return Response(f"answer to {query_str}")
+
+
+class FixedQuestions(BaseQuestionGenerator):
+    def __init__(self, sub_questions: List[SubQuestion]):
+        self.sub_questions = sub_questions
+
+    def _get_prompts(self):
+        return {}
+
+    def _update_prompts(self, prompts) -> None:
+        pass
+
+    def generate(self, tools: Sequence[ToolMetadata], query) -> List[SubQuestion]:
+        return self.sub_questions
+
+    async def agenerate(self, tools, query) -> List[SubQuestion]:
+        return self.sub_questions
+
+
+class SubQuestionRecorder(BaseCallbackHandler):
+    def __init__(self):
+        super().__init__([], [])
+        self.ended = []
+
+    def on_event_start(self, *args, **kwargs):
+        return ""
+
+    def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+        if event_type == CBEventType.SUB_QUESTION:
+            self.ended.append(payload[EventPayload.SUB_QUESTION])
+
+    def start_trace(self, trace_id=None):
+        pass
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        pass
+
+
+def engine(
+    delays: dict, recorder: SubQuestionRecorder, **kwargs
+) -> BoundedSubQuestionQueryEngine:
+    callback_manager = CallbackManager([recorder])
+    tools = [
+        QueryEngineTool(
+            query_engine=SlowQueryEngine(
+                delay=delay, callback_manager=callback_manager
+            ),
+            metadata=ToolMetadata(name=name, description=name),
+        )
+        for name, delay in delays.items()
+    ]
+    return BoundedSubQuestionQueryEngine(
+        FixedQuestions(
+            [
+                SubQuestion(sub_question=f"about {name}", tool_name=name)
+                for name in delays
+            ]
+        ),
+        NoText(llm=MockLLM(), callback_manager=callback_manager),
+        tools,
+        callback_manager=callback_manager,
+        verbose=False,
+        **kwargs,
+    )
+
+
+@pytest.mark.anyio
+async def test_slow_sub_questions_are_skipped_at_the_deadline() -> None:
+    recorder = SubQuestionRecorder()
+    query_engine = engine(
+        {"fast": 0.0, "slow": 5.0},
+        recorder,
+        sub_question_timeout=5.0,
+        deadline=0.2,
+    )
+    start = time.perf_counter()
+    response = await query_engine.aquery("what's on?")
+    assert time.perf_counter() - start < 1.0
+
+    texts = [n.node.get_content() for n in response.source_nodes]
+    assert "Sub question: about fast\nResponse: answer to about fast" in texts
+    assert any(
+        t.startswith("Sub question: about slow\nResponse: Not answered") for t in texts
+    )
+    skipped = [p for p in recorder.ended if isinstance(p, SkippedSubQuestion)]
+    assert [p.sub_q.tool_name for p in skipped] == ["slow"]
+
+
+@pytest.mark.anyio
+async def test_sub_questions_run_a_few_at_a_time() -> None:
+    recorder = SubQuestionRecorder()
+    query_engine = engine(
+        {name: 0.1 for name in "abcd"},
+        recorder,
+        max_concurrency=2,
+        sub_question_timeout=5.0,
+        deadline=5.0,
+    )
+    start = time.perf_counter()
+    await query_engine.aquery("what's on?")
+    # two rounds of two
+    assert 0.2 <= time.perf_counter() - start < 0.4
+    assert len(recorder.ended) == 4
+    assert not any(isinstance(p, SkippedSubQuestion) for p in recorder.ended)
+
+
+@pytest.mark.anyio
+async def test_failing_sub_questions_are_skipped() -> None:
+    recorder = SubQuestionRecorder()
+    query_engine = engine({"ok": 0.0, "throttled": -1.0}, recorder)
+    response = await query_engine.aquery("what's on?")
+
+    texts = [n.node.get_content() for n in response.source_nodes]
+    assert "Sub question: about ok\nResponse: answer to about ok" in texts
+    skipped = [p for p in recorder.ended if isinstance(p, SkippedSubQuestion)]
+    assert [p.sub_q.tool_name for p in skipped] == ["throttled"]
+    assert "RuntimeError" in skipped[0].skipped_reason
+
+
+def test_skipped_reason_reaches_the_message_metadata() -> None:
+    skipped = SkippedSubQuestion(
+        sub_q=SubQuestion(sub_question="who headlines?", tool_name="doc"),
+        skipped_reason="the deadline had passed",
+    )
+    pair = QuestionAnswerPair.from_sub_question_answer_pair(skipped)
+    assert pair.answer is None
+    assert pair.skipped_reason == "the deadline had passed"
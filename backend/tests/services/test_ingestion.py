@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.schemas import IngestionJobCreate, IngestionJobInDB, IngestionJobStatus
+from app.services.ingestion import IngestionJobStore, IngestionWorkerPool
+
+
+def test_enqueue_deduplicates_active_jobs() -> None:
+    store = IngestionJobStore(path=":memory:")
+    job = store.enqueue(IngestionJobCreate(document_id="doc", url="s3://doc.pdf"))
+    assert job.status == IngestionJobStatus.queued
+    again = store.enqueue(IngestionJobCreate(document_id="doc", url="s3://doc.pdf"))
+    assert again.id == job.id
+
+    claimed = store.claim()
+    assert claimed is not None and claimed.id == job.id
+    assert claimed.status == IngestionJobStatus.running
+    assert store.enqueue(IngestionJobCreate(document_id="doc", url="")).id == job.id
+
+    store.succeed(job.id)
+    # finished jobs don't block a new one for the same document
+    assert store.enqueue(IngestionJobCreate(document_id="doc", url="")).id != job.id
+
+
+def test_claim_respects_not_before() -> None:
+    store = IngestionJobStore(path=":memory:")
+    store.enqueue(
+        IngestionJobCreate(
+            document_id="doc",
+            url="s3://doc.pdf",
+            not_before=datetime.now() + timedelta(hours=1),
+        )
+    )
+    assert store.claim() is None
+
+
+@pytest.mark.anyio
+async def test_worker_pool_retries_failed_jobs() -> None:
+    store = IngestionJobStore(path=":memory:")
+    job = store.enqueue(IngestionJobCreate(document_id="doc", url="s3://doc.pdf"))
+
+    async def handler(job: IngestionJobInDB, report) -> None:
+        report("fetching")
+        raise RuntimeError("boom")
+
+    pool = IngestionWorkerPool(store, handler, max_attempts=2)
+    await pool._run_job(store.claim())
+    job = store.get(job.id)
+    assert job.status == IngestionJobStatus.queued
+    assert job.stage == "fetching"
+    assert "boom" in job.error
+
+    store._conn.execute("UPDATE jobs SET not_before = 0")
+    await pool._run_job(store.claim())
+    assert store.get(job.id).status == IngestionJobStatus.failed